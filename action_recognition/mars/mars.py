@@ -17,6 +17,8 @@ from webcamera_utils import get_capture  # noqa: E402
 from image_utils import load_image  # noqa: E402
 from classifier_utils import plot_results  # noqa: E402
 
+from mars_utils import ClipBuffer, ResultSmoother  # noqa: E402
+
 
 # ======================
 # Parameters
@@ -98,6 +100,14 @@ parser.add_argument(
     '-t', '--top', metavar='TOP', default=3, type=int,
     help='Number of outputs for category.',
 )
+parser.add_argument(
+    '-s', '--stride', metavar='STRIDE', default=1, type=int,
+    help='Predict every STRIDE frames.',
+)
+parser.add_argument(
+    '-w', '--smooth_window', metavar='WINDOW', default=1, type=int,
+    help='Average the results of the last WINDOW predictions.',
+)
 args = update_parser(parser)
 
 
@@ -118,21 +128,22 @@ def recognize_from_image():
     # prepare input data
     num = lambda val: int(re.sub("\\D", "", val))
     sorted_inputs_path = sorted(args.input, key=num)
-    input_blob = np.empty((1, 3, args.duration, IMAGE_HEIGHT, IMAGE_WIDTH))
-    for i, input_path in enumerate(sorted_inputs_path[0:args.duration]):
+    clip_buffer = ClipBuffer(args.duration, (3, IMAGE_HEIGHT, IMAGE_WIDTH))
+    for input_path in sorted_inputs_path[0:args.duration]:
         img = load_image(
             input_path,
             (IMAGE_HEIGHT, IMAGE_WIDTH),
             normalize_type='None',
             gen_input_ailia=True
         )
-        input_blob[0, :, i, :, :] = img
+        clip_buffer.push(img)
     next_input_index = args.duration
     input_frame_size = len(sorted_inputs_path)
 
     # net initialize
     net = ailia.Net(MODEL_PATH, WEIGHT_PATH, env_id=args.env_id)
     net.set_input_shape((1, 3, args.duration, IMAGE_HEIGHT, IMAGE_WIDTH))
+    smoother = ResultSmoother(args.smooth_window)
 
     # inference
     print('Start inference...')
@@ -140,24 +151,22 @@ def recognize_from_image():
         print('BENCHMARK mode')
         for i in range(5):
             start = int(round(time.time() * 1000))
-            result = net.predict(input_blob)
+            result = net.predict(clip_buffer.clip())
             end = int(round(time.time() * 1000))
             print(f'\tailia processing time {end - start} ms')
     else:
         while(next_input_index < input_frame_size):
             if cv2.waitKey(1) & 0xFF == ord('q'):
                 break
-            result = net.predict(input_blob)
-
-            print_mars_result(result)
+            if (next_input_index - args.duration) % args.stride == 0:
+                result = smoother.update(net.predict(clip_buffer.clip()))
 
-            preview_img = cv2.imread(sorted_inputs_path[
-                    next_input_index - args.duration
-            ])
-            cv2.imshow('preview', preview_img)
+                print_mars_result(result)
 
-            for i in range(args.duration - 1):
-                input_blob[0, :, i, :, :] = input_blob[0, :, i + 1, :, :]
+                preview_img = cv2.imread(sorted_inputs_path[
+                        next_input_index - args.duration
+                ])
+                cv2.imshow('preview', preview_img)
 
             img = load_image(
                 sorted_inputs_path[next_input_index],
@@ -165,7 +174,7 @@ def recognize_from_image():
                 normalize_type='None',
                 gen_input_ailia=True
             )
-            input_blob[0, :, args.duration - 1, :, :] = img
+            clip_buffer.push(img)
             next_input_index += 1
 
     print('Script finished successfully.')
@@ -187,38 +196,31 @@ def recognize_from_video():
     net.set_input_shape((1, 3, args.duration, IMAGE_HEIGHT, IMAGE_WIDTH))
 
     # prepare input data
-    original_queue = deque([])
-    input_blob = np.empty((1, 3, args.duration, IMAGE_HEIGHT, IMAGE_WIDTH))
-    for i in range(args.duration - 1):
-        ret, frame = capture.read()
-        if not ret:
-            continue
-        original_queue.append(frame)
-        input_blob[0, :, i, :, :] = convert_input_frame(frame)
+    original_queue = deque([], maxlen=args.duration)
+    clip_buffer = ClipBuffer(args.duration, (3, IMAGE_HEIGHT, IMAGE_WIDTH))
+    smoother = ResultSmoother(args.smooth_window)
+    result = None
 
-    next_input_index = args.duration - 1
-    input_frame_size = capture.get(cv2.CAP_PROP_FRAME_COUNT)
-
-    while(next_input_index <= input_frame_size or input_frame_size == 0):
+    while(True):
         ret, frame = capture.read()
         if (cv2.waitKey(1) & 0xFF == ord('q')) or not ret:
             break
         original_queue.append(frame)
-        input_blob[0, :, args.duration - 1, :, :] = convert_input_frame(frame)
+        clip_buffer.push(convert_input_frame(frame))
+        if not clip_buffer.ready:
+            continue
 
-        result = net.predict(input_blob)
-        print_mars_result(result)
-        preview_img = original_queue.popleft()
+        # predict every `stride` frames
+        if (clip_buffer.count - args.duration) % args.stride == 0:
+            result = smoother.update(net.predict(clip_buffer.clip()))
+            print_mars_result(result)
 
+        # show the first frame of the clip with the latest result
+        preview_img = original_queue[0].copy()
         plot_results(preview_img, result, HMDB51_LABEL)
 
         cv2.imshow('preview', preview_img)
 
-        for i in range(args.duration - 1):
-            input_blob[0, :, i, :, :] = input_blob[0, :, i + 1, :, :]
-
-        next_input_index += 1
-
     capture.release()
     print('Script finished successfully.')
 
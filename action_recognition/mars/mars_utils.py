@@ -0,0 +1,90 @@
+from collections import deque
+
+import numpy as np
+
+
+class ClipBuffer:
+    """
+    Circular buffer of the last `duration` frames of a video.
+
+    Each frame is written twice, at `i` and `i + duration` of a buffer
+    of `2 * duration` frames, so the last `duration` frames are always
+    a slice of the buffer in temporal order. Pushing a frame costs two
+    frame copies, and getting the clip costs one clip copy (the slice
+    is strided along the channels, the network input must be
+    contiguous).
+
+    Parameters
+    ----------
+    duration: int
+        number of frames of a clip
+    frame_shape: tuple of int
+        (C, H, W) shape of a frame
+    dtype: numpy dtype
+    """
+
+    def __init__(self, duration, frame_shape, dtype=np.float32):
+        self.duration = duration
+        c = frame_shape[0]
+        self.buffer = np.zeros(
+            (c, 2 * duration) + tuple(frame_shape[1:]), dtype=dtype)
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.duration)
+
+    @property
+    def ready(self):
+        return self.count >= self.duration
+
+    def reset(self):
+        self.count = 0
+
+    def push(self, frame):
+        """
+        Parameters
+        ----------
+        frame: numpy array
+            (C, H, W) or (1, C, H, W) frame
+        """
+        frame = np.reshape(frame, (self.buffer.shape[0],) + self.buffer.shape[2:])
+        i = self.count % self.duration
+        self.buffer[:, i] = frame
+        self.buffer[:, i + self.duration] = frame
+        self.count += 1
+
+    def clip(self):
+        """
+        The last `duration` frames, oldest first.
+
+        Returns
+        -------
+        numpy array
+            (1, C, duration, H, W) contiguous array
+        """
+        start = self.count % self.duration
+        return np.ascontiguousarray(
+            self.buffer[np.newaxis, :, start:start + self.duration])
+
+
+class ResultSmoother:
+    """
+    Moving average of the last `window` predictions.
+    """
+
+    def __init__(self, window=1):
+        self.results = deque(maxlen=max(window, 1))
+        self.total = None
+
+    def reset(self):
+        self.results.clear()
+        self.total = None
+
+    def update(self, result):
+        result = np.asarray(result, dtype=np.float64)
+        if len(self.results) == self.results.maxlen:
+            self.total -= self.results[0]
+        self.results.append(result)
+        self.total = result.copy() if self.total is None else \
+            self.total + result
+        return self.total / len(self.results)
@@ -1,5 +1,7 @@
 import sys
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import cv2
@@ -13,7 +15,7 @@ from st_gcn_labels import KINETICS_LABEL
 sys.path.append('../../util')
 from utils import get_base_parser, update_parser  # noqa: E402
 from utils import check_file_existance  # noqa: E402
-from model_utils import check_and_download_models  # noqa: E402
+from model_utils import check_and_download_models, SessionPool  # noqa: E402
 from webcamera_utils import get_capture  # noqa: E402
 
 
@@ -72,6 +74,24 @@ parser.add_argument(
     '--img-save', action='store_true',
     help='Instead of show video, save image file.'
 )
+parser.add_argument(
+    '--stream', action='store_true',
+    help=('Streaming mode for long videos: classify a sliding window of ' +
+          'skeletons every --interval frames, in constant memory.')
+)
+parser.add_argument(
+    '--window', default=128, type=int,
+    help='Number of frames of the skeleton window (streaming mode).'
+)
+parser.add_argument(
+    '--interval', default=30, type=int,
+    help='Output the action every INTERVAL frames (streaming mode).'
+)
+parser.add_argument(
+    '--pose_workers', default=0, type=int,
+    help=('Number of pose estimators running in worker threads ahead of ' +
+          'the classifier (streaming mode). 0 runs them inline.')
+)
 args = update_parser(parser)
 
 if args.arch == "pyopenpose":
@@ -108,6 +128,50 @@ def pose_postprocess(pose_keypoints):
     return pose_keypoints
 
 
+def estimate_pose(pose, frame):
+    """
+    Resize the frame to a height of 256 and estimate the poses.
+
+    Returns
+    -------
+    img: numpy array
+        resized frame
+    pose_keypoints: numpy array
+        (num_person, num_joint, 3) keypoints, or None if nobody is found
+    """
+    source_H, source_W, _ = frame.shape
+    img = cv2.resize(
+        frame, (256 * source_W // source_H, 256))
+    H, W, _ = img.shape
+
+    if args.arch == "pyopenpose":
+        datum = op.Datum()
+        datum.cvInputData = img
+        pose.emplaceAndPop([datum])
+        pose_keypoints = datum.poseKeypoints  # (num_person, num_joint, 3)
+        if len(pose_keypoints.shape) != 3:
+            return img, None
+
+        # normalization
+        pose_keypoints[:, :, 0] = pose_keypoints[:, :, 0] / W
+        pose_keypoints[:, :, 1] = pose_keypoints[:, :, 1] / H
+    else:
+        pose.compute(cv2.cvtColor(img, cv2.COLOR_BGR2BGRA))
+        count = pose.get_object_count()
+        if count == 0:
+            return img, None
+
+        pose_keypoints = np.zeros((count, 18, 3))
+        # pose_keypoints.shape : (num_person, num_joint, 3)
+        for idx in range(count):
+            person = pose.get_object_pose(idx)
+            for i, key in enumerate(POSE_KEY):
+                p = person.points[key]
+                pose_keypoints[idx, i, :] = [p.x, p.y, p.score]
+
+    return img, pose_postprocess(pose_keypoints)
+
+
 def postprocess(output, feature, num_person):
     intensity = (feature * feature).sum(axis=0) ** 0.5
 
@@ -154,40 +218,12 @@ def recognize_offline(input, pose, net):
         if frame is None:
             break
 
-        source_H, source_W, _ = frame.shape
-        img = cv2.resize(
-            frame, (256 * source_W // source_H, 256))
+        # pose estimate
+        img, pose_keypoints = estimate_pose(pose, frame)
         frames.append(img)
-        H, W, _ = img.shape
+        if pose_keypoints is None:
+            continue
 
-        # pose estimate
-        if args.arch == "pyopenpose":
-            datum = op.Datum()
-            datum.cvInputData = img
-            pose.emplaceAndPop([datum])
-            pose_keypoints = datum.poseKeypoints  # (num_person, num_joint, 3)
-            if len(pose_keypoints.shape) != 3:
-                continue
-
-            # normalization
-            pose_keypoints[:, :, 0] = pose_keypoints[:, :, 0] / W
-            pose_keypoints[:, :, 1] = pose_keypoints[:, :, 1] / H
-        else:
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2BGRA)
-            pose.compute(img)
-            count = pose.get_object_count()
-            if count == 0:
-                continue
-
-            pose_keypoints = np.zeros((count, 18, 3))
-            # pose_keypoints.shape : (num_person, num_joint, 3)
-            for idx in range(count):
-                person = pose.get_object_pose(idx)
-                for i, key in enumerate(POSE_KEY):
-                    p = person.points[key]
-                    pose_keypoints[idx, i, :] = [p.x, p.y, p.score]
-
-        pose_keypoints = pose_postprocess(pose_keypoints)
         pose_tracker.update(pose_keypoints, frame_index)
         frame_index += 1
         print('Pose estimation ({}/{}).'.format(frame_index, video_length))
@@ -257,44 +293,16 @@ def recognize_realtime(video, pose, net):
         if cv2.waitKey(1) & 0xFF == ord('q') or not ret:
             break
 
-        source_H, source_W, _ = frame.shape
-        img = cv2.resize(
-            frame, (256 * source_W // source_H, 256))
-        H, W, _ = img.shape
-
         # pose estimate
-        if args.arch == "pyopenpose":
-            datum = op.Datum()
-            datum.cvInputData = img
-            pose.emplaceAndPop([datum])
-            pose_keypoints = datum.poseKeypoints  # (num_person, num_joint, 3)
-            if len(pose_keypoints.shape) != 3:
-                continue
-
-            # normalization
-            pose_keypoints[:, :, 0] = pose_keypoints[:, :, 0] / W
-            pose_keypoints[:, :, 1] = pose_keypoints[:, :, 1] / H
-        else:
-            img = cv2.cvtColor(img, cv2.COLOR_BGR2BGRA)
-            pose.compute(img)
-            count = pose.get_object_count()
-            if count == 0:
-                continue
-
-            pose_keypoints = np.zeros((count, 18, 3))
-            # pose_keypoints.shape : (num_person, num_joint, 3)
-            for idx in range(count):
-                person = pose.get_object_pose(idx)
-                for i, key in enumerate(POSE_KEY):
-                    p = person.points[key]
-                    pose_keypoints[idx, i, :] = [p.x, p.y, p.score]
+        _, pose_keypoints = estimate_pose(pose, frame)
+        if pose_keypoints is None:
+            continue
 
         # pose tracking
         if video == '0':
             frame_index = int((time.time() - start_time) * args.fps)
         else:
             frame_index += 1
-        pose_keypoints = pose_postprocess(pose_keypoints)
         pose_tracker.update(pose_keypoints, frame_index)
 
         # action recognition
@@ -330,18 +338,7 @@ def recognize_realtime(video, pose, net):
     print('Script finished successfully.')
 
 
-def main():
-    # model files check and download
-    print("=== ST-GCN model ===")
-    check_and_download_models(WEIGHT_PATH, MODEL_PATH, REMOTE_PATH)
-    print("=== OpenPose model ===")
-    check_and_download_models(
-        WEIGHT_POSE_PATH, MODEL_POSE_PATH, REMOTE_POSE_PATH
-    )
-
-    # net initialize
-    net = ailia.Net(MODEL_PATH, WEIGHT_PATH, env_id=args.env_id)
-
+def create_pose_estimator():
     if args.arch == "pyopenpose":
         pose = op.WrapperPython()
         params = dict(model_folder='.', model_pose='COCO')
@@ -356,6 +353,115 @@ def main():
         )
         if args.arch == "openpose":
             pose.set_threshold(0.1)
+    return pose
+
+
+def estimate_pose_pooled(pool, frame):
+    with pool.acquire() as pose:
+        return estimate_pose(pose, frame)[1]
+
+
+def recognize_streaming(input, pose, net):
+    """
+    Classify a sliding window of `args.window` frames every
+    `args.interval` frames. Decoded frames are dropped as soon as their
+    poses are estimated, so memory does not grow with the video length.
+    """
+    capture = get_capture(input)
+    pose_tracker = naive_pose_tracker(data_frame=args.window)
+
+    executor = None
+    workers = args.pose_workers
+    if workers > 0 and args.arch == "pyopenpose":
+        print('pyopenpose does not support pose workers, run inline.')
+        workers = 0
+    if workers > 0:
+        pool = SessionPool(create_pose_estimator, workers)
+        executor = ThreadPoolExecutor(max_workers=workers)
+    pending = deque()
+
+    def classify(frame_index):
+        data = pose_tracker.get_skeleton_sequence()
+        if data is None:
+            return
+        input_data = np.expand_dims(data, 0)
+        if tuple(net.get_input_shape()) != input_data.shape:
+            net.set_input_shape(input_data.shape)
+        output, feature = net.predict({
+            'data': input_data
+        })
+        _, _, _, num_person = data.shape
+        voting_label_name, _, _, _ = postprocess(
+            output[0], feature[0], num_person)
+        print('frame {}: {} ({} person)'.format(
+            frame_index, voting_label_name, num_person))
+
+    def consume(frame_index, pose_keypoints):
+        if pose_keypoints is not None:
+            pose_tracker.update(pose_keypoints, frame_index)
+        if frame_index % args.interval == 0:
+            classify(frame_index)
+
+    frame_index = 0
+    while True:
+        ret, frame = capture.read()
+        if (cv2.waitKey(1) & 0xFF == ord('q')) or not ret:
+            break
+        frame_index += 1
+
+        if executor is None:
+            consume(frame_index, estimate_pose(pose, frame)[1])
+            continue
+
+        # keep at most 2 frames per worker in flight
+        pending.append((
+            frame_index,
+            executor.submit(estimate_pose_pooled, pool, frame)
+        ))
+        while len(pending) > 2 * workers or \
+                (pending and pending[0][1].done()):
+            index, future = pending.popleft()
+            consume(index, future.result())
+
+    while pending:
+        index, future = pending.popleft()
+        consume(index, future.result())
+    if frame_index % args.interval != 0:
+        classify(frame_index)
+
+    if executor is not None:
+        executor.shutdown()
+    capture.release()
+    cv2.destroyAllWindows()
+    print('Script finished successfully.')
+
+
+def main():
+    # model files check and download
+    print("=== ST-GCN model ===")
+    check_and_download_models(WEIGHT_PATH, MODEL_PATH, REMOTE_PATH)
+    print("=== OpenPose model ===")
+    check_and_download_models(
+        WEIGHT_POSE_PATH, MODEL_POSE_PATH, REMOTE_POSE_PATH
+    )
+
+    # net initialize
+    net = ailia.Net(MODEL_PATH, WEIGHT_PATH, env_id=args.env_id)
+
+    if args.stream:
+        # streaming mode
+        pose = None if args.pose_workers > 0 and args.arch != "pyopenpose" \
+            else create_pose_estimator()
+        if args.video is not None:
+            video = args.video
+        elif isinstance(args.input, list):
+            video = args.input[0]
+        else:
+            video = args.input
+        recognize_streaming(video, pose, net)
+        return
+
+    pose = create_pose_estimator()
 
     if args.video is not None:
         # realtime mode
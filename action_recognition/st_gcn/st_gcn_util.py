@@ -57,6 +57,9 @@ class naive_pose_tracker():
                 pad_mode = 'interp' if latest_frame == self.latest_frame else 'zero'
                 pad = current_frame - latest_frame - 1
                 new_trace = self.cat_pose(trace, p, pad, pad_mode)
+                # only the last data_frame poses are used, so the traces
+                # stay bounded on long videos
+                new_trace = new_trace[-self.data_frame:]
                 self.trace_info[matching_trace] = (new_trace, current_frame)
 
             else:
@@ -8,7 +8,6 @@ import pickle
 import numpy as np
 import cv2
 from PIL import Image
-from scipy.spatial.distance import mahalanobis
 from scipy.ndimage import gaussian_filter
 from sklearn.metrics import precision_recall_curve
 from skimage import morphology
@@ -57,11 +56,12 @@ parser.add_argument(
     help='arch model.'
 )
 parser.add_argument(
-    '-f', '--feat', metavar="PICKLE_FILE", default=None,
-    help='train set feature pkl files.'
+    '-f', '--feat', metavar="FEAT_DIR", default=None,
+    help=('train set feature directory (fitted model). '
+          'pkl files of the previous versions are also accepted.')
 )
 parser.add_argument(
-    '-bs', '--batch_size', default=32,
+    '-bs', '--batch_size', default=32, type=int,
     help='batch size.'
 )
 parser.add_argument(
@@ -76,6 +76,21 @@ parser.add_argument(
     '--seed', type=int, default=1024,
     help='random seed'
 )
+parser.add_argument(
+    '--stats', metavar="NPZ_FILE", default=None,
+    help=('save the running train set statistics to this file every '
+          '--stats_interval seconds and at the end, and resume from it if '
+          'it exists.')
+)
+parser.add_argument(
+    '--stats_interval', metavar="SECONDS", type=float, default=600,
+    help='interval of the --stats checkpoints (0: after each batch).'
+)
+parser.add_argument(
+    '--merge_stats', metavar="NPZ_FILE", nargs='+', default=None,
+    help=('fit the distribution from the statistics files computed on '
+          'several machines (by --stats) instead of the train images.')
+)
 parser.add_argument(
     '-th', '--threshold', type=float, default=None,
     help='threshold'
@@ -127,31 +142,48 @@ def postprocess(outputs):
     return embedding_vectors
 
 
-def get_train_outputs(net, create_net, params):
-    if args.feat:
-        logger.info('loading train set feature from: %s' % args.feat)
-        with open(args.feat, 'rb') as f:
-            train_outputs = pickle.load(f)
-        logger.info('loaded.')
-        return train_outputs
+def load_train_stats(path, idx):
+    acc, extra = GaussianAccumulator.load(path)
+    if list(extra['idx']) != list(idx):
+        logger.error(
+            "'%s' was computed with different dimensions (--arch/--seed)" % path)
+        sys.exit(-1)
+    return acc, int(extra['n_files'])
+
+
+def merge_train_stats(paths, idx):
+    acc = None
+    for path in paths:
+        logger.info('merging train set statistics: %s' % path)
+        a, _ = load_train_stats(path, idx)
+        if acc is None:
+            acc = a
+        else:
+            acc.merge(a)
+    return acc
+
 
+def accumulate_train_stats(net, create_net, params, train_imgs):
+    """
+    Accumulate the mean / covariance of the train embeddings batch by batch,
+    so that the memory does not grow with the number of train images.
+    """
     batch_size = args.batch_size
+    idx = params['idx']
 
-    train_dir = args.train_dir
-    train_imgs = sorted([
-        os.path.join(train_dir, f) for f in os.listdir(train_dir)
-        if f.endswith('.png') or f.endswith('.jpg') or f.endswith('.bmp')
-    ])
-    if len(train_imgs) == 0:
-        logger.error("train images not found in '%s'" % train_dir)
-        sys.exit(-1)
+    acc = None
+    start = 0
+    if args.stats and os.path.exists(args.stats):
+        acc, start = load_train_stats(args.stats, idx)
+        logger.info('resume from: %s (%d images)' % (args.stats, start))
 
     logger.info('extract train set features')
 
-    train_outputs = OrderedDict([
-        ('layer1', []), ('layer2', []), ('layer3', [])
-    ])
-    for i in range(0, len(train_imgs), batch_size):
+    # the m2 array is large, the checkpoints are written every
+    # --stats_interval seconds instead of every batch
+    last_save = time.time()
+    n_files = saved_files = start
+    for i in range(start, len(train_imgs), batch_size):
         # prepare input data
         imgs = []
         for image_path in train_imgs[i:i + batch_size]:
@@ -170,39 +202,74 @@ def get_train_outputs(net, create_net, params):
 
         _ = net.predict(imgs)
 
-        for key, name in zip(train_outputs.keys(), params["feat_names"]):
-            train_outputs[key].append(net.get_blob_data(name))
+        train_outputs = OrderedDict([
+            (key, net.get_blob_data(name))
+            for key, name in zip(['layer1', 'layer2', 'layer3'], params["feat_names"])
+        ])
+        embedding_vectors = postprocess(train_outputs)
 
-    logger.info('postprocessing...')
+        # randomly select d dimension
+        embedding_vectors = embedding_vectors[:, idx, :, :]
 
-    for k, v in train_outputs.items():
-        train_outputs[k] = np.vstack(v)
+        B, C, H, W = embedding_vectors.shape
+        embedding_vectors = embedding_vectors.reshape(B, C, H * W)
+        if acc is None:
+            acc = GaussianAccumulator(C, H * W)
+        acc.update(embedding_vectors)
+        n_files = i + len(imgs)
 
-    embedding_vectors = postprocess(train_outputs)
+        if args.stats and time.time() - last_save >= args.stats_interval:
+            acc.save(args.stats, idx=np.asarray(idx), n_files=n_files)
+            last_save = time.time()
+            saved_files = n_files
+
+    if args.stats and n_files > saved_files:
+        acc.save(args.stats, idx=np.asarray(idx), n_files=n_files)
+
+    return acc
+
+
+def get_train_outputs(net, create_net, params):
+    if args.feat:
+        logger.info('loading train set feature from: %s' % args.feat)
+        if os.path.isdir(args.feat):
+            mean, cov_inv, idx = load_fitted_model(args.feat)
+            params['idx'] = list(idx)
+        else:
+            # pickle file of the previous versions: [mean, cov]
+            with open(args.feat, 'rb') as f:
+                mean, cov = pickle.load(f)
+            mean, cov_inv = fit_gaussian(mean, cov)
+        logger.info('loaded.')
+        return mean, cov_inv
 
-    # randomly select d dimension
     idx = params['idx']
-    embedding_vectors = embedding_vectors[:, idx, :, :]
 
-    # calculate multivariate Gaussian distribution
-    B, C, H, W = embedding_vectors.shape
-    embedding_vectors = embedding_vectors.reshape(B, C, H * W)
-    mean = np.mean(embedding_vectors, axis=0)
-    cov = np.zeros((C, C, H * W), dtype=np.float32)
-    I = np.identity(C)
-    for i in range(H * W):
-        cov[:, :, i] = np.cov(embedding_vectors[:, :, i], rowvar=False) + 0.01 * I
+    train_dir = args.train_dir
+    if args.merge_stats:
+        acc = merge_train_stats(args.merge_stats, idx)
+    else:
+        train_imgs = sorted([
+            os.path.join(train_dir, f) for f in os.listdir(train_dir)
+            if f.endswith('.png') or f.endswith('.jpg') or f.endswith('.bmp')
+        ])
+        if len(train_imgs) == 0:
+            logger.error("train images not found in '%s'" % train_dir)
+            sys.exit(-1)
 
-    train_outputs = [mean, cov]
+        acc = accumulate_train_stats(net, create_net, params, train_imgs)
+
+    # calculate multivariate Gaussian distribution
+    mean, cov = acc.finalize()
+    mean, cov_inv = fit_gaussian(mean, cov)
 
     # save learned distribution
-    train_feat_file = "%s.pkl" % os.path.basename(train_dir)
-    logger.info('saving train set feature to: %s ...' % train_feat_file)
-    with open(train_feat_file, 'wb') as f:
-        pickle.dump(train_outputs, f)
+    train_feat_dir = "%s_feat" % os.path.basename(os.path.normpath(train_dir))
+    logger.info('saving train set feature to: %s ...' % train_feat_dir)
+    save_fitted_model(train_feat_dir, mean, cov_inv, idx)
     logger.info('saved.')
 
-    return train_outputs
+    return mean, cov_inv
 
 
 def denormalization(x):
@@ -282,7 +349,8 @@ def recognize_from_image(net, create_net, params):
     idx = random.sample(range(0, params["t_d"]), params["d"])
 
     params["idx"] = idx
-    train_outputs = get_train_outputs(net, create_net, params)
+    mean, cov_inv = get_train_outputs(net, create_net, params)
+    idx = params["idx"]
 
     gt_type_dir = args.gt_dir if args.gt_dir else None
     test_imgs = []
@@ -357,14 +425,8 @@ def recognize_from_image(net, create_net, params):
     # calculate distance matrix
     B, C, H, W = embedding_vectors.shape
     embedding_vectors = embedding_vectors.reshape(B, C, H * W)
-    dist_list = []
-    for i in range(H * W):
-        mean = train_outputs[0][:, i]
-        conv_inv = np.linalg.inv(train_outputs[1][:, :, i])
-        dist = [mahalanobis(sample[:, i], mean, conv_inv) for sample in embedding_vectors]
-        dist_list.append(dist)
-
-    dist_list = np.array(dist_list).transpose(1, 0).reshape(B, H, W)
+    dist_list = mahalanobis_distance(embedding_vectors, mean, cov_inv)
+    dist_list = dist_list.reshape(B, H, W)
 
     # upsample
     score_map = np.asarray([
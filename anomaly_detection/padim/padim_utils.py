@@ -1,7 +1,14 @@
+import os
+
 import numpy as np
 
 __all__ = [
     'embedding_concat',
+    'GaussianAccumulator',
+    'fit_gaussian',
+    'save_fitted_model',
+    'load_fitted_model',
+    'mahalanobis_distance',
 ]
 
 
@@ -39,6 +46,185 @@ def embedding_concat(x, y):
 
     return a
 
+
+class GaussianAccumulator:
+    """
+    Online mean / covariance of the embedding at each position.
+
+    Batches are merged with the parallel variant of Welford's algorithm
+    (Chan et al.), so the memory does not depend on the number of
+    training images. Accumulators computed on several machines can be
+    merged with `merge`, and the state can be saved and resumed.
+
+    Parameters
+    ----------
+    num_features: int
+        C, embedding dimension
+    num_positions: int
+        H*W
+    """
+
+    def __init__(self, num_features, num_positions):
+        self.n = 0
+        self.mean = np.zeros((num_positions, num_features))
+        self.m2 = np.zeros((num_positions, num_features, num_features))
+
+    def _merge(self, n_b, mean_b, m2_b):
+        n_a = self.n
+        n = n_a + n_b
+        delta = mean_b - self.mean
+        self.mean += delta * (n_b / n)
+        self.m2 += m2_b + \
+            delta[:, :, None] * delta[:, None, :] * (n_a * n_b / n)
+        self.n = n
+
+    def update(self, embedding_vectors):
+        """
+        Parameters
+        ----------
+        embedding_vectors: numpy array
+            (B, C, H*W) embedding of a batch
+        """
+        x = np.asarray(embedding_vectors, dtype=np.float64).transpose(2, 0, 1)
+        n_b = x.shape[1]
+        if n_b == 0:
+            return
+        mean_b = x.mean(axis=1)
+        d = x - mean_b[:, None, :]
+        m2_b = np.matmul(d.transpose(0, 2, 1), d)
+        self._merge(n_b, mean_b, m2_b)
+
+    def merge(self, other):
+        if other.n == 0:
+            return
+        self._merge(other.n, other.mean, other.m2)
+
+    def finalize(self, eps=0.01):
+        """
+        Returns
+        -------
+        mean: numpy array
+            (C, H*W)
+        cov: numpy array
+            (C, C, H*W) unbiased covariance + eps * I
+        """
+        if self.n < 2:
+            raise ValueError('at least 2 samples are required')
+        C = self.mean.shape[1]
+        cov = self.m2 / (self.n - 1) + eps * np.identity(C)
+        return self.mean.T, cov.transpose(1, 2, 0)
+
+    def save(self, path, **extra):
+        # write to a temporary file first, so that an interrupted save
+        # does not break the previous checkpoint
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, n=self.n, mean=self.mean, m2=self.m2, **extra)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        acc = cls(data['mean'].shape[1], data['mean'].shape[0])
+        acc.n = int(data['n'])
+        acc.mean[...] = data['mean']
+        acc.m2[...] = data['m2']
+        extra = {k: data[k] for k in data.files if k not in ('n', 'mean', 'm2')}
+        return acc, extra
+
+
+def fit_gaussian(mean, cov):
+    """
+    Precompute the inverse covariance of every position.
+
+    Parameters
+    ----------
+    mean: numpy array
+        (C, H*W) mean of the embedding at each position
+    cov: numpy array
+        (C, C, H*W) covariance of the embedding at each position
+
+    Returns
+    -------
+    mean: numpy array
+        (H*W, C) float32
+    cov_inv: numpy array
+        (H*W, C, C) float32
+    """
+    mean = np.ascontiguousarray(mean.T, dtype=np.float32)
+    cov = np.asarray(cov, dtype=np.float64).transpose(2, 0, 1)
+    cov_inv = np.linalg.inv(cov).astype(np.float32)
+    return mean, cov_inv
+
+
+def save_fitted_model(save_dir, mean, cov_inv, idx):
+    """
+    Save the fitted model as .npy files, which can be memory-mapped.
+
+    Parameters
+    ----------
+    save_dir: str
+        output directory (created if not exists)
+    mean: numpy array
+        (H*W, C)
+    cov_inv: numpy array
+        (H*W, C, C)
+    idx: list of int
+        selected embedding dimensions
+    """
+    os.makedirs(save_dir, exist_ok=True)
+    np.save(os.path.join(save_dir, 'mean.npy'), mean)
+    np.save(os.path.join(save_dir, 'cov_inv.npy'), cov_inv)
+    np.save(os.path.join(save_dir, 'idx.npy'), np.asarray(idx, dtype=np.int64))
+
+
+def load_fitted_model(save_dir):
+    """
+    Load the fitted model saved by `save_fitted_model` without copying.
+
+    Returns
+    -------
+    mean: numpy array (memory-mapped)
+    cov_inv: numpy array (memory-mapped)
+    idx: numpy array
+    """
+    mean = np.load(os.path.join(save_dir, 'mean.npy'), mmap_mode='r')
+    cov_inv = np.load(os.path.join(save_dir, 'cov_inv.npy'), mmap_mode='r')
+    idx = np.load(os.path.join(save_dir, 'idx.npy'))
+    return mean, cov_inv, idx
+
+
+def mahalanobis_distance(embedding_vectors, mean, cov_inv, chunk_size=256):
+    """
+    Mahalanobis distance of all samples at all positions.
+
+    Parameters
+    ----------
+    embedding_vectors: numpy array
+        (B, C, H*W)
+    mean: numpy array
+        (H*W, C)
+    cov_inv: numpy array
+        (H*W, C, C)
+    chunk_size: int
+        number of positions processed at once (bounds the temporary memory)
+
+    Returns
+    -------
+    dist: numpy array
+        (B, H*W)
+    """
+    B, C, N = embedding_vectors.shape
+    x = embedding_vectors.astype(np.float32).transpose(2, 0, 1)  # (H*W, B, C)
+
+    dist = np.empty((N, B), dtype=np.float32)
+    for i in range(0, N, chunk_size):
+        d = x[i:i + chunk_size] - mean[i:i + chunk_size, None, :]
+        t = np.matmul(d, cov_inv[i:i + chunk_size])
+        dist[i:i + chunk_size] = np.einsum('pbc,pbc->pb', t, d)
+
+    return np.sqrt(np.maximum(dist, 0)).T
+
 #
 # def embedding_concat(x, y):
 #     import torch
@@ -1,14 +1,22 @@
+import os
 import sys
 import time
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pyaudio
+import soundfile as sf
 
 import ailia
 # import original moduls
 sys.path.append('../../util')
 from utils import get_base_parser, update_parser, get_savepath  # noqa: E402
 from model_utils import check_and_download_models  # noqa: E402
+from deepspeech2_utils import RingBuffer, StreamResampler, \
+    IncrementalSpectrogram, StreamingCTCDecoder, \
+    ctc_greedy_decode  # noqa: E402
 
 # logger
 from logging import getLogger   # noqa: E402
@@ -53,7 +61,15 @@ CHUNK = 1024
 FORMAT = pyaudio.paInt16
 CHANNELS = 1
 RECODING_SAMPING_RATE = 48000
-THRESHOLD = 0.02
+
+# streaming
+RING_SECONDS = 10
+OUTPUT_STRIDE = 2   # time stride of the convolutions
+LEFT_CONTEXT = 0.5  # committed audio decoded again before the window
+RIGHT_CONTEXT = 1.0  # audio at the end of the window never committed
+
+# batch transcription
+BUCKET_SECONDS = 1.0  # the batches are padded to a multiple of this length
 
 # ======================
 # Arguemnt Parser Config
@@ -86,11 +102,46 @@ parser.add_argument(
     '--ailia_audio', action='store_true',
     help='use ailia audio library'
 )
+parser.add_argument(
+    '--stream_wav', metavar='WAV', default=None,
+    help=('feed the wav file to the streaming recognizer at real-time ' +
+          'pace, as the microphone input (-V)')
+)
+parser.add_argument(
+    '--step', type=float, default=0.25,
+    help='interval of the recognition of the streaming mode in seconds'
+)
+parser.add_argument(
+    '--buckets', type=float, nargs='+', default=[1, 2, 4],
+    help=('lengths of the windows of the streaming mode in seconds, ' +
+          'the last one is the maximum')
+)
+parser.add_argument(
+    '--endpoint', type=float, default=0.8,
+    help='silence in seconds ending an utterance in the streaming mode'
+)
+parser.add_argument(
+    '--batch', action='store_true',
+    help=('batch transcription of the inputs (a directory or --manifest), ' +
+          'sorted by duration. The results are saved to a JSONL file.')
+)
+parser.add_argument(
+    '--manifest', metavar='CSV', default=None,
+    help=('manifest of the batch mode, with lines "wav_path,txt_path" ' +
+          '(the references of the WER/CER report, optional)')
+)
+parser.add_argument(
+    '--batch_size', type=int, default=16,
+    help='number of utterances of a batch'
+)
+parser.add_argument(
+    '--workers', type=int, default=4,
+    help='number of processes of the beam decoder in the batch mode'
+)
 args = update_parser(parser)
 
 if args.ailia_audio:
   import ailia.audio
-  import soundfile as sf
 else:
   import librosa
   import torch
@@ -131,50 +182,6 @@ def create_spectrogram(wav):
     return (spectrogram, spec_length)
 
 
-def record_microphone_input():
-    logger.info('Ready...')
-    time.sleep(1)
-    p = pyaudio.PyAudio()
-
-    stream = p.open(
-        format=FORMAT,
-        channels=CHANNELS,
-        rate=RECODING_SAMPING_RATE,
-        input=True,
-        frames_per_buffer=CHUNK,
-    )
-
-    # time.sleep(1)
-    logger.info("Please speak something")
-
-    frames = []
-    count_uv = 0
-
-    stream.start_stream()
-    while True:
-        data = np.frombuffer(stream.read(CHUNK), dtype=np.int16) / 32768.0
-        if data.max() > THRESHOLD:
-            frames.extend(data)
-            count_uv = 0
-        elif len(frames) > 0:
-            count_uv += 1
-            if count_uv > 48:
-                break
-            frames.extend(data)
-
-    # logger.info("Translating")
-
-    stream.stop_stream()
-    stream.close()
-    p.terminate()
-
-    wav = np.array(frames)
-    if args.ailia_audio:
-        return ailia.audio.resample(wav, RECODING_SAMPING_RATE, SAMPLING_RATE)
-    else:
-        return librosa.resample(wav, RECODING_SAMPING_RATE, SAMPLING_RATE)
-
-
 def decode(sequence, size=None):
     sequence = np.argmax(sequence, -1)
 
@@ -212,38 +219,46 @@ def beam_ctc_decode(sequence, size=None, decoder=None):
     return utterances[0].lower()
 
 
+def create_beam_decoder(num_processes=NUM_PROCESS):
+    try:
+        from ctcdecode import CTCBeamDecoder
+    except ImportError:
+        raise ImportError("BeamCTCDecoder requires paddledecoder package.")
+
+    return CTCBeamDecoder(
+        LABELS,
+        LM_PATH,
+        ALPHA,
+        BETA,
+        CUTOFF_TOP_N,
+        CUTOFF_PROB,
+        BEAM_WIDTH,
+        num_processes,
+        BRANK_LABEL_INDEX,
+    )
+
+
+def load_wav(path):
+    if args.ailia_audio:
+        wav,sr = sf.read(path)
+        wav = ailia.audio.resample(wav,sr,SAMPLING_RATE)
+    else:
+        wav = librosa.load(path, sr=SAMPLING_RATE)[0]
+    return wav
+
+
 # ======================
 # Main functions
 # ======================
 def wavfile_input_recognition():
-    if args.beamdecode:
-        try:
-            from ctcdecode import CTCBeamDecoder
-        except ImportError:
-            raise ImportError("BeamCTCDecoder requires paddledecoder package.")
-
-        decoder = CTCBeamDecoder(
-            LABELS,
-            LM_PATH,
-            ALPHA,
-            BETA,
-            CUTOFF_TOP_N,
-            CUTOFF_PROB,
-            BEAM_WIDTH,
-            NUM_PROCESS,
-            BRANK_LABEL_INDEX,
-        )
+    decoder = create_beam_decoder() if args.beamdecode else None
 
     # net initialize
     net = ailia.Net(MODEL_PATH, WEIGHT_PATH, env_id=args.env_id)
 
     for soundf_path in args.input:
         logger.info(soundf_path)
-        if args.ailia_audio:
-            wav,sr = sf.read(soundf_path)
-            wav = ailia.audio.resample(wav,sr,SAMPLING_RATE)
-        else:
-            wav = librosa.load(soundf_path, sr=SAMPLING_RATE)[0]
+        wav = load_wav(soundf_path)
         spectrogram = create_spectrogram(wav)
         net.set_input_shape(spectrogram[0].shape)
 
@@ -280,49 +295,399 @@ def wavfile_input_recognition():
 # ======================
 # microphone input mode
 # ======================
-def microphone_input_recognition():
-    if args.beamdecode:
-        try:
-            from ctcdecode import CTCBeamDecoder
-        except ImportError:
-            raise ImportError("BeamCTCDecoder requires paddledecoder package.")
-
-        decoder = CTCBeamDecoder(
-            LABELS,
-            LM_PATH,
-            ALPHA,
-            BETA,
-            CUTOFF_TOP_N,
-            CUTOFF_PROB,
-            BEAM_WIDTH,
-            NUM_PROCESS,
-            BRANK_LABEL_INDEX,
-        )
+def window_spectrogram(frames, bucket):
+    """
+    Network input of the (T, F) frames of a window, as create_spectrogram,
+    padded to `bucket` frames.
+    """
+    spectrogram = frames.T
+    spectrogram = spectrogram - spectrogram.mean()
+    spectrogram /= spectrogram.std() + 1e-6
+    # a window of background noise only can go below -1 (NaN)
+    spectrogram = np.log1p(np.maximum(spectrogram, -0.9))
+    spectrogram = np.pad(spectrogram, ((0, 0), (0, bucket - len(frames))))
+    spec_length = np.array(([len(frames)-1]))
 
-    while True:
-        wav = record_microphone_input()
-        spectrogram = create_spectrogram(wav)
+    return (spectrogram[np.newaxis, np.newaxis, :, :], spec_length)
 
-        # net initialize
-        net = ailia.Net(MODEL_PATH, WEIGHT_PATH, env_id=args.env_id)
-        net.set_input_shape(spectrogram[0].shape)
 
-        # inference
-        logger.info('Translating...')
+def streaming_recognition(ring, sample_rate, decoder=None):
+    """
+    Recognize the audio of the ring buffer as it arrives.
+
+    The spectrogram frames are computed once, and every `args.step`
+    seconds the network is run on a window from the last committed frames
+    to the end of the audio, padded to the next length of `args.buckets`.
+    The frames older than the last RIGHT_CONTEXT seconds of a window are
+    committed before the window exceeds the last bucket, and an utterance
+    ends after `args.endpoint` seconds of silence.
+
+    Returns
+    -------
+    list of str
+        transcripts of the utterances
+    """
+    # net initialize
+    net = ailia.Net(MODEL_PATH, WEIGHT_PATH, env_id=args.env_id)
+
+    resampler = StreamResampler(sample_rate, SAMPLING_RATE)
+    spectrogram = IncrementalSpectrogram(WIN_LENGTH, HOP_LENGTH)
+    ctc = StreamingCTCDecoder(LABELS, BRANK_LABEL_INDEX)
+    space_index = LABELS.index(' ')
+
+    def to_frames(sec):
+        frames = sec * SAMPLING_RATE / HOP_LENGTH
+        return int(round(frames / OUTPUT_STRIDE)) * OUTPUT_STRIDE
+
+    buckets = sorted(to_frames(b) for b in args.buckets)
+    max_window = buckets[-1]
+    left, right = to_frames(LEFT_CONTEXT), to_frames(RIGHT_CONTEXT)
+    endpoint = to_frames(args.endpoint) // OUTPUT_STRIDE
+    step_frames = max(to_frames(args.step), OUTPUT_STRIDE)
+    if max_window <= left + right + step_frames:
+        raise ValueError(
+            'the last bucket must be longer than ' +
+            f'{LEFT_CONTEXT + RIGHT_CONTEXT + args.step} seconds')
+
+    # a read returns at most the whole audio ring (the backlog when the
+    # recognition is late), plus the tails of the resampler and of the
+    # spectrogram
+    backlog = ring.capacity / sample_rate + 1
+    frames = RingBuffer(
+        max_window + to_frames(backlog), shape=(WIN_LENGTH // 2 + 1,))
+    utt_start = committed = 0
+    texts = []
+    times = []
+    last_text = ''
+
+    def window_start():
+        return max(utt_start, committed - left)
+
+    def infer(start, end):
+        bucket = next(b for b in buckets if b >= end - start)
+        input_data = window_spectrogram(frames.get(start, end), bucket)
+        if tuple(net.get_input_shape()) != input_data[0].shape:
+            net.set_input_shape(input_data[0].shape)
         # Deep Speech output: output_probability, output_length
-        preds_ailia, output_length = net.predict(spectrogram)
+        preds_ailia, _ = net.predict(input_data)
+        return preds_ailia[0, :-(-(end - start) // OUTPUT_STRIDE)]
 
-        if args.beamdecode:
+    def finalize(probs):
+        if decoder is not None:
+            probs = probs[np.newaxis]
             text = beam_ctc_decode(
-                torch.from_numpy(preds_ailia),
-                torch.from_numpy(output_length),
+                torch.from_numpy(probs),
+                torch.from_numpy(np.array([probs.shape[1]])),
                 decoder,
             )
         else:
-            text = decode(preds_ailia[0], output_length)
+            text = ctc.text.lower()
+        if text.strip():
+            logger.info(f'final: {text}')
+            texts.append(text)
+
+    def recognize(end, final=False):
+        nonlocal utt_start, committed, last_text
+        start = window_start()
+        if end <= start:
+            return
+        probs = infer(start, end)[(committed - start) // OUTPUT_STRIDE:]
+        labels = np.argmax(probs, axis=-1)
+        silent = (labels == BRANK_LABEL_INDEX) | (labels == space_index)
+        speech = np.nonzero(~silent)[0]
+        trailing = len(labels) - (speech[-1] + 1 if len(speech) else 0)
+
+        if len(speech) == 0 and not ctc.text and not final:
+            # no speech yet, keep a short context only
+            utt_start = committed = max(
+                committed, (end - left) // OUTPUT_STRIDE * OUTPUT_STRIDE)
+            return
+
+        if final or trailing >= endpoint:
+            ctc.commit(probs)
+            finalize(ctc.committed_probs())
+            ctc.reset()
+            utt_start = committed = end // OUTPUT_STRIDE * OUTPUT_STRIDE
+            last_text = ''
+            return
+
+        if end - start > max_window - step_frames:
+            # the next window would exceed the last bucket, commit up to
+            # the last blank before the right context
+            cut = max((end - right - committed) // OUTPUT_STRIDE, 0)
+            blank = np.nonzero(labels[:cut] == BRANK_LABEL_INDEX)[0]
+            if len(blank) > 0:
+                cut = blank[-1] + 1
+            ctc.commit(probs[:cut])
+            committed += cut * OUTPUT_STRIDE
+            probs = probs[cut:]
+
+        text = ctc.partial(probs).lower()
+        if text != last_text:
+            logger.info(f'partial: {text}')
+            last_text = text
+
+    step = max(int(args.step * sample_rate), 1)
+    while True:
+        block = ring.read(step)
+        final = block is None
+        block = resampler.flush() if final else resampler(block)
+        frames.write(spectrogram(block))
+
+        # the frames overwritten before they were recognized are skipped
+        lost = frames.written - frames.capacity - window_start()
+        if lost > 0:
+            logger.warning(f'recognition late, {lost} frames dropped')
+            utt_start = committed = \
+                -(-(frames.written - frames.capacity) // OUTPUT_STRIDE) * \
+                OUTPUT_STRIDE
+
+        start_time = time.time()
+        end = frames.written
+        # a window at most every last bucket, when the recognition is late
+        while end - window_start() > max_window:
+            recognize(window_start() + max_window)
+        recognize(end, final)
+        times.append(time.time() - start_time)
+        logger.debug(f'processing time {int(times[-1] * 1000)} ms')
+        if final:
+            break
+
+    logger.info(
+        f'processing time per step: mean {np.mean(times) * 1000:.0f} ms, '
+        f'max {np.max(times) * 1000:.0f} ms')
+    if ring.dropped > 0:
+        logger.warning(f'{ring.dropped} samples dropped')
+    return texts
+
+
+def feed_wav(path, ring):
+    """
+    Write the wav file to the ring buffer at real-time pace, as the
+    microphone does.
+    """
+    wav, sr = sf.read(path, dtype='float32', always_2d=True)
+    wav = wav.mean(axis=1)
+    start = time.time()
+    for i in range(0, len(wav), CHUNK):
+        ring.write(wav[i:i + CHUNK])
+        delay = start + (i + CHUNK) / sr - time.time()
+        if delay > 0:
+            time.sleep(delay)
+    ring.close()
+
+
+def microphone_input_recognition():
+    decoder = create_beam_decoder() if args.beamdecode else None
+
+    if args.stream_wav:
+        sample_rate = sf.info(args.stream_wav).samplerate
+        ring = RingBuffer(int(sample_rate * RING_SECONDS))
+        feeder = threading.Thread(
+            target=feed_wav, args=(args.stream_wav, ring), daemon=True)
+        feeder.start()
+        texts = streaming_recognition(ring, sample_rate, decoder)
+
+        savepath = get_savepath(args.savepath, args.stream_wav, ext='.txt')
+        logger.info(f'Results saved at : {savepath}')
+        with open(savepath, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(texts))
+        logger.info('Script finished successfully.')
+        return
+
+    ring = RingBuffer(int(RECODING_SAMPING_RATE * RING_SECONDS))
+
+    def callback(in_data, frame_count, time_info, status):
+        ring.write(np.frombuffer(in_data, dtype=np.int16) / 32768.0)
+        return (None, pyaudio.paContinue)
+
+    p = pyaudio.PyAudio()
+    stream = p.open(
+        format=FORMAT,
+        channels=CHANNELS,
+        rate=RECODING_SAMPING_RATE,
+        input=True,
+        frames_per_buffer=CHUNK,
+        stream_callback=callback,
+    )
+    logger.info("Please speak something")
+
+    try:
+        stream.start_stream()
+        streaming_recognition(ring, RECODING_SAMPING_RATE, decoder)
+    finally:
+        stream.stop_stream()
+        stream.close()
+        p.terminate()
 
-        logger.info(f'predict sentence:\n{text}\n')
-        time.sleep(1)
+
+# ======================
+# batch transcription mode
+# ======================
+def read_manifest(path):
+    """
+    (wav path, txt path or None) of the lines of a manifest, with the paths
+    relative to the manifest.
+    """
+    root = os.path.dirname(os.path.abspath(path))
+    items = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            paths = [p.strip() for p in line.strip().split(',')]
+            if not paths[0]:
+                continue
+            paths = [os.path.join(root, p) for p in paths if p]
+            items.append((paths[0], paths[1] if len(paths) > 1 else None))
+    return items
+
+
+def read_reference(path):
+    if path is None or not os.path.isfile(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return f.read().strip().lower()
+
+
+def batch_spectrogram(paths):
+    """
+    Network input of the utterances, padded to a multiple of
+    BUCKET_SECONDS.
+    """
+    spectrograms = [create_spectrogram(load_wav(p))[0][0, 0] for p in paths]
+    bucket = int(SAMPLING_RATE * BUCKET_SECONDS / HOP_LENGTH)
+    length = max(s.shape[1] for s in spectrograms)
+    length = -(-length // bucket) * bucket
+
+    batch = np.zeros(
+        (len(paths), 1, spectrograms[0].shape[0], length), dtype=np.float32)
+    for i, spectrogram in enumerate(spectrograms):
+        batch[i, 0, :, :spectrogram.shape[1]] = spectrogram
+    spec_length = np.array([s.shape[1]-1 for s in spectrograms])
+
+    return (batch, spec_length)
+
+
+def beam_ctc_decode_batch(probs, sizes, decoder):
+    out, scores, offsets, seq_len = decoder.decode(
+        torch.from_numpy(probs), torch.from_numpy(sizes))
+
+    texts = []
+    for b, batch in enumerate(out):
+        size = seq_len[b][0]
+        texts.append(''.join(
+            map(lambda x: int_to_char[x.item()], batch[0][0:size])))
+    return texts
+
+
+def report_error_rates(results):
+    """
+    WER and CER of the utterances with a reference, as the evaluation of
+    deepspeech.pytorch (edit distances over the number of words and
+    characters of the references).
+    """
+    results = [r for r in results if r['reference'] is not None]
+    if len(results) == 0:
+        return None
+
+    from decoder import Decoder
+    scorer = Decoder(LABELS, BRANK_LABEL_INDEX)
+    total_wer = total_cer = num_words = num_chars = 0
+    for r in results:
+        total_wer += scorer.wer(r['text'], r['reference'])
+        total_cer += scorer.cer(r['text'], r['reference'])
+        num_words += len(r['reference'].split())
+        num_chars += len(r['reference'].replace(' ', ''))
+
+    wer = 100 * total_wer / max(num_words, 1)
+    cer = 100 * total_cer / max(num_chars, 1)
+    logger.info(
+        f'WER {wer:.2f}% CER {cer:.2f}% ({len(results)} utterances)')
+    return wer, cer
+
+
+def batch_recognition():
+    if args.manifest:
+        items = read_manifest(args.manifest)
+    else:
+        items = [
+            (p, os.path.splitext(p)[0] + '.txt') for p in args.input]
+
+    # the utterances of similar durations are batched together
+    durations = [sf.info(p).duration for p, _ in items]
+    order = np.argsort(durations, kind='stable')
+    batches = [
+        order[i:i + args.batch_size]
+        for i in range(0, len(order), args.batch_size)]
+    logger.info(
+        f'{len(items)} utterances ({sum(durations) / 3600:.2f} hours), ' +
+        f'{len(batches)} batches')
+
+    decoder = create_beam_decoder(args.workers) if args.beamdecode else None
+
+    # net initialize
+    net = ailia.Net(MODEL_PATH, WEIGHT_PATH, env_id=args.env_id)
+
+    savepath = args.savepath
+    if os.path.isdir(savepath):
+        savepath = os.path.join(savepath, 'transcripts.jsonl')
+    elif not savepath.endswith('.jsonl'):
+        savepath = os.path.splitext(savepath)[0] + '.jsonl'
+
+    def load(batch):
+        return batch_spectrogram([items[i][0] for i in batch])
+
+    # the next batch is loaded during the inference
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(load, batches[0]) if batches else None
+
+    results = []
+    start_time = time.time()
+    with open(savepath, 'w', encoding='utf-8') as f:
+        for n, batch in enumerate(batches):
+            input_data = future.result()
+            if n + 1 < len(batches):
+                future = executor.submit(load, batches[n + 1])
+
+            start = int(round(time.time() * 1000))
+            if tuple(net.get_input_shape()) != input_data[0].shape:
+                # the lengths also change with the batch size
+                for blob, data in zip(net.get_input_blob_list(), input_data):
+                    net.set_input_blob_shape(data.shape, blob)
+            # Deep Speech output: output_probability, output_length
+            preds_ailia, output_length = net.predict(input_data)
+
+            if args.beamdecode:
+                texts = beam_ctc_decode_batch(
+                    preds_ailia, output_length, decoder)
+            else:
+                texts = ctc_greedy_decode(
+                    preds_ailia, output_length, LABELS, BRANK_LABEL_INDEX)
+            end = int(round(time.time() * 1000))
+            logger.info(
+                f'batch {n + 1}/{len(batches)} ' +
+                f'{tuple(input_data[0].shape)} : ' +
+                f'processing time {end - start} ms')
+
+            for i, text in zip(batch, texts):
+                path, txt_path = items[i]
+                result = {
+                    'path': path,
+                    'duration': durations[i],
+                    'text': text.lower(),
+                    'reference': read_reference(txt_path),
+                }
+                results.append(result)
+                f.write(json.dumps(result, ensure_ascii=False) + '\n')
+            f.flush()
+    executor.shutdown()
+
+    elapsed = time.time() - start_time
+    logger.info(
+        f'{sum(durations):.1f} seconds of audio in {elapsed:.1f} seconds ' +
+        f'(x{sum(durations) / max(elapsed, 1e-6):.1f} real time)')
+    report_error_rates(results)
+    logger.info(f'Results saved at : {savepath}')
+    logger.info('Script finished successfully.')
 
 
 def main():
@@ -335,12 +700,16 @@ def main():
     check_and_download_models(LM_PATH, LM_PATH, REMOTE_PATH)
 
     # microphone input mode
-    if args.V:
+    if args.V or args.stream_wav:
         try:
             microphone_input_recognition()
         except KeyboardInterrupt:
             logger.info('script finished successfully.')
 
+    # batch transcription mode
+    elif args.batch or args.manifest:
+        batch_recognition()
+
     # sound file input mode
     else:
         wavfile_input_recognition()
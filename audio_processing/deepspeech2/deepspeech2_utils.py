@@ -0,0 +1,300 @@
+import threading
+from math import gcd
+
+import numpy as np
+
+
+# ======================
+# Audio feed
+# ======================
+class RingBuffer:
+    """
+    Last `capacity` rows of a stream, written by a producer thread (the
+    microphone callback) and read by a consumer thread. The unread rows
+    overwritten by the producer are dropped.
+
+    Parameters
+    ----------
+    capacity: int
+    shape: tuple
+        shape of a row
+    dtype: numpy dtype
+    """
+
+    def __init__(self, capacity, shape=(), dtype=np.float32):
+        self.capacity = capacity
+        self.data = np.zeros((capacity,) + tuple(shape), dtype=dtype)
+        self.written = 0
+        self.read_pos = 0
+        self.dropped = 0
+        self.closed = False
+        self._cond = threading.Condition()
+
+    def write(self, rows):
+        rows = np.asarray(rows, dtype=self.data.dtype)
+        with self._cond:
+            n = len(rows)
+            kept = rows[-self.capacity:]
+            index = np.arange(self.written + n - len(kept), self.written + n)
+            self.data[index % self.capacity] = kept
+            self.written += n
+            lost = self.written - self.capacity - self.read_pos
+            if lost > 0:
+                self.dropped += lost
+                self.read_pos += lost
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def read(self, min_rows=1, timeout=None):
+        """
+        All the unread rows, waiting for at least `min_rows` of them.
+
+        Returns
+        -------
+        numpy array or None
+            None once the buffer is closed and all the rows are read
+        """
+        with self._cond:
+            self._cond.wait_for(
+                lambda: self.written - self.read_pos >= min_rows or
+                self.closed, timeout)
+            if self.closed and self.written == self.read_pos:
+                return None
+            rows = self.get(self.read_pos, self.written)
+            self.read_pos = self.written
+            return rows
+
+    def get(self, start, end):
+        """
+        Rows [start, end) of the stream, which must still be in the buffer.
+        """
+        with self._cond:
+            if start < self.written - self.capacity or end > self.written:
+                raise ValueError(
+                    f'rows [{start}, {end}) are not in the buffer')
+            return self.data[np.arange(start, end) % self.capacity]
+
+
+class StreamResampler:
+    """
+    Polyphase resampling of a stream given in blocks of any size, with a
+    windowed sinc filter. Each output sample is computed once, when the
+    input samples of its filter are available.
+
+    Parameters
+    ----------
+    sr_in: int
+    sr_out: int
+    width: int
+        half length of the filter, in samples at the lower rate
+    """
+
+    def __init__(self, sr_in, sr_out, width=16):
+        g = gcd(sr_in, sr_out)
+        self.up, self.down = sr_out // g, sr_in // g
+        r = max(self.up, self.down)
+        self.half = width * r
+        m = np.arange(-self.half, self.half + 1)
+        h = np.sinc(m / r) / r * np.hamming(2 * self.half + 1) * self.up
+        # index -1 for the taps out of the filter
+        self.h = np.concatenate([h, [0.]]).astype(np.float32)
+        self.taps = 2 * self.half // self.up + 1
+
+        # the stream starts with zeros
+        pre = self.half // self.up + 1
+        self.buf = np.zeros(pre, dtype=np.float32)
+        self.buf_start = -pre
+        self.next_out = 0
+
+    def __call__(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        if self.up == self.down:
+            return x
+
+        self.buf = np.concatenate([self.buf, x])
+        total = self.buf_start + len(self.buf)
+        up, down, half = self.up, self.down, self.half
+
+        # outputs whose last input sample is available
+        end = max((total * up - 1 - half) // down + 1, self.next_out)
+        n = np.arange(self.next_out, end)
+        p = n * down
+        k = -((half - p) // up)
+        k = k[:, None] + np.arange(self.taps)
+        m = p[:, None] - k * up
+        m = np.where(np.abs(m) <= half, m + half, -1)
+        # the last tap can be past the buffer, with a zero weight
+        k = np.minimum(k - self.buf_start, len(self.buf) - 1)
+        y = (self.buf[k] * self.h[m]).sum(axis=1)
+
+        self.next_out = end
+        cut = -((half - end * down) // up) - self.buf_start
+        if cut > 0:
+            self.buf = self.buf[cut:]
+            self.buf_start += cut
+        return y.astype(np.float32)
+
+    def flush(self):
+        """
+        Outputs of the last input samples, followed by zeros.
+        """
+        if self.up == self.down:
+            return np.zeros(0, dtype=np.float32)
+        return self(np.zeros(self.half // self.up + 1, dtype=np.float32))
+
+
+# ======================
+# Spectrogram
+# ======================
+class IncrementalSpectrogram:
+    """
+    Frames of `log1p(|stft|)` computed as the samples arrive, as
+    librosa.stft (hamming window, center=True with reflect padding at
+    the start of the stream). The past frames are never recomputed.
+
+    Parameters
+    ----------
+    n_fft: int
+    hop_length: int
+    """
+
+    def __init__(self, n_fft, hop_length):
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        # periodic window, as scipy.signal.get_window
+        self.window = np.hamming(n_fft + 1)[:-1].astype(np.float32)
+        self.buf = np.zeros(0, dtype=np.float32)
+        self.started = False
+
+    def __call__(self, x):
+        """
+        Returns
+        -------
+        numpy array
+            (N, n_fft // 2 + 1) new frames
+        """
+        self.buf = np.concatenate([self.buf, np.asarray(x, np.float32)])
+        pad = self.n_fft // 2
+        if not self.started:
+            if len(self.buf) <= pad:
+                return np.zeros((0, pad + 1), dtype=np.float32)
+            self.buf = np.concatenate([self.buf[pad:0:-1], self.buf])
+            self.started = True
+
+        num = (len(self.buf) - self.n_fft) // self.hop_length + 1
+        if num <= 0:
+            return np.zeros((0, pad + 1), dtype=np.float32)
+        frames = np.lib.stride_tricks.sliding_window_view(
+            self.buf, self.n_fft)[::self.hop_length][:num]
+        spec = np.abs(np.fft.rfft(frames * self.window, axis=1))
+        self.buf = self.buf[num * self.hop_length:]
+        return np.log1p(spec).astype(np.float32)
+
+
+# ======================
+# CTC
+# ======================
+def ctc_collapse(labels, blank=0, prev=None):
+    """
+    Greedy CTC merging of a label sequence: the repeated labels are
+    collapsed and the blanks are removed.
+
+    Parameters
+    ----------
+    labels: numpy array
+        (T,) labels
+    blank: int
+    prev: int
+        last label before the sequence (to merge across two sequences)
+
+    Returns
+    -------
+    numpy array
+        kept labels
+    """
+    prev = blank if prev is None else prev
+    shifted = np.concatenate([[prev], labels[:-1]])
+    return labels[(labels != blank) & (labels != shifted)]
+
+
+def ctc_greedy_decode(probs, sizes, labels, blank=0):
+    """
+    Greedy CTC decoding of a batch: argmax, collapse of the repeated
+    labels and removal of the blanks, for all the utterances at once.
+
+    Parameters
+    ----------
+    probs: numpy array
+        (N, T, C) probabilities
+    sizes: numpy array
+        (N,) valid lengths
+    labels: list of str
+    blank: int
+
+    Returns
+    -------
+    list of str
+    """
+    best = np.argmax(probs, axis=-1)
+    prev = np.concatenate(
+        [np.full((len(best), 1), blank), best[:, :-1]], axis=1)
+    valid = np.arange(best.shape[1])[None, :] < np.asarray(sizes)[:, None]
+    keep = (best != blank) & (best != prev) & valid
+    chars = np.array(labels)[best]
+    return [''.join(c[k]) for c, k in zip(chars, keep)]
+
+
+class StreamingCTCDecoder:
+    """
+    Transcript of an utterance decoded over sliding windows. The labels
+    of the committed frames are final and merged into `text`, the later
+    frames give the partial transcript and are decoded again with the
+    next window. The committed probabilities are kept for the beam
+    decoder.
+
+    Parameters
+    ----------
+    labels: list of str
+    blank: int
+    """
+
+    def __init__(self, labels, blank=0):
+        self.labels = np.array(labels)
+        self.blank = blank
+        self.reset()
+
+    def reset(self):
+        self.text = ''
+        self.last = self.blank
+        self.probs = []
+
+    def _text(self, labels, prev):
+        return ''.join(self.labels[ctc_collapse(labels, self.blank, prev)])
+
+    def commit(self, probs):
+        """
+        Merge the (T, C) probabilities of the committed frames.
+        """
+        if len(probs) == 0:
+            return
+        labels = np.argmax(probs, axis=-1)
+        self.text += self._text(labels, self.last)
+        self.last = labels[-1]
+        self.probs.append(probs)
+
+    def partial(self, probs):
+        """
+        Transcript with the (T, C) probabilities of the uncommitted frames.
+        """
+        if len(probs) == 0:
+            return self.text
+        return self.text + self._text(np.argmax(probs, axis=-1), self.last)
+
+    def committed_probs(self):
+        if len(self.probs) == 0:
+            return np.zeros((0, len(self.labels)), dtype=np.float32)
+        return np.concatenate(self.probs)
@@ -1,6 +1,9 @@
 import time
 import sys
 import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from math import gcd
 
 import numpy as np
 
@@ -11,7 +14,7 @@ import soundfile as sf
 # import original modules
 sys.path.append('../../util')
 from utils import get_base_parser, update_parser, get_savepath  # noqa: E402
-from model_utils import check_and_download_models  # noqa: E402
+from model_utils import check_and_download_models, SessionPool  # noqa: E402
 
 # logger
 from logging import getLogger   # noqa: E402
@@ -56,6 +59,26 @@ parser.add_argument(
     '--ailia_audio', action='store_true',
     help='use ailia audio library'
 )
+parser.add_argument(
+    '--stream', action='store_true',
+    help=('Streaming mode for long audio: separate overlapping chunks of ' +
+          '--chunk seconds, reading and writing the audio incrementally, ' +
+          'in constant memory.')
+)
+parser.add_argument(
+    '--chunk', default=10.0, type=float,
+    help='Length of the chunks in seconds (streaming mode).'
+)
+parser.add_argument(
+    '--overlap', default=1.0, type=float,
+    help=('Overlap of consecutive chunks in seconds, cross-faded in the ' +
+          'output (streaming mode).')
+)
+parser.add_argument(
+    '--workers', default=0, type=int,
+    help=('Number of sessions separating chunks in worker threads ' +
+          '(streaming mode). 0 runs them inline.')
+)
 args = update_parser(parser)
 
 if args.ailia_audio:
@@ -115,32 +138,60 @@ def src_sep(data, session) :
     return sep
 
 
-def recognize_one_audio(input_path):
-    # load audio
-    logger.info('Loading wavfile...')
-    wav, sr = sf.read(input_path)
-    
-    if wav.dtype != np.float32:
-        wav = wav.astype(np.float32)
+def create_session():
+    if not args.onnx :
+        logger.info('Use ailia')
+        env_id = args.env_id
+        logger.info(f'env_id: {env_id}')
+        memory_mode = ailia.get_memory_mode(reuse_interstage=True)
+        session = ailia.Net(MODEL_PATH, WEIGHT_PATH, env_id=env_id, memory_mode=memory_mode)
+    else :
+        logger.info('Use onnxruntime')
+        import onnxruntime
+        session = onnxruntime.InferenceSession(WEIGHT_PATH)
+
+    return session
 
-    if wav.ndim == 2 :
+
+def to_batch(wav):
+    # (samples, channels) to (batch, samples)
+    if wav.ndim == 2 and wav.shape[1] > 1:
         if args.stereo:
             wav = np.transpose(wav,(1,0))   # stereo to batch
         else:
             wav = (wav[:,0][np.newaxis,:] + wav[:,1][np.newaxis,:])/2   # convert to mono
     else:
-        wav = wav[np.newaxis,:]
+        wav = wav.reshape(1,-1)
 
-    calc_time(wav.shape[1], sr)
+    return wav
 
-    # convert sample rate
-    logger.info('Converting sample rate...')
+
+def resample(wav, sr):
     if not sr == DESIRED_SR :
         if args.ailia_audio:
             wav = ailia.audio.resample(wav,sr,DESIRED_SR)
         else:
             wav = signal.resample_poly(wav, DESIRED_SR, sr, axis=1)
 
+    return wav
+
+
+def recognize_one_audio(input_path):
+    # load audio
+    logger.info('Loading wavfile...')
+    wav, sr = sf.read(input_path)
+    
+    if wav.dtype != np.float32:
+        wav = wav.astype(np.float32)
+
+    wav = to_batch(wav)
+
+    calc_time(wav.shape[1], sr)
+
+    # convert sample rate
+    logger.info('Converting sample rate...')
+    wav = resample(wav, sr)
+
     # apply preenphasis filter
     logger.info('Generating input feature...')
     wav = preemphasis(wav)
@@ -148,16 +199,7 @@ def recognize_one_audio(input_path):
     input_feature = tfconvert(wav, WINDOW_LEN, HOP_LEN, MULT)
 
     # create instance
-    if not args.onnx :
-        logger.info('Use ailia')
-        env_id = args.env_id
-        logger.info(f'env_id: {env_id}')
-        memory_mode = ailia.get_memory_mode(reuse_interstage=True)
-        session = ailia.Net(MODEL_PATH, WEIGHT_PATH, env_id=env_id, memory_mode=memory_mode)
-    else :
-        logger.info('Use onnxruntime')
-        import onnxruntime
-        session = onnxruntime.InferenceSession(WEIGHT_PATH)
+    session = create_session()
 
     # inference
     logger.info('Start inference...')
@@ -189,12 +231,148 @@ def recognize_one_audio(input_path):
     logger.info('Script finished successfully.')
 
 
+# ======================
+# Streaming mode
+# ======================
+def separate_chunk(wav, session):
+    """
+    Separate one chunk of `chunk_len` samples at DESIRED_SR. The chunk
+    length gives a whole number of MULT frames, so the input shape of the
+    network is the same for all the chunks.
+    """
+    start = int(round(time.time() * 1000))
+    chunk_len = wav.shape[1]
+    input_feature = tfconvert(preemphasis(wav), WINDOW_LEN, HOP_LEN, MULT)
+    sep = src_sep(input_feature, session)
+    if LPF_CUTOFF > 0 :
+        sep = lowpass(sep, LPF_CUTOFF, DESIRED_SR)
+    sep = inv_preemphasis(sep)
+
+    if sep.shape[1] < chunk_len:
+        sep = np.pad(sep, ((0,0),(0,chunk_len-sep.shape[1])))
+    end = int(round(time.time() * 1000))
+    return sep[:,:chunk_len], end-start
+
+
+def separate_chunk_pooled(pool, wav):
+    with pool.acquire() as session:
+        return separate_chunk(wav, session)
+
+
+def recognize_one_audio_stream(input_path):
+    """
+    Separate overlapping chunks of `args.chunk` seconds and cross-fade
+    them in the output. The input is read and the output is written
+    chunk by chunk, so memory does not grow with the audio length.
+    """
+    f = sf.SoundFile(input_path)
+    sr = f.samplerate
+    calc_time(f.frames, sr)
+
+    # chunk geometry at DESIRED_SR: the chunk hop is a whole number of
+    # samples at both rates, so the resampled chunks are on the same grid
+    g = gcd(DESIRED_SR, sr)
+    up, down = DESIRED_SR // g, sr // g
+    frames = int(np.ceil(args.chunk * DESIRED_SR / HOP_LEN / MULT)) * MULT
+    chunk_len = (frames - 1) * HOP_LEN
+    hop = (chunk_len - int(args.overlap * DESIRED_SR)) // up * up
+    if hop <= 0:
+        raise ValueError(
+            f'overlap ({args.overlap}s) must be shorter than the chunk '
+            f'({chunk_len / DESIRED_SR:.2f}s)')
+    overlap = chunk_len - hop
+    src_hop = hop // up * down
+    src_len = int(np.ceil(chunk_len * down / up))
+
+    # cross-fade of the overlaps, the filter transients at the chunk
+    # edges are in the margins of zero weight
+    margin = overlap // 4
+    ramp = np.clip(
+        (np.arange(overlap) - margin + 1) / (overlap - 2 * margin + 1), 0, 1
+    ).astype(np.float32)
+
+    # the last chunk also ends at least a margin after the audio
+    num_out = int(np.ceil(f.frames * up / down))
+    num_chunks = max(
+        int(np.ceil((num_out + margin - chunk_len) / hop)), 0) + 1
+    logger.info(
+        f'{num_chunks} chunks of {chunk_len / DESIRED_SR:.2f}s '
+        f'(overlap {overlap / DESIRED_SR:.2f}s)')
+
+    def read_chunk(i):
+        f.seek(i * src_hop)
+        wav = f.read(src_len, dtype='float32', always_2d=True)
+        wav = resample(to_batch(wav), sr)
+        if wav.shape[1] < chunk_len:
+            wav = np.pad(wav, ((0,0),(0,chunk_len-wav.shape[1])))
+        return wav[:,:chunk_len].astype(np.float32)
+
+    savepath = get_savepath(args.savepath, input_path)
+    channels = f.channels if args.stereo and f.channels > 1 else 1
+    out = sf.SoundFile(
+        savepath, 'w', samplerate=DESIRED_SR, channels=channels)
+
+    tail = None
+
+    def consume(i, sep, elapsed):
+        nonlocal tail
+        logger.info(
+            f'chunk {i + 1}/{num_chunks} : processing time {elapsed} ms')
+        if tail is not None:
+            sep[:,:overlap] = tail * (1 - ramp) + sep[:,:overlap] * ramp
+        if i < num_chunks - 1:
+            tail = sep[:,hop:]
+            sep = sep[:,:hop]
+        else:
+            sep = sep[:,:num_out - i * hop]
+        out.write(sep.clip(-1.,1.).swapaxes(0,1))
+        out.flush()
+
+    logger.info('Start inference...')
+    executor = None
+    workers = args.workers
+    if workers > 0:
+        pool = SessionPool(create_session, workers)
+        executor = ThreadPoolExecutor(max_workers=workers)
+    else:
+        session = create_session()
+    pending = deque()
+
+    for i in range(num_chunks):
+        wav = read_chunk(i)
+        if executor is None:
+            consume(i, *separate_chunk(wav, session))
+            continue
+
+        # keep at most 2 chunks per worker in flight
+        pending.append((i, executor.submit(separate_chunk_pooled, pool, wav)))
+        while len(pending) > 2 * workers or \
+                (pending and pending[0][1].done()):
+            index, future = pending.popleft()
+            consume(index, *future.result())
+
+    while pending:
+        index, future = pending.popleft()
+        consume(index, *future.result())
+
+    if executor is not None:
+        executor.shutdown()
+    out.close()
+    f.close()
+
+    logger.info(f'saved at : {savepath}')
+    logger.info('Script finished successfully.')
+
+
 def main():
     # model files check and download
     check_and_download_models(WEIGHT_PATH, MODEL_PATH, REMOTE_PATH)
 
     for input_file in args.input:
-        recognize_one_audio(input_file)
+        if args.stream:
+            recognize_one_audio_stream(input_file)
+        else:
+            recognize_one_audio(input_file)
 
 if __name__ == "__main__":
      main()
@@ -0,0 +1,190 @@
+# ailia MODELS benchmark driver
+
+import os
+import re
+import sys
+import json
+import time
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append('./util')
+from utils import get_base_parser, update_parser  # noqa: E402
+from launcher_utils import search_model  # noqa: E402
+from benchmark_utils import stage_stats, summary_rows, write_csv  # noqa: E402
+
+# logger
+from logging import getLogger  # noqa: E402
+logger = getLogger(__name__)
+
+# ======================
+# Arguemnt Parser Config
+# ======================
+parser = get_base_parser('ailia MODELS benchmark', None, None)
+parser.add_argument(
+    '--models', metavar='NAME', nargs='+', default=None,
+    help='model or category names to run (default: all the models)'
+)
+parser.add_argument(
+    '--env_ids', metavar='ENV_ID', nargs='+', type=int, default=None,
+    help='environment ids to run each model on (default: --env_id)'
+)
+parser.add_argument(
+    '-o', '--output', metavar='DIR', default='benchmark_results',
+    help='directory of the results (results.json, results.csv and logs)'
+)
+parser.add_argument(
+    '--timeout', metavar='SEC', type=int, default=600,
+    help='time limit of a model run in seconds'
+)
+parser.add_argument(
+    '-j', '--jobs', metavar='N', type=int, default=1,
+    help=('number of models run in parallel. Models running at the same '
+          'time share the device, so use 1 for regression numbers.')
+)
+args = update_parser(parser, check_input_type=False)
+
+
+# ======================
+# Settings
+# ======================
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# timing line printed by the scripts, only read when a script did not
+# write its benchmark output (ex. it does not use util/utils.update_parser)
+LEGACY_TIME = re.compile(r'processing time (\d+(?:\.\d+)?) ?ms')
+
+
+# ======================
+# Benchmark
+# ======================
+
+def legacy_summary(name, env_id, log):
+    """
+    Fallback summary of the `processing time N ms` lines of a script log.
+    These lines only time the inference, with a millisecond resolution.
+    """
+    samples = [float(t) * 1e6 for t in LEGACY_TIME.findall(log)]
+    samples = samples[args.benchmark_warmup:]
+    if len(samples) == 0:
+        return None
+    stats = stage_stats(samples)
+    return {
+        'name': name,
+        'env_id': env_id,
+        'iterations': len(samples),
+        'warmup': args.benchmark_warmup,
+        'stages': {'inference': stats},
+        'total': stats,
+        'throughput': len(samples) / (sum(samples) / 1e9),
+    }
+
+
+def run_model(model, env_id):
+    name = model['model']
+    model_dir = os.path.join(ROOT, model['category'], name)
+    tag = f'{name}_env{env_id}'
+    json_path = os.path.abspath(os.path.join(args.output, 'raw', tag + '.json'))
+    log_path = os.path.join(args.output, 'logs', tag + '.log')
+    if os.path.exists(json_path):
+        os.remove(json_path)
+
+    cmd = [
+        sys.executable, name + '.py',
+        '--benchmark',
+        '--benchmark_count', str(args.benchmark_count),
+        '--benchmark_warmup', str(args.benchmark_warmup),
+        '--benchmark_output', json_path,
+        '--env_id', str(env_id),
+    ]
+    logger.info(f'run {model["category"]}/{name} (env_id {env_id})')
+
+    start = time.perf_counter_ns()
+    returncode = None
+    try:
+        proc = subprocess.run(
+            cmd, cwd=model_dir, capture_output=True, text=True,
+            timeout=args.timeout)
+        returncode = proc.returncode
+        status = 'ok' if returncode == 0 else 'error'
+        log = proc.stdout + proc.stderr
+    except subprocess.TimeoutExpired as e:
+        status = 'timeout'
+        log = ''.join(
+            s.decode(errors='replace') if isinstance(s, bytes) else s
+            for s in (e.stdout, e.stderr) if s)
+    wall = (time.perf_counter_ns() - start) / 1e9
+
+    with open(log_path, 'w') as f:
+        f.write(' '.join(cmd) + '\n' + log)
+
+    if os.path.exists(json_path):
+        with open(json_path) as f:
+            summary = json.load(f)
+        # stage timings of the script, or its session calls
+        source = 'stages' if summary.get('timing') == 'iterations' \
+            else 'session_calls'
+    else:
+        summary = legacy_summary(name, env_id, log)
+        source = None
+        if summary is not None:
+            source = 'log_fallback'
+            logger.warning(
+                f'\t{tag}: no benchmark output, falling back to the log '
+                '(inference only, 1 ms resolution)')
+
+    logger.info(f'\t{tag}: {status} ({wall:.1f} s)')
+    return {
+        'category': model['category'],
+        'model': name,
+        'env_id': env_id,
+        'status': status,
+        'returncode': returncode,
+        'wall_s': wall,
+        'source': source,
+        'summary': summary,
+    }
+
+
+def result_rows(result):
+    extra = {
+        'category': result['category'], 'model': result['model'],
+        'status': result['status'], 'source': result['source'],
+        'wall_s': result['wall_s'],
+    }
+    if result['summary'] is None:
+        return [dict(extra, name=result['model'], env_id=result['env_id'])]
+    return summary_rows(result['summary'], **extra)
+
+
+def main():
+    model_list, _ = search_model(ROOT)
+    if args.models:
+        model_list = [
+            m for m in model_list
+            if m['model'] in args.models or m['category'] in args.models
+        ]
+    env_ids = args.env_ids if args.env_ids else [args.env_id]
+    tasks = [(m, env_id) for env_id in env_ids for m in model_list]
+    logger.info(f'{len(model_list)} models x {len(env_ids)} environments')
+
+    os.makedirs(os.path.join(args.output, 'raw'), exist_ok=True)
+    os.makedirs(os.path.join(args.output, 'logs'), exist_ok=True)
+
+    with ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as executor:
+        results = list(executor.map(lambda t: run_model(*t), tasks))
+
+    json_path = os.path.join(args.output, 'results.json')
+    with open(json_path, 'w') as f:
+        json.dump(results, f, indent=2)
+    csv_path = os.path.join(args.output, 'results.csv')
+    write_csv(csv_path, [row for r in results for row in result_rows(r)])
+
+    num_ok = sum(r['status'] == 'ok' for r in results)
+    logger.info(f'{num_ok}/{len(results)} runs succeeded')
+    logger.info(f'results saved at : {json_path}, {csv_path}')
+
+
+if __name__ == '__main__':
+    main()
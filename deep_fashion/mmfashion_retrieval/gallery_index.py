@@ -0,0 +1,234 @@
+import os
+import json
+
+import numpy as np
+
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+INDEX_DTYPES = ('float32', 'float16', 'int8')
+
+
+def l2_normalize(x, axis=-1):
+    x = np.asarray(x, dtype=np.float32)
+    norm = np.linalg.norm(x, axis=axis, keepdims=True)
+    return x / np.maximum(norm, 1e-12)
+
+
+class GalleryIndex:
+    """
+    Persistent index of L2-normalized gallery embeddings.
+
+    Vectors are stored in `vectors.npy` (float32, float16 or int8 with a
+    per-vector scale in `scales.npy`) and memory-mapped on load, so a large
+    catalogue opens without reading the whole file. Search is a single
+    matrix product followed by `argpartition`.
+    The arrays are allocated with spare rows, growing geometrically, so
+    that adding the images one by one does not copy the whole index.
+
+    Layout of the index directory:
+        meta.json    dtype, dimension
+        names.txt    gallery filename of each row
+        vectors.npy  (N, D) embeddings
+        scales.npy   (N,) dequantization scales (int8 only)
+        valid.npy    (N,) False for removed rows
+
+    Parameters
+    ----------
+    dim: int
+        embedding dimension (None: set by the first `add`)
+    dtype: str
+        'float32', 'float16' or 'int8'
+    """
+
+    def __init__(self, dim, dtype='float32'):
+        if dtype not in INDEX_DTYPES:
+            raise ValueError(f'unknown index dtype: {dtype}')
+        self.dim = dim
+        self.dtype = dtype
+        self.names = []
+        self._vectors = np.zeros((0, dim or 0), dtype=dtype)
+        self._scales = np.zeros((0,), dtype=np.float32)
+        self._valid = np.zeros((0,), dtype=bool)
+        self._name2row = {}
+
+    @property
+    def vectors(self):
+        return self._vectors[:len(self.names)]
+
+    @property
+    def scales(self):
+        return self._scales[:len(self.names)]
+
+    @property
+    def valid(self):
+        return self._valid[:len(self.names)]
+
+    def __len__(self):
+        return int(self.valid.sum())
+
+    def __contains__(self, name):
+        return name in self._name2row
+
+    # -------------------------------------------------------------------------
+    # update
+    # -------------------------------------------------------------------------
+    def _quantize(self, embeds):
+        embeds = l2_normalize(embeds.reshape(len(embeds), -1))
+        if self.dtype == 'int8':
+            scales = np.abs(embeds).max(axis=1) / 127
+            scales = np.maximum(scales, 1e-12)
+            vectors = np.round(embeds / scales[:, None]).astype(np.int8)
+            return vectors, scales.astype(np.float32)
+        return embeds.astype(self.dtype), np.ones(len(embeds), np.float32)
+
+    def _reserve(self, size):
+        capacity = len(self._valid)
+        if size <= capacity:
+            return
+        capacity = max(size, 2 * capacity, 16)
+        n = len(self.names)
+
+        def grow(a):
+            out = np.zeros((capacity,) + a.shape[1:], dtype=a.dtype)
+            out[:n] = a[:n]
+            return out
+
+        self._vectors = grow(self._vectors)
+        self._scales = grow(self._scales)
+        self._valid = grow(self._valid)
+
+    def add(self, names, embeds):
+        """
+        Add (or replace) embeddings.
+
+        Parameters
+        ----------
+        names: list of str
+        embeds: numpy array
+            (N, D) raw embeddings (normalized here)
+        """
+        if len(names) == 0:
+            return
+        self.remove([name for name in names if name in self._name2row])
+
+        vectors, scales = self._quantize(np.asarray(embeds))
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            self._vectors = np.zeros((0, self.dim), dtype=self.dtype)
+        start = len(self.names)
+        end = start + len(names)
+        self._reserve(end)
+        self._vectors[start:end] = vectors
+        self._scales[start:end] = scales
+        self._valid[start:end] = True
+        for i, name in enumerate(names):
+            self._name2row[name] = start + i
+        self.names.extend(names)
+
+    def remove(self, names):
+        rows = [self._name2row.pop(name) for name in names
+                if name in self._name2row]
+        if rows:
+            if not self._valid.flags.writeable:
+                self._valid = self._valid.copy()
+            self._valid[rows] = False
+
+    def compact(self):
+        """
+        Drop the removed rows.
+        """
+        keep = np.nonzero(self.valid)[0]
+        if len(keep) == len(self.valid):
+            return
+        self._vectors = np.ascontiguousarray(self.vectors[keep])
+        self._scales = self.scales[keep]
+        self._valid = np.ones(len(keep), dtype=bool)
+        self.names = [self.names[i] for i in keep]
+        self._name2row = {name: i for i, name in enumerate(self.names)}
+
+    # -------------------------------------------------------------------------
+    # search
+    # -------------------------------------------------------------------------
+    def search(self, query, k=5, chunk_size=65536):
+        """
+        Top-k cosine similarity search.
+
+        Parameters
+        ----------
+        query: numpy array
+            (D,) or (Q, D) raw query embeddings
+        k: int
+        chunk_size: int
+            number of rows converted to float32 at once
+
+        Returns
+        -------
+        indices: numpy array
+            (Q, k) rows of the best matches (use `names` to get the files)
+        scores: numpy array
+            (Q, k) cosine similarities
+        """
+        if self.dim is None:
+            # empty index
+            query = np.asarray(query)
+            empty = np.zeros((1 if query.ndim == 1 else len(query), 0))
+            return empty.astype(np.int64), empty.astype(np.float32)
+        query = l2_normalize(np.asarray(query).reshape(-1, self.dim))
+        n = len(self.names)
+        k = min(k, len(self))
+
+        scores = np.empty((len(query), n), dtype=np.float32)
+        for start in range(0, n, chunk_size):
+            block = self.vectors[start:start + chunk_size]
+            scores[:, start:start + chunk_size] = \
+                query @ block.astype(np.float32).T
+        if self.dtype == 'int8':
+            scores *= self.scales[None, :]
+        scores[:, ~self.valid] = -np.inf
+
+        if k <= 0:
+            empty = np.zeros((len(query), 0))
+            return empty.astype(np.int64), empty.astype(np.float32)
+
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        return (
+            np.take_along_axis(top, order, axis=1),
+            np.take_along_axis(top_scores, order, axis=1),
+        )
+
+    # -------------------------------------------------------------------------
+    # persistence
+    # -------------------------------------------------------------------------
+    def save(self, index_dir):
+        self.compact()
+        os.makedirs(index_dir, exist_ok=True)
+        with open(os.path.join(index_dir, 'meta.json'), 'w') as f:
+            json.dump({'dim': self.dim, 'dtype': self.dtype}, f)
+        with open(os.path.join(index_dir, 'names.txt'), 'w') as f:
+            for name in self.names:
+                f.write('%s\n' % name)
+        np.save(os.path.join(index_dir, 'vectors.npy'), self.vectors)
+        np.save(os.path.join(index_dir, 'scales.npy'), self.scales)
+        np.save(os.path.join(index_dir, 'valid.npy'), self.valid)
+
+    @classmethod
+    def load(cls, index_dir):
+        with open(os.path.join(index_dir, 'meta.json')) as f:
+            meta = json.load(f)
+        index = cls(meta['dim'], meta['dtype'])
+        with open(os.path.join(index_dir, 'names.txt')) as f:
+            index.names = f.read().splitlines()
+        index._vectors = np.load(
+            os.path.join(index_dir, 'vectors.npy'), mmap_mode='r')
+        index._scales = np.load(os.path.join(index_dir, 'scales.npy'))
+        index._valid = np.load(os.path.join(index_dir, 'valid.npy'))
+        index._name2row = {name: i for i, name in enumerate(index.names)}
+        return index
+
+    @staticmethod
+    def exists(index_dir):
+        return os.path.exists(os.path.join(index_dir, 'meta.json'))
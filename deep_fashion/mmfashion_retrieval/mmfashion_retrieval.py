@@ -7,7 +7,6 @@ import onnxruntime
 import cv2
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.spatial.distance import cosine
 from pathlib import Path
 
 import ailia
@@ -19,6 +18,8 @@ from model_utils import check_and_download_models  # noqa: E402
 from detector_utils import plot_results, load_image  # noqa: E402
 import webcamera_utils  # noqa: E402
 
+from gallery_index import GalleryIndex, INDEX_DTYPES  # noqa: E402
+
 # logger
 from logging import getLogger  # noqa: E402
 
@@ -71,6 +72,28 @@ parser.add_argument(
     default=5, type=int,
     help='Retrieve the top k results'
 )
+parser.add_argument(
+    '--index',
+    default=None, type=str,
+    help=("Directory of the gallery embedding index. It is built on the first run "
+          "and updated with the added / removed gallery images afterwards. "
+          "(default: GALLERY/index)")
+)
+parser.add_argument(
+    '--index_dtype',
+    default='float32', choices=INDEX_DTYPES,
+    help='Storage type of the embeddings in a newly built index'
+)
+parser.add_argument(
+    '--rebuild_index',
+    action='store_true',
+    help='Re-embed the whole gallery even if the index exists'
+)
+parser.add_argument(
+    '-bs', '--batch_size',
+    default=32, type=int,
+    help='Batch size of the gallery embedding extraction'
+)
 args = update_parser(parser)
 if not (args.gallery):
     parser.error('--gallery option is required')
@@ -122,7 +145,7 @@ def recognize_from_image_onnx(filename, ort_session):
 
     #logger.info(f'output shape: {pred.shape}')
 
-def recognize_from_image(filename, net):
+def recognize_from_image(filename, net, index):
     # prepare input data
     img = load_image(filename)
     #logger.info(f'input image shape: {img.shape}')
@@ -142,66 +165,103 @@ def recognize_from_image(filename, net):
         preds_ailia = net.predict(img)
 
     #logger.info(f'output shape: {preds_ailia.shape}')
-    search_gallery(net, preds_ailia, filename)
+    search_gallery(index, preds_ailia, filename)
 
     savepath = get_savepath(args.savepath, filename)
     plt.savefig(savepath, bbox_inches='tight')
     logger.info(f'saved at : {savepath}')
 
-def process_embeds(filenames, model):
+def process_embeds(filenames, model, batch_size=1):
     embeds = []
     logger.info('Exploring the gallery... (it may take a while)')
 
-    for filename in filenames:
+    for i in range(0, len(filenames), batch_size):
         # prepare input data
-        img = load_image(os.path.join(args.gallery, filename)[:-1])
-        img = cv2.cvtColor(img, cv2.COLOR_BGRA2RGB)
-        img = preprocess(img)
+        imgs = []
+        for filename in filenames[i:i + batch_size]:
+            img = load_image(os.path.join(args.gallery, filename))
+            img = cv2.cvtColor(img, cv2.COLOR_BGRA2RGB)
+            imgs.append(preprocess(img))
+        n = len(imgs)
 
-        if len(embeds) % 500 == 0: 
-            print(f"{len(embeds)}/{len(filenames)}")
+        # pad the last batch so that the input shape does not change
+        imgs.extend([np.zeros_like(imgs[0])] * (batch_size - n))
+        imgs = np.concatenate(imgs, axis=0)
 
-        # inference
-        embed = model.predict(img)
-        embeds.append(embed)
-
-    return embeds
-
-def search_gallery(net, pred, filename=None):
-    gallery_idx2im = {}
-    gallery_imgs = open(args.img_file,'r').readlines()
-    for i, img in enumerate(gallery_imgs):
-        gallery_idx2im[i] = img.strip('\n')
-
-    gallery_embeds = process_embeds(gallery_imgs, net)
-
-    show_retrieved_images(pred, gallery_embeds, gallery_idx2im, args.topk, filename)
+        if i % 500 < batch_size:
+            print(f"{i}/{len(filenames)}")
 
-def show_topk_retrieved_images(retrieved_idxes, gallery_idx2im, input_image):
+        # inference
+        if tuple(model.get_input_shape()) != imgs.shape:
+            model.set_input_shape(imgs.shape)
+        embed = model.predict(imgs)
+        embeds.append(embed.reshape(batch_size, -1)[:n])
+
+    return np.concatenate(embeds, axis=0)
+
+def get_gallery_index(net):
+    """
+    Load the gallery index, embedding only the gallery images
+    that are not indexed yet.
+    """
+    gallery_imgs = [
+        img.strip('\n') for img in open(args.img_file, 'r').readlines()
+        if img.strip('\n')
+    ]
+    index_dir = args.index if args.index else os.path.join(args.gallery, 'index')
+
+    if GalleryIndex.exists(index_dir) and not args.rebuild_index:
+        index = GalleryIndex.load(index_dir)
+        logger.info(f'gallery index loaded from : {index_dir}')
+    else:
+        index = None
+
+    gallery_set = set(gallery_imgs)
+    removed = [] if index is None else \
+        [name for name in index.names if name in index and name not in gallery_set]
+    added = [name for name in gallery_imgs if index is None or name not in index]
+
+    if index is None or added or removed:
+        embeds = process_embeds(added, net, args.batch_size) if added else None
+        if index is None:
+            # the dimension is set by the first embeddings
+            index = GalleryIndex(None, args.index_dtype)
+        index.remove(removed)
+        if added:
+            index.add(added, embeds)
+        index.save(index_dir)
+        logger.info(
+            f'gallery index saved at : {index_dir} '
+            f'({len(added)} added, {len(removed)} removed)')
+
+        # restore the input shape of the query
+        net.set_input_shape((1, 3, 224, 224))
+
+    if len(index) == 0:
+        logger.warning('the gallery is empty')
+
+    return index
+
+def search_gallery(index, pred, filename=None):
+    show_retrieved_images(pred, index, args.topk, filename)
+
+def show_topk_retrieved_images(retrieved_names, input_image):
     fig = plt.figure(figsize=(15, 2.5))
     k=1
-    n=len(retrieved_idxes)+1
+    n=len(retrieved_names)+1
     show_img(input_image, fig, 'Input image', n, k)
 
-    for idx in retrieved_idxes:
+    for retrieved_img in retrieved_names:
         k+=1 
-        retrieved_img = gallery_idx2im[idx]
         filename = os.path.join(args.gallery, retrieved_img)
         print(filename)
         show_img(filename, fig, f'Top-{k-1} result', n, k) 
 
-def show_retrieved_images(query_feat, gallery_embeds, gallery_idx2im, topk, filename):
-    query_dist = []
-    for i, feat in enumerate(gallery_embeds):
-        cosine_dist = cosine(
-            feat.reshape(1, -1), query_feat.reshape(1, -1))
-        query_dist.append(cosine_dist)
-
-    query_dist = np.array(query_dist)
-    order = np.argsort(query_dist)
+def show_retrieved_images(query_feat, index, topk, filename):
+    order, _ = index.search(query_feat, topk)
 
     logger.info('Retrieved Top%d Results' % topk)
-    show_topk_retrieved_images(order[:topk], gallery_idx2im, filename)
+    show_topk_retrieved_images([index.names[i] for i in order[0]], filename)
 
 def show_img(filename, fig, title, topk, idx):
     if isinstance(filename, str):
@@ -213,7 +273,7 @@ def show_img(filename, fig, title, topk, idx):
     imgplot = plt.imshow(img)
     ax.set_title(title)
 
-def recognize_from_video(filename, net):
+def recognize_from_video(filename, net, index):
     capture = webcamera_utils.get_capture(args.video)
 
     # create video writer if savepath is specified as video format
@@ -232,7 +292,7 @@ def recognize_from_video(filename, net):
         x = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
         x = preprocess(x)
         preds_ailia = net.predict(x)
-        search_gallery(net, preds_ailia, x[0].transpose(1, 2, 0))
+        search_gallery(index, preds_ailia, x[0].transpose(1, 2, 0))
 
         # save results
         if writer is not None:
@@ -278,9 +338,12 @@ def main():
         # net initialize
         net = ailia.Net(MODEL_PATH, WEIGHT_PATH, env_id=args.env_id)
 
+        # gallery embeddings are computed once and reused across queries
+        index = get_gallery_index(net)
+
         if args.video is not None:
             # video mode
-            recognize_from_video(SAVE_IMAGE_PATH, net)
+            recognize_from_video(SAVE_IMAGE_PATH, net, index)
         else:
             # image mode
             if args.onnx_runtime:
@@ -292,7 +355,7 @@ def main():
             else:
                 # input image loop
                 for image_path in args.input:
-                    recognize_from_image(image_path, net)
+                    recognize_from_image(image_path, net, index)
     logger.info('Script finished successfully.')
 
 if __name__ == '__main__':
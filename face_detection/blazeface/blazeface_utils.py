@@ -5,6 +5,7 @@ import ailia
 import sys
 sys.path.append('../../util')
 from detector_utils import letterbox_convert, reverse_letterbox  # noqa: E402
+import nms_utils  # noqa: E402
 
 
 DEFAULT_MIN_SCORE_THRESH = 0.75
@@ -159,42 +160,10 @@ def weighted_non_max_suppression(detections):
     if len(detections) == 0:
         return []
 
-    output_detections = []
-
-    # Sort the detections from highest to lowest score.
-    # argsort(-x) returns the descending order version of argsort(x)
-    remaining = np.argsort(-detections[:, 16])
-
-    while len(remaining) > 0:
-        detection = detections[remaining[0]]
-
-        # Compute the overlap between the first box and the other 
-        # remaining boxes. (Note that the other_boxes also include
-        # the first_box.)
-        first_box = detection[:4]
-        other_boxes = detections[remaining, :4]
-        ious = overlap_similarity(first_box, other_boxes)
-
-        # If two detections don't overlap enough, they are considered
-        # to be from different faces.
-        mask = ious > min_suppression_threshold
-        overlapping = remaining[mask]
-        remaining = remaining[~mask]
-
-        # Take an average of the coordinates from the overlapping
-        # detections, weighted by their confidence scores.
-        weighted_detection = detection.copy()
-        if len(overlapping) > 1:
-            coordinates = detections[overlapping, :16]
-            scores = detections[overlapping, 16:17]
-            total_score = scores.sum()
-            weighted = (coordinates * scores).sum(axis=0) / total_score
-            weighted_detection[:16] = weighted
-            weighted_detection[16] = total_score / len(overlapping)
-
-        output_detections.append(weighted_detection)
-
-    return output_detections    
+    output_detections = nms_utils.weighted_nms(
+        detections, min_suppression_threshold, score_index=16
+    )
+    return list(output_detections)
 
 
 def postprocess(preds_ailia, anchor_path='anchors.npy', back=False, min_score_thresh = DEFAULT_MIN_SCORE_THRESH):
@@ -1,3 +1,4 @@
+import os
 import sys
 import time
 
@@ -15,6 +16,8 @@ from model_utils import check_and_download_models  # noqa: E402
 from detector_utils import hsv_to_rgb  # noqa: E402
 from nms_utils import nms_between_categories  # noqa: E402
 
+from face_gallery import FaceGallery  # noqa: E402
+
 # logger
 from logging import getLogger   # noqa: E402
 logger = getLogger(__name__)
@@ -81,6 +84,12 @@ parser.add_argument(
     '-ft', '--face_threshold', type=float, default=FACE_THRESHOLD,
     help='Threshold for face detection'
 )
+parser.add_argument(
+    '-g', '--gallery', metavar='NPZ', default=None,
+    help=('Identities of the video mode. '
+          'They are loaded from the file if it exists, '
+          'and saved to it at the end.')
+)
 args = update_parser(parser)
 
 WEIGHT_PATH = args.arch + '.onnx'
@@ -159,119 +168,68 @@ FACE_TRACK_T = 15   # Face buffer size
 FACE_REMOVE_T = 80  # Remove track after this frames
 
 
-class FaceTrack():
-    def __init__(self, id, fe, image, frame_no):
-        self.id = id
-        self.fe = [fe]
-        self.image = [image]
-        self.frame_no = [frame_no]
-        self.score = 0
+# Numbers of faces per inference. Faces are padded to the smallest bucket
+# so that the network is not reshaped on every frame.
+FACE_BATCH_BUCKETS = (1, 4, 8, 16)
 
-    def update(self, fe, image, score, frame_no):
-        self.fe.append(fe)
-        self.image.append(image)
-        self.frame_no.append(frame_no)
-        self.score = score
 
-    def pop(self, frame_no):
-        if len(self.frame_no) > FACE_TRACK_T:
-            self.fe.pop(0)
-            self.image.pop(0)
-            self.frame_no.pop(0)
+def get_bucket_size(n):
+    for size in FACE_BATCH_BUCKETS:
+        if n <= size:
+            return size
+    return FACE_BATCH_BUCKETS[-1]
 
-        if len(self.frame_no) >= 1:
-            if frame_no - self.frame_no[0] >= FACE_REMOVE_T:
-                self.fe.pop(0)
-                self.image.pop(0)
-                self.frame_no.pop(0)
 
+def extract_features(net, faces):
+    """
+    Compute the features of the face images in batches.
 
-def face_identification(tracks, net, detections, frame_no):
-    BATCH_SIZE = net.get_input_shape()[0]
+    Each face is fed with its flipped copy, and the two outputs are
+    concatenated to one feature.
+    """
+    fe = []
+    batch = FACE_BATCH_BUCKETS[-1]
+    for i in range(0, len(faces), batch):
+        chunk = faces[i:i + batch]
+        bucket = get_bucket_size(len(chunk))
 
-    for i in range(len(detections)):
-        resized_frame = detections[i]["resized_frame"]
+        input_data = np.concatenate([
+            preprocess_image(face, input_is_bgr=True) for face in chunk
+        ], axis=0)
+        shape = (2 * bucket,) + input_data.shape[1:]
+        if tuple(net.get_input_shape()) != shape:
+            net.set_input_shape(shape)
 
-        # prepare target face and input face
-        input_frame = preprocess_image(resized_frame, input_is_bgr=True)
-        if BATCH_SIZE == 4:
-            input_data = np.concatenate([input_frame, input_frame], axis=0)
-        else:
-            input_data = input_frame
+        if len(chunk) < bucket:
+            pad = np.zeros(
+                (shape[0] - len(input_data),) + shape[1:], dtype=np.float32
+            )
+            input_data = np.concatenate([input_data, pad], axis=0)
 
-        # inference
         preds_ailia = net.predict(input_data)
+        fe.append(preds_ailia[:2 * len(chunk)].reshape(len(chunk), -1))
+    return np.concatenate(fe, axis=0)
 
-        # postprocessing
-        if BATCH_SIZE == 4:
-            fe_1 = np.concatenate([preds_ailia[0], preds_ailia[1]], axis=0)
-            fe_2 = np.concatenate([preds_ailia[2], preds_ailia[3]], axis=0)
-        else:
-            fe_1 = np.concatenate([preds_ailia[0], preds_ailia[1]], axis=0)
-            fe_2 = fe_1
-
-        detections[i]["fe"] = fe_2
-
-    score_matrix = np.zeros((len(detections), len(tracks)))
-    for i in range(len(detections)):
-        for j in range(len(tracks)):
-            max_sim = 0
-            avg_sim = 0
-            for k in range(len(tracks[j].fe)):
-                sim = cosin_metric(detections[i]["fe"], tracks[j].fe[k])
-                avg_sim = avg_sim + sim
-                if max_sim < sim:
-                    max_sim = sim
-            score_matrix[i, j] = max_sim
-            if len(tracks[j].fe) >= 1:
-                avg_sim = avg_sim / len(tracks[j].fe)
-            score_matrix[i, j] = avg_sim
-
-    for i in range(len(detections)):
-        if len(tracks) == 0:
-            continue
 
-        # search max score between detections and tracks
-        max_score = np.unravel_index(
-            np.argmax(score_matrix), score_matrix.shape
-        )
+def face_identification(gallery, net, detections, frame_no):
+    if len(detections) == 0:
+        gallery.scores[:] = 0
+        gallery.expire(frame_no)
+        return
 
-        det_sim = max_score[0]
-        id_sim = max_score[1]
-        score_sim = score_matrix[det_sim, id_sim]
+    faces = [detection["resized_frame"] for detection in detections]
+    fe = extract_features(net, faces)
 
-        detections[det_sim]["id_sim"] = id_sim
-        detections[det_sim]["score_sim"] = score_sim
+    thumbnails = [
+        cv2.resize(face, (int(IMAGE_WIDTH/4), int(IMAGE_HEIGHT/4)))
+        for face in faces
+    ]
+    ids, scores = gallery.identify(fe, thumbnails, frame_no, args.threshold)
 
-        score_matrix[det_sim, :] = 0
-        score_matrix[:, id_sim] = 0
-
-    for i in range(len(tracks)):
-        tracks[i].score = 0
-
-    for i in range(len(detections)):
-        # identification
-        if detections[i]["score_sim"] < args.threshold:
-            id_sim = len(tracks)
-            fe_obj = FaceTrack(
-                id_sim,
-                detections[i]["fe"],
-                detections[i]["resized_frame"],
-                frame_no
-            )
-            tracks.append(fe_obj)
-            detections[i]["score_sim"] = 0
-            detections[i]["id_sim"] = id_sim
-        else:
-            tracks[detections[i]["id_sim"]].update(
-                detections[i]["fe"],
-                detections[i]["resized_frame"],
-                detections[i]["score_sim"],
-                frame_no
-            )
-
-    for i in range(len(tracks)):
-        tracks[i].pop(frame_no)
+    for i, detection in enumerate(detections):
+        detection["fe"] = fe[i]
+        detection["id_sim"] = ids[i]
+        detection["score_sim"] = scores[i]
 
 
 def get_faces(detector, frame, w, h):
@@ -354,22 +312,23 @@ def display_detections(ui, w, h, detections):
         )
 
 
-def display_tracks(ui, w, h, tracks):
+def display_tracks(ui, w, h, gallery):
     cnt = 0
-    for i in range(len(tracks)):
-        if len(tracks[i].image) <= 0:
+    for i in range(len(gallery)):
+        images = gallery.get_images(i)
+        if len(images) <= 0:
             continue
 
         y0 = int(IMAGE_HEIGHT/4)*(cnt*2+0)
         y1 = int(IMAGE_HEIGHT/4)*(cnt*2+1)
         y2 = int(IMAGE_HEIGHT/4)*(cnt*2+2)
 
-        for j in range(len(tracks[i].image)):
+        for j in range(len(images)):
             x1 = w+int(IMAGE_WIDTH/4)*j
             x2 = w+int(IMAGE_WIDTH/4)*(j+1)
             if x2 > ui.shape[1] or y2 > ui.shape[0]:
                 continue
-            face = tracks[i].image[j]
+            face = images[j]
             face = cv2.resize(
                 face, ((int)(IMAGE_WIDTH/4), (int)(IMAGE_HEIGHT/4))
             )
@@ -384,7 +343,7 @@ def display_tracks(ui, w, h, tracks):
 
         cv2.putText(
             ui,
-            f"ID {i} : {tracks[i].score:5.3f}",
+            f"ID {i} : {gallery.scores[i]:5.3f}",
             text_position,
             cv2.FONT_HERSHEY_SIMPLEX,
             fontScale,
@@ -447,12 +406,19 @@ def compare_images():
 
 
 def compare_video():
-    # prepare base image
-    tracks = []
-
     # net initialize
     net = ailia.Net(MODEL_PATH, WEIGHT_PATH, env_id=args.env_id)
 
+    # identities
+    if args.gallery is not None and os.path.exists(args.gallery):
+        gallery = FaceGallery.load(args.gallery)
+        logger.info(f'{len(gallery)} identities loaded from {args.gallery}')
+    else:
+        gallery = FaceGallery(
+            net.get_output_shape()[1] * 2,
+            bank_size=FACE_TRACK_T, remove_t=FACE_REMOVE_T
+        )
+
     # detector initialize
     if args.face == "blazeface":
         detector = ailia.Net(
@@ -504,14 +470,14 @@ def compare_video():
         detections = get_faces(detector, frame, w, h)
 
         # track face
-        face_identification(tracks, net, detections, frame_no)
+        face_identification(gallery, net, detections, frame_no)
         frame_no = frame_no+1
 
         # display result
         ui[:, :, :] = 0
         ui[0:h, 0:w, :] = frame[:, :, :]
         display_detections(ui, w, h, detections)
-        display_tracks(ui, w, h, tracks)
+        display_tracks(ui, w, h, gallery)
 
         # show
         cv2.imshow('arcface', ui)
@@ -524,6 +490,11 @@ def compare_video():
 
     capture.release()
     cv2.destroyAllWindows()
+
+    if args.gallery is not None:
+        gallery.save(args.gallery)
+        logger.info(f'{len(gallery)} identities saved to {args.gallery}')
+
     logger.info('Script finished successfully.')
 
 
@@ -0,0 +1,256 @@
+import os
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+
+def l2_normalize(x, axis=-1):
+    x = np.asarray(x, dtype=np.float32)
+    norm = np.linalg.norm(x, axis=axis, keepdims=True)
+    return x / np.maximum(norm, 1e-12)
+
+
+class FaceGallery:
+    """
+    Feature banks of the identified faces.
+
+    Each identity keeps the normalized features of its last `bank_size`
+    observations in a row of the `(T, K, D)` array `features`, so that
+    all detections are scored against all identities with one matrix
+    product. The score of an identity is the average cosine similarity
+    over its bank.
+
+    Observations older than `remove_t` frames are dropped from the bank.
+    Identities loaded from a file are enrolled: their features are
+    stored with frame -1 and never expire, until they are overwritten
+    by new observations.
+
+    Parameters
+    ----------
+    dim: int
+        feature dimension
+    bank_size: int
+        number of features kept for each identity
+    remove_t: int
+        drop the features observed this many frames ago
+    capacity: int
+        initial number of identities (grows automatically)
+    """
+
+    ENROLLED = -1
+
+    def __init__(self, dim, bank_size=15, remove_t=80, capacity=16):
+        self.dim = dim
+        self.bank_size = bank_size
+        self.remove_t = remove_t
+
+        self.features = np.zeros((capacity, bank_size, dim), dtype=np.float32)
+        self.frames = np.zeros((capacity, bank_size), dtype=np.int64)
+        self.valid = np.zeros((capacity, bank_size), dtype=bool)
+        self.head = np.zeros(capacity, dtype=np.int64)
+        self.scores = np.zeros(capacity, dtype=np.float32)
+        self.images = [[None] * bank_size for _ in range(capacity)]
+        self.num_ids = 0
+
+    def __len__(self):
+        return self.num_ids
+
+    def _grow(self):
+        capacity = len(self.head)
+        new_capacity = capacity * 2
+
+        def grow(a):
+            out = np.zeros((new_capacity,) + a.shape[1:], dtype=a.dtype)
+            out[:capacity] = a
+            return out
+
+        self.features = grow(self.features)
+        self.frames = grow(self.frames)
+        self.valid = grow(self.valid)
+        self.head = grow(self.head)
+        self.scores = grow(self.scores)
+        self.images.extend(
+            [[None] * self.bank_size for _ in range(new_capacity - capacity)])
+
+    # -------------------------------------------------------------------------
+    # update
+    # -------------------------------------------------------------------------
+    def enroll(self, fe, image, frame_no):
+        """
+        Register a new identity.
+
+        Returns
+        -------
+        int
+            id of the new identity
+        """
+        if self.num_ids == len(self.head):
+            self._grow()
+        id = self.num_ids
+        self.num_ids += 1
+        self.add(id, fe, image, frame_no)
+        return id
+
+    def add(self, id, fe, image, frame_no):
+        """
+        Push an observation to the bank of the identity, replacing the
+        oldest one when the bank is full.
+        """
+        k = self.head[id]
+        self.features[id, k] = l2_normalize(np.ravel(fe))
+        self.frames[id, k] = frame_no
+        self.valid[id, k] = True
+        self.images[id][k] = image
+        self.head[id] = (k + 1) % self.bank_size
+
+    def expire(self, frame_no):
+        """
+        Drop the observations older than `remove_t` frames.
+        """
+        n = self.num_ids
+        frames = self.frames[:n]
+        stale = self.valid[:n] & (frames != self.ENROLLED) & \
+            (frame_no - frames >= self.remove_t)
+        if np.any(stale):
+            self.valid[:n][stale] = False
+            for id, k in zip(*np.nonzero(stale)):
+                self.images[id][k] = None
+
+    # -------------------------------------------------------------------------
+    # identification
+    # -------------------------------------------------------------------------
+    def score_matrix(self, features):
+        """
+        Average cosine similarity between features and identities.
+
+        Parameters
+        ----------
+        features: numpy array
+            (M, D) raw features
+
+        Returns
+        -------
+        numpy array
+            (M, T) similarities, 0 for identities with an empty bank
+        """
+        n = self.num_ids
+        features = l2_normalize(np.reshape(features, (-1, self.dim)))
+        if n == 0 or len(features) == 0:
+            return np.zeros((len(features), n), dtype=np.float32)
+
+        bank = self.features[:n].reshape(-1, self.dim)
+        sim = (features @ bank.T).reshape(len(features), n, self.bank_size)
+        valid = self.valid[:n]
+        count = valid.sum(axis=1)
+        total = np.einsum('mtk,tk->mt', sim, valid)
+        return total / np.maximum(count, 1)
+
+    def identify(self, features, images, frame_no, threshold):
+        """
+        Match the detected faces to the identities, register the
+        unmatched faces as new identities, and update the banks.
+
+        The detections are assigned to the identities by maximizing the
+        total similarity (Hungarian algorithm). Pairs whose similarity is
+        below `threshold` are not allowed, a detection without an allowed
+        pair is left unmatched.
+
+        Parameters
+        ----------
+        features: numpy array
+            (M, D) raw features of the detected faces
+        images: list
+            face image of each detection
+        frame_no: int
+        threshold: float
+
+        Returns
+        -------
+        ids: list of int
+            identity of each detection
+        scores: list of float
+            similarity of each detection (0 for a new identity)
+        """
+        m = len(images)
+        scores = self.score_matrix(features)
+        ids = [-1] * m
+        sims = [0.] * m
+        if scores.size > 0:
+            # one extra column per detection to leave it unmatched, so a
+            # pair below the threshold never takes part in the assignment
+            n = scores.shape[1]
+            cost = np.zeros((m, n + m), dtype=np.float64)
+            cost[:, :n] = np.where(scores >= threshold, -scores, np.inf)
+            rows, cols = linear_sum_assignment(cost)
+            for i, j in zip(rows, cols):
+                if j < n:
+                    ids[i] = int(j)
+                    sims[i] = float(scores[i, j])
+
+        self.scores[:] = 0
+        for i in range(m):
+            if ids[i] < 0:
+                ids[i] = self.enroll(features[i], images[i], frame_no)
+            else:
+                self.add(ids[i], features[i], images[i], frame_no)
+                self.scores[ids[i]] = sims[i]
+
+        self.expire(frame_no)
+        return ids, sims
+
+    def get_images(self, id):
+        """
+        Face images of the identity, oldest first.
+        """
+        k = np.nonzero(self.valid[id])[0]
+        k = k[np.argsort(self.frames[id, k], kind='stable')]
+        return [self.images[id][i] for i in k]
+
+    # -------------------------------------------------------------------------
+    # persistence
+    # -------------------------------------------------------------------------
+    def save(self, path):
+        """
+        Save the identities to a .npz file. The face images must all
+        have the same shape.
+        """
+        n = self.num_ids
+        image_shape = next(
+            (img.shape for row in self.images[:n] for img in row
+             if img is not None), (0, 0, 3))
+        images = np.zeros((n, self.bank_size) + image_shape, dtype=np.uint8)
+        for id in range(n):
+            for k in np.nonzero(self.valid[id])[0]:
+                images[id, k] = self.images[id][k]
+
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        np.savez(
+            path,
+            features=self.features[:n], valid=self.valid[:n],
+            head=self.head[:n], images=images,
+            remove_t=self.remove_t,
+        )
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        features = data['features']
+        n, bank_size, dim = features.shape
+        gallery = cls(
+            dim, bank_size=bank_size, remove_t=int(data['remove_t']),
+            capacity=max(n, 16))
+        gallery.features[:n] = features
+        gallery.valid[:n] = data['valid']
+        gallery.frames[:n] = cls.ENROLLED
+        gallery.head[:n] = data['head']
+        images = data['images']
+        for id, k in zip(*np.nonzero(gallery.valid[:n])):
+            gallery.images[id][k] = images[id, k]
+        gallery.num_ids = n
+        return gallery
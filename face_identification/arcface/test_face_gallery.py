@@ -0,0 +1,36 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from face_gallery import FaceGallery  # noqa: E402
+
+
+def test_identify_gates_pairs_below_threshold():
+    gallery = FaceGallery(3)
+    gallery.enroll([1, 0, 0], None, 0)
+    gallery.enroll([0, 1, 0], None, 0)
+
+    # first face: 0.8 to ID0, 0.5 to ID1. second face: 0.6 to ID0.
+    # Without the gate, (first, ID1) + (second, ID0) has the larger total.
+    features = np.array([
+        [0.8, 0.5, np.sqrt(0.11)],
+        [0.6, 0.0, 0.8],
+    ])
+    ids, sims = gallery.identify(features, [None, None], 1, 0.55)
+
+    assert ids == [0, 2]
+    assert np.isclose(sims[0], 0.8)
+    assert sims[1] == 0.
+    assert len(gallery) == 3
+
+
+def test_identify_below_threshold_enrolls():
+    gallery = FaceGallery(2)
+    gallery.enroll([1, 0], None, 0)
+
+    ids, sims = gallery.identify(np.array([[0, 1]]), [None], 1, 0.5)
+
+    assert ids == [1]
+    assert len(gallery) == 2
@@ -1,6 +1,7 @@
 import sys
 import os
 import re
+import hashlib
 
 import numpy as np
 import cv2
@@ -53,6 +54,18 @@ parser.add_argument(
     action='store_true',
     help='RCalculate using only some images'
 )
+parser.add_argument(
+    '-bs', '--batch_size', type=int, default=16,
+    help='Number of images per inference'
+)
+parser.add_argument(
+    '-c', '--cache', metavar='DIR', default='./feature_cache',
+    help='Directory of the features cached by file hash'
+)
+parser.add_argument(
+    '--no_cache', action='store_true',
+    help='Do not read or write the feature cache'
+)
 args = update_parser(parser)
 
 if args.arch == "vggface2":
@@ -119,18 +132,6 @@ def prepare_input_data(image_path):
         return preprocess_image_arcface(image)
 
 
-def cosin_metric(x1, x2):
-    return np.dot(x1, x2) / (np.linalg.norm(x1) * np.linalg.norm(x2))
-
-
-def l2_metric(feature1, feature2):
-    norm1 = np.sqrt(np.sum(np.abs(feature1**2)))
-    norm2 = np.sqrt(np.sum(np.abs(feature2**2)))
-    dist = feature1/norm1-feature2/norm2
-    l2_norm = np.sqrt(np.sum(np.abs(dist**2)))
-    return l2_norm
-
-
 def get_evaluation_files(input):
     folder_cnt = 0
 
@@ -171,78 +172,112 @@ def get_evaluation_files(input):
     return file_list
 
 
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def extract_features(net, file_list):
+    n = len(file_list)
+    if n == 0:
+        return None
+
+    fe = []
+    for i in range(0, n, args.batch_size):
+        files = file_list[i:i + args.batch_size]
+        for path in files:
+            print("feature extracting "+path)
+        input_data = np.concatenate(
+            [prepare_input_data(path) for path in files], axis=0)
+        if tuple(net.get_input_shape()) != input_data.shape:
+            net.set_input_shape(input_data.shape)
+        preds_ailia = net.predict(input_data)
+        # arcface: the features of the image and its flipped copy are
+        # concatenated
+        fe.append(preds_ailia.reshape(len(files), -1))
+    return np.concatenate(fe, axis=0)
+
+
 def get_feature_values(net, file_list):
-    BATCH_SIZE = net.get_input_shape()[0]
-    fe_list = []
-    for i in range(0, len(file_list)):
-        inputs0 = file_list[i]
-        print("feature extracting "+inputs0)
-        imgs_1 = prepare_input_data(inputs0)
-        if BATCH_SIZE == 4:
-            imgs_1 = np.concatenate([imgs_1, imgs_1], axis=0)
-        preds_ailia1 = net.predict(imgs_1)
-        if args.arch == "vggface2":
-            fe_1 = preds_ailia1[0]
+    """
+    Features of the files, shape (N, D).
+
+    The features are cached in `args.cache` by model and file hash,
+    so only the new or modified images are fed to the net.
+    """
+    if args.no_cache:
+        return extract_features(net, file_list)
+
+    cache_dir = os.path.join(args.cache, args.arch)
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_files = [
+        os.path.join(cache_dir, file_hash(path) + '.npy')
+        for path in file_list
+    ]
+
+    fe_list = [None] * len(file_list)
+    missing = []
+    for i, cache_file in enumerate(cache_files):
+        if os.path.exists(cache_file):
+            fe_list[i] = np.load(cache_file)
         else:
-            fe_1 = np.concatenate([preds_ailia1[0], preds_ailia1[1]], axis=0)
-        fe_list.append(fe_1)
-    return fe_list
-
-
-def compute_similality(heatmap, expect, file_list, fe_list, face_count):
-    for i0 in range(0, face_count):
-        for i1 in range(0, face_count):
-            inputs0 = file_list[i0]
-            inputs1 = file_list[i1]
-
-            # postprocessing
-            fe_1 = fe_list[i0]
-            fe_2 = fe_list[i1]
-            if args.arch == "vggface2":
-                sim = 1.0 - l2_metric(fe_1, fe_2)
-            else:
-                sim = cosin_metric(fe_1, fe_2)
-
-            ex = 0
-            f0 = inputs0.split("/")
-            f1 = inputs1.split("/")
-
-            f0 = f0[len(f0)-2]
-            f1 = f1[len(f1)-2]
-
-            if f0 == f1:
-                ex = 1
-
-            print(f'Similarity of ({inputs0}, {inputs1}) : {sim:.3f}')
-            # if THRESHOLD > sim:
-            #     print('They are not the same face!')
-            # else:
-            #     print('They are the same face!')
-
-            heatmap[i0, i1] = sim
-            expect[i0, i1] = ex
+            missing.append(i)
+    print(f"{len(file_list) - len(missing)} features loaded from cache")
+
+    if missing:
+        fe = extract_features(net, [file_list[i] for i in missing])
+        for i, fe_1 in zip(missing, fe):
+            np.save(cache_files[i], fe_1)
+            fe_list[i] = fe_1
+
+    return np.stack(fe_list)
+
+
+def compute_similality(fe_list, file_list):
+    """
+    Similarity matrix of all pairs and the expected matrix
+    (1 if the two files are in the same folder).
+    """
+    fe = fe_list.reshape(len(fe_list), -1).astype(np.float32)
+    fe = fe / np.maximum(np.linalg.norm(fe, axis=1, keepdims=True), 1e-12)
+    cos = fe @ fe.T
+    if args.arch == "vggface2":
+        # 1 - (l2 distance of the normalized features)
+        heatmap = 1.0 - np.sqrt(np.maximum(2.0 - 2.0 * cos, 0))
+    else:
+        heatmap = cos
+
+    folders = np.array([path.split("/")[-2] for path in file_list])
+    expect = folders[:, None] == folders[None, :]
     return heatmap, expect
 
 
-def decide_threshold(heatmap, expect, face_count):
+def decide_threshold(heatmap, expect, thresholds=THRESHOLDS):
+    """
+    Accuracy of each threshold, from one sort of the similarities.
+
+    A pair is judged to be the same face if threshold <= sim.
+    """
+    sim = heatmap.ravel()
+    same = expect.ravel()
+    order = np.argsort(sim, kind='stable')
+    sim = sim[order]
+    same_below = np.concatenate([[0], np.cumsum(same[order])])
+
+    total = len(sim)
+    num_same = same_below[-1]
+    below = np.searchsorted(sim, thresholds, side='left')
+    # same faces above the threshold + different faces below it
+    success = (num_same - same_below[below]) + \
+        (below - same_below[below])
+
     best_threshold = 0.0
     best_accuracy = 0.0
-    for threshold in THRESHOLDS:
-        success = 0
-        failed = 0
-
-        for i0 in range(0, face_count):
-            for i1 in range(0, face_count):
-                sim = heatmap[i0, i1]
-                ex = expect[i0, i1]
-
-                if (ex == 1 and threshold <= sim) or \
-                   (ex == 0 and threshold > sim):
-                    success = success + 1
-                else:
-                    failed = failed + 1
-
-        accuracy = int(success * 10000 / (success + failed))/100
+    for threshold, n in zip(thresholds, success):
+        accuracy = int(n * 10000 / total)/100
         print("threshold "+str(threshold)+" accuracy "+str(accuracy))
         if best_accuracy < accuracy:
             best_accuracy = accuracy
@@ -251,19 +286,6 @@ def decide_threshold(heatmap, expect, face_count):
     return best_threshold, best_accuracy
 
 
-def compute_final_result(
-        detected, heatmap, expect, face_count, best_threshold
-):
-    for i0 in range(0, face_count):
-        for i1 in range(0, face_count):
-            sim = heatmap[i0, i1]
-
-            if best_threshold <= sim:
-                detected[int(i0), int(i1)] = 1
-            else:
-                detected[int(i0), int(i1)] = 0
-
-
 def display_result(file_list, fe_list):
     fig = plt.figure(figsize=(12.0, 12.0))
 
@@ -275,28 +297,19 @@ def display_result(file_list, fe_list):
     ax2.tick_params(labelleft="on")
     ax3.tick_params(labelleft="on")
 
-    max_cnt = len(file_list)
-
-    x = np.zeros((max_cnt))
-    y = np.zeros((max_cnt))
-
-    heatmap = np.zeros((len(file_list), len(file_list)))
-    expect = np.zeros((len(file_list), len(file_list)))
-    detected = np.zeros((len(file_list), len(file_list)))
-
-    face_count = len(file_list)
-
-    compute_similality(heatmap, expect, file_list, fe_list, face_count)
-    best_threshold, best_accuracy = decide_threshold(
-        heatmap, expect, face_count)
-    compute_final_result(detected, heatmap, expect, face_count, best_threshold)
+    heatmap, expect = compute_similality(fe_list, file_list)
+    best_threshold, best_accuracy = decide_threshold(heatmap, expect)
+    detected = best_threshold <= heatmap
 
     print("best threshold "+str(best_threshold) +
           " best accuracy "+str(best_accuracy))
 
-    ax1.pcolor(expect, cmap=plt.cm.Blues)
-    ax2.pcolor(detected, cmap=plt.cm.Blues)
-    ax3.pcolor(heatmap, cmap=plt.cm.Blues)
+    # imshow instead of pcolor, which is too slow for large datasets
+    for ax, data in ((ax1, expect), (ax2, detected), (ax3, heatmap)):
+        ax.imshow(
+            data.astype(np.float32), cmap=plt.cm.Blues, origin='lower',
+            aspect='auto', interpolation='nearest'
+        )
 
     if False:   # Plot values
         for y in range(heatmap.shape[0]):
@@ -344,6 +357,9 @@ def main():
 
     # get target files
     file_list = get_evaluation_files(args.input)
+    if len(file_list) == 0:
+        print("No image found")
+        return
 
     # net initialize
     net = ailia.Net(MODEL_PATH, WEIGHT_PATH, env_id=args.env_id)
@@ -6,12 +6,15 @@ import numpy as np
 
 import ailia
 import facemesh_utils as fut
+from scipy.special import expit
 
 sys.path.append('../../util')
 from utils import get_base_parser, update_parser, get_savepath  # noqa: E402
 from webcamera_utils import get_capture, get_writer  # noqa: E402
 from image_utils import load_image  # noqa: E402
 from model_utils import check_and_download_models  # noqa: E402
+from roi_tracking_utils import RoiTracker, roi_corners  # noqa: E402
+from mediapipe_utils import LandmarkEstimator  # noqa: E402
 
 # logger
 from logging import getLogger   # noqa: E402
@@ -41,6 +44,16 @@ parser.add_argument(
     help='By default, the optimized model is used, but with this option, ' +
     'you can switch to the normal (not optimized) model'
 )
+parser.add_argument(
+    '--faces', metavar='NUM_FACES', type=int, default=2,
+    help='The maximum number of faces tracked in the video mode'
+)
+parser.add_argument(
+    '--detection_interval', metavar='N', type=int, default=30,
+    help='In the video mode, the faces are tracked from their landmarks, ' +
+    'and the face detector only runs when a face is lost or every N ' +
+    'frames (0: only when a face is lost, 1: every frame)'
+)
 args = update_parser(parser)
 
 
@@ -93,6 +106,8 @@ def recognize_from_image():
     estimator = ailia.Net(
         LANDMARK_MODEL_PATH, LANDMARK_WEIGHT_PATH, env_id=args.env_id
     )
+    # all the faces of an image in one batch
+    estimate_landmarks = LandmarkEstimator(estimator)
 
     # input image loop
     for image_path in args.input:
@@ -119,8 +134,7 @@ def recognize_from_image():
                         src_img[:, :, ::-1], detections, scale, pad
                     )
                     draw_roi(src_img, box)
-                    estimator.set_input_shape(imgs.shape)
-                    landmarks, confidences = estimator.predict([imgs])
+                    landmarks, confidences = estimate_landmarks(imgs)
                     normalized_landmarks = landmarks / 192.0
 
                     # postprocessing
@@ -145,8 +159,7 @@ def recognize_from_image():
                     src_img[:, :, ::-1], detections, scale, pad
                 )
                 draw_roi(src_img, box)
-                estimator.set_input_shape(imgs.shape)
-                landmarks, confidences = estimator.predict([imgs])
+                landmarks, confidences = estimate_landmarks(imgs)
                 normalized_landmarks = landmarks / 192.0
 
                 # postprocessing
@@ -174,6 +187,39 @@ def recognize_from_video():
     estimator = ailia.Net(
         LANDMARK_MODEL_PATH, LANDMARK_WEIGHT_PATH, env_id=args.env_id
     )
+    # the tracked faces in one padded batch of a fixed size, so the input
+    # shape is not changed with the number of faces
+    estimate_landmarks = LandmarkEstimator(estimator, batch_size=args.faces)
+
+    def detect(frame):
+        # Face detection
+        _, img128, scale, pad = fut.resize_pad(frame[:, :, ::-1])
+        input_data = img128.astype('float32') / 127.5 - 1.0
+        input_data = np.expand_dims(np.moveaxis(input_data, -1, 0), 0)
+        preds = detector.predict([input_data])
+        detections = fut.detector_postprocess(preds)
+        if detections[0].size == 0:
+            return np.zeros((0, 4))
+        detections = fut.denormalize_detections(detections[0], scale, pad)
+        return np.stack(fut.detection2roi(detections), axis=1)
+
+    def estimate(frame, rois):
+        # Face landmark estimation
+        xc, yc, scale, theta = rois.T
+        imgs, affines, _ = fut.extract_roi(
+            frame[:, :, ::-1], xc, yc, theta, scale
+        )
+        landmarks, confidences = estimate_landmarks(imgs)
+        landmarks = fut.denormalize_landmarks(landmarks / 192.0, affines)
+        # the confidence is the logit of the face presence
+        scores = expit(confidences.reshape(-1))
+        return landmarks, scores, fut.landmarks2roi(landmarks)
+
+    tracker = RoiTracker(
+        detect, estimate,
+        max_subjects=args.faces,
+        detection_interval=args.detection_interval,
+    )
 
     capture = get_capture(args.video)
 
@@ -190,48 +236,12 @@ def recognize_from_video():
         if (cv2.waitKey(1) & 0xFF == ord('q')) or not ret:
             break
 
-        _, img128, scale, pad = fut.resize_pad(frame[:,:,::-1])
-        input_data = img128.astype('float32') / 127.5 - 1.0
-        input_data = np.expand_dims(np.moveaxis(input_data, -1, 0), 0)
-
         # inference
-        # Face detection
-        preds = detector.predict([input_data])
-        detections = fut.detector_postprocess(preds)
-
-        # Face landmark estimation
-        if detections[0].size != 0:
-            imgs, affines, box = fut.estimator_preprocess(
-                frame[:, :, ::-1], detections, scale, pad
-            )
-            draw_roi(frame, box)
-
-            dynamic_input_shape = False
-
-            if dynamic_input_shape:
-                estimator.set_input_shape(imgs.shape)
-                landmarks, confidences = estimator.predict([imgs])
-                normalized_landmarks = landmarks / 192.0
-                landmarks = fut.denormalize_landmarks(
-                    normalized_landmarks, affines
-                )
-            else:
-                landmarks = np.zeros((imgs.shape[0], 468, 3))
-                confidences = np.zeros((imgs.shape[0], 1))
-                for i in range(imgs.shape[0]):
-                    landmark, confidences[i, :] = estimator.predict(
-                        [imgs[i:i+1, :, :, :]]
-                    )
-                    normalized_landmark = landmark / 192.0
-                    landmarks[i, :, :] = fut.denormalize_landmarks(
-                        normalized_landmark, affines
-                    )
+        landmarks, _, rois = tracker(frame)
 
-            for i in range(len(landmarks)):
-                landmark, confidence = landmarks[i], confidences[i]
-                # if confidence > 0:
-                # Can be > 1, no idea what it represents
-                draw_landmarks(frame, landmark[:, :2], size=1)
+        draw_roi(frame, roi_corners(rois))
+        for landmark in landmarks:
+            draw_landmarks(frame, landmark[:, :2], size=1)
 
         visual_img = frame
         if args.video == '0': # Flip horizontally if camera
@@ -247,8 +257,10 @@ def recognize_from_video():
     if writer is not None:
         writer.release()
     cv2.destroyAllWindows()
-    if writer is not None:
-        writer.release()
+    logger.info(
+        f'face detection ran on {tracker.num_detections}/'
+        f'{tracker.num_frames} frames'
+    )
     logger.info('Script finished successfully.')
 
 
@@ -6,12 +6,15 @@ import numpy as np
 
 import ailia
 import mediapipe_iris_utils as iut
+from scipy.special import expit
 
 sys.path.append('../../util')
 from utils import get_base_parser, update_parser,get_savepath  # noqa: E402
 from webcamera_utils import get_capture, get_writer  # noqa: E402
 from image_utils import load_image  # noqa: E402
 from model_utils import check_and_download_models  # noqa: E402
+from roi_tracking_utils import RoiTracker  # noqa: E402
+from mediapipe_utils import LandmarkEstimator  # noqa: E402
 
 # logger
 from logging import getLogger   # noqa: E402
@@ -39,6 +42,16 @@ parser.add_argument(
     help='By default, the optimized model is used, but with this option, ' +
     'you can switch to the normal (not optimized) model'
 )
+parser.add_argument(
+    '--faces', metavar='NUM_FACES', type=int, default=2,
+    help='The maximum number of faces tracked in the video mode'
+)
+parser.add_argument(
+    '--detection_interval', metavar='N', type=int, default=30,
+    help='In the video mode, the faces are tracked from their landmarks, ' +
+    'and the face detector only runs when a face is lost or every N ' +
+    'frames (0: only when a face is lost, 1: every frame)'
+)
 args = update_parser(parser)
 
 
@@ -127,6 +140,9 @@ def recognize_from_image():
     estimator2 = ailia.Net(
         LANDMARK2_MODEL_PATH, LANDMARK2_WEIGHT_PATH, env_id=args.env_id
     )
+    # all the faces (eyes) of an image in one batch
+    estimate_landmarks = LandmarkEstimator(estimator)
+    estimate_iris = LandmarkEstimator(estimator2)
 
     # prepare input data
     # input image loop
@@ -153,13 +169,11 @@ def recognize_from_image():
                     imgs, affines, box = iut.estimator_preprocess(
                         src_img[:, :, ::-1], detections, scale, pad
                     )
-                    estimator.set_input_shape(imgs.shape)
-                    landmarks, confidences = estimator.predict([imgs])
+                    landmarks, confidences = estimate_landmarks(imgs)
 
                     # Iris landmark estimation
                     imgs2, origins = iut.iris_preprocess(imgs, landmarks)
-                    estimator2.set_input_shape(imgs2.shape)
-                    eyes, iris = estimator2.predict([imgs2])
+                    eyes, iris = estimate_iris(imgs2)
 
                     eyes, iris = iut.iris_postprocess(
                         eyes, iris, origins, affines
@@ -183,13 +197,11 @@ def recognize_from_image():
                 imgs, affines, box = iut.estimator_preprocess(
                     src_img[:, :, ::-1], detections, scale, pad
                 )
-                estimator.set_input_shape(imgs.shape)
-                landmarks, confidences = estimator.predict([imgs])
+                landmarks, confidences = estimate_landmarks(imgs)
 
                 # Iris landmark estimation
                 imgs2, origins = iut.iris_preprocess(imgs, landmarks)
-                estimator2.set_input_shape(imgs2.shape)
-                eyes, iris = estimator2.predict([imgs2])
+                eyes, iris = estimate_iris(imgs2)
 
                 eyes, iris = iut.iris_postprocess(eyes, iris, origins, affines)
                 for i in range(len(eyes)):
@@ -214,6 +226,49 @@ def recognize_from_video():
     estimator2 = ailia.Net(
         LANDMARK2_MODEL_PATH, LANDMARK2_WEIGHT_PATH, env_id=args.env_id
     )
+    # the tracked faces (and their two eyes) in padded batches of a fixed
+    # size, so the input shapes are not changed with the number of faces
+    estimate_landmarks = LandmarkEstimator(estimator, batch_size=args.faces)
+    estimate_iris = LandmarkEstimator(estimator2, batch_size=2 * args.faces)
+
+    def detect(frame):
+        # Face detection
+        _, img128, scale, pad = iut.resize_pad(frame[:, :, ::-1])
+        input_data = img128.astype('float32') / 127.5 - 1.0
+        input_data = np.expand_dims(np.moveaxis(input_data, -1, 0), 0)
+        preds = detector.predict([input_data])
+        detections = iut.detector_postprocess(preds)
+        if detections[0].size == 0:
+            return np.zeros((0, 4))
+        detections = iut.denormalize_detections(detections[0], scale, pad)
+        return np.stack(iut.detection2roi(detections), axis=1)
+
+    def estimate(frame, rois):
+        # Face landmark estimation
+        xc, yc, scale, theta = rois.T
+        imgs, affines, _ = iut.extract_roi(
+            frame[:, :, ::-1], xc, yc, theta, scale
+        )
+        landmarks, confidences = estimate_landmarks(imgs)
+
+        # Iris landmark estimation
+        imgs2, origins = iut.iris_preprocess(imgs, landmarks)
+        eyes, iris = estimate_iris(imgs2)
+        eyes, iris = iut.iris_postprocess(eyes, iris, origins, affines)
+
+        face_landmarks = iut.denormalize_landmarks(
+            landmarks / iut.resolution, affines
+        )
+        # the confidence is the logit of the face presence
+        scores = expit(confidences.reshape(-1))
+        results = list(zip(eyes, iris))
+        return results, scores, iut.landmarks2roi(face_landmarks)
+
+    tracker = RoiTracker(
+        detect, estimate,
+        max_subjects=args.faces,
+        detection_interval=args.detection_interval,
+    )
 
     capture = get_capture(args.video)
 
@@ -230,53 +285,11 @@ def recognize_from_video():
         if (cv2.waitKey(1) & 0xFF == ord('q')) or not ret:
             break
 
-        _, img128, scale, pad = iut.resize_pad(frame[:,:,::-1])
-        input_data = img128.astype('float32') / 127.5 - 1.0
-        input_data = np.expand_dims(np.moveaxis(input_data, -1, 0), 0)
-
         # inference
-        # Face detection
-        preds = detector.predict([input_data])
-        detections = iut.detector_postprocess(preds)
+        results, _, _ = tracker(frame)
 
-        # Face landmark estimation
-        if detections[0].size != 0:
-            imgs, affines, box = iut.estimator_preprocess(
-                frame[:, :, ::-1], detections, scale, pad
-            )
-
-            dynamic_shape = False
-
-            if dynamic_shape:
-                estimator.set_input_shape(imgs.shape)
-                landmarks, confidences = estimator.predict([imgs])
-            else:
-                landmarks = np.zeros((imgs.shape[0], 1404))
-                confidences = np.zeros((imgs.shape[0], 1))
-                for i in range(imgs.shape[0]):
-                    landmarks[i, :], confidences[i, :] = estimator.predict(
-                        [imgs[i:i+1, :, :, :]]
-                    )
-
-            # Iris landmark estimation
-            imgs2, origins = iut.iris_preprocess(imgs, landmarks)
-
-            if dynamic_shape:
-                estimator2.set_input_shape(imgs2.shape)
-                eyes, iris = estimator2.predict([imgs2])
-            else:
-                eyes = np.zeros((imgs2.shape[0], 213))
-                iris = np.zeros((imgs2.shape[0], 15))
-                for i in range(imgs2.shape[0]):
-                    eyes[i, :], iris[i, :] = estimator2.predict(
-                        [imgs2[i:i+1, :, :, :]]
-                    )
-
-            eyes, iris = iut.iris_postprocess(eyes, iris, origins, affines)
-            for i in range(len(eyes)):
-                draw_eye_iris(
-                    frame, eyes[i, :, :16, :2], iris[i, :, :, :2], size=1
-                )
+        for eyes, iris in results:
+            draw_eye_iris(frame, eyes[:, :16, :2], iris[:, :, :2], size=1)
 
         visual_img = frame
         if args.video == '0': # Flip horizontally if camera
@@ -292,8 +305,11 @@ def recognize_from_video():
     if writer is not None:
         writer.release()
     cv2.destroyAllWindows()
+    logger.info(
+        f'face detection ran on {tracker.num_detections}/'
+        f'{tracker.num_frames} frames'
+    )
     logger.info('Script finished successfully.')
-    pass
 
 
 def main():
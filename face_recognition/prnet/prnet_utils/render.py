@@ -82,6 +82,112 @@ def get_point_weight(point, tri_points):
     return w0, w1, w2
 
 
+def get_barycentric(x, y, tri_points):
+    ''' Barycentric coordinates of points in triangles (vectorized get_point_weight)
+    Args:
+        x, y: ntri or ntri x npoint. coordinates of the points
+        tri_points: 2 coords x 3 vertices x ntri
+    Returns:
+        u: weight of v2
+        v: weight of v1
+    '''
+    shape = (2, -1) + (1,) * (np.ndim(x) - 1)
+    p0 = tri_points[:, 0].reshape(shape)
+    v0 = (tri_points[:, 2] - tri_points[:, 0]).reshape(shape)
+    v1 = (tri_points[:, 1] - tri_points[:, 0]).reshape(shape)
+    v2x = x - p0[0]
+    v2y = y - p0[1]
+
+    # dot products
+    dot00 = v0[0]*v0[0] + v0[1]*v0[1]
+    dot01 = v0[0]*v1[0] + v0[1]*v1[1]
+    dot11 = v1[0]*v1[0] + v1[1]*v1[1]
+    dot02 = v0[0]*v2x + v0[1]*v2y
+    dot12 = v1[0]*v2x + v1[1]*v2y
+
+    # barycentric coordinates (0 for degenerated triangles, as isPointInTri)
+    deno = dot00*dot11 - dot01*dot01
+    inverDeno = np.divide(1., deno, out=np.zeros_like(deno), where=deno != 0)
+
+    u = (dot11*dot02 - dot01*dot12)*inverDeno
+    v = (dot00*dot12 - dot01*dot02)*inverDeno
+    return u, v
+
+
+def rasterize_triangles(vertices, triangles, h, w, inside_test=True, block_size=1 << 20):
+    ''' z-buffer rasterization of a mesh
+    The triangles are grouped by the size of their inner bounding box, so that
+    the pixels of a group form a (ntri x npixel) grid. The barycentric test is
+    computed on blocks of at most `block_size` pixels, and each block is merged
+    into the buffers by keeping the deepest triangle of each pixel (the first
+    triangle on ties, as the sequential z-buffer).
+    Args:
+        vertices: 3 x nver
+        triangles: 3 x ntri
+        h: height
+        w: width
+        inside_test: if False, the whole inner bounding box of each triangle
+            is drawn (as get_depth_buffer)
+        block_size: maximum number of (triangle, pixel) pairs in a block
+    Returns:
+        depth_buffer: height x width. -999999. for the pixels without triangle
+        triangle_buffer: height x width. the triangle index of each pixel, -1 for no triangle
+    '''
+    vertices = np.asarray(vertices, dtype=np.float64)
+    depth_buffer = np.zeros(h * w) - 999999.
+    triangle_buffer = np.zeros(h * w, dtype=np.int32) - 1
+
+    # triangle depth: approximate the depth to the average value of z in each vertex(v0, v1, v2)
+    tri_depth = (vertices[2, triangles[0,:]] + vertices[2,triangles[1,:]] + vertices[2, triangles[2,:]])/3.
+    tri_points = vertices[:2][:, triangles] # 2 x 3 x ntri
+
+    # the inner bounding box
+    umin = np.maximum(np.ceil(tri_points[0].min(axis=0)), 0).astype(np.int64)
+    umax = np.minimum(np.floor(tri_points[0].max(axis=0)), w-1).astype(np.int64)
+    vmin = np.maximum(np.ceil(tri_points[1].min(axis=0)), 0).astype(np.int64)
+    vmax = np.minimum(np.floor(tri_points[1].max(axis=0)), h-1).astype(np.int64)
+
+    valid = np.nonzero((umax >= umin) & (vmax >= vmin))[0]
+    sizes = np.stack([umax[valid] - umin[valid] + 1, vmax[valid] - vmin[valid] + 1], axis=1)
+    if len(valid) == 0:
+        return depth_buffer.reshape(h, w), triangle_buffer.reshape(h, w)
+    sizes, group = np.unique(sizes, axis=0, return_inverse=True)
+    group = group.ravel()
+
+    for g, (bw, bh) in enumerate(sizes):
+        du, dv = np.meshgrid(np.arange(bw), np.arange(bh))
+        du, dv = du.ravel(), dv.ravel()
+        members = valid[group == g]
+        step = max(block_size // len(du), 1)
+        for start in range(0, len(members), step):
+            tri = members[start:start + step]
+            u = umin[tri, None] + du
+            v = vmin[tri, None] + dv
+            inside = np.ones(u.shape, dtype=bool)
+            if inside_test:
+                bu, bv = get_barycentric(u, v, tri_points[:, :, tri])
+                inside = (bu >= 0) & (bv >= 0) & (bu + bv < 1)
+
+            pix = (v * w + u)[inside]
+            tri = np.broadcast_to(tri[:, None], inside.shape)[inside]
+            depth = tri_depth[tri]
+
+            # deepest (then first) triangle of each pixel in the block
+            order = np.lexsort((tri, -depth, pix))
+            pix, tri, depth = pix[order], tri[order], depth[order]
+            first = np.ones(len(pix), dtype=bool)
+            first[1:] = pix[1:] != pix[:-1]
+            pix, tri, depth = pix[first], tri[first], depth[first]
+
+            # scatter into the buffers
+            update = (depth > depth_buffer[pix]) | \
+                ((depth == depth_buffer[pix]) & (tri < triangle_buffer[pix]))
+            depth_buffer[pix[update]] = depth[update]
+            triangle_buffer[pix[update]] = tri[update]
+
+    return depth_buffer.reshape(h, w), triangle_buffer.reshape(h, w)
+
+
 def render_texture(vertices, colors, triangles, h, w, c = 3):
     ''' render mesh by z buffer
     Args:
@@ -94,29 +200,12 @@ def render_texture(vertices, colors, triangles, h, w, c = 3):
     # initial 
     image = np.zeros((h, w, c))
 
-    depth_buffer = np.zeros([h, w]) - 999999.
-    # triangle depth: approximate the depth to the average value of z in each vertex(v0, v1, v2), since the vertices are closed to each other
-    tri_depth = (vertices[2, triangles[0,:]] + vertices[2,triangles[1,:]] + vertices[2, triangles[2,:]])/3. 
+    # triangle color: the average color of the vertices
     tri_tex = (colors[:, triangles[0,:]] + colors[:,triangles[1,:]] + colors[:, triangles[2,:]])/3.
 
-    for i in range(triangles.shape[1]):
-        tri = triangles[:, i] # 3 vertex indices
-
-        # the inner bounding box
-        umin = max(int(np.ceil(np.min(vertices[0,tri]))), 0)
-        umax = min(int(np.floor(np.max(vertices[0,tri]))), w-1)
-
-        vmin = max(int(np.ceil(np.min(vertices[1,tri]))), 0)
-        vmax = min(int(np.floor(np.max(vertices[1,tri]))), h-1)
-
-        if umax<umin or vmax<vmin:
-            continue
-
-        for u in range(umin, umax+1):
-            for v in range(vmin, vmax+1):
-                if tri_depth[i] > depth_buffer[v, u] and isPointInTri([u,v], vertices[:2, tri]): 
-                    depth_buffer[v, u] = tri_depth[i]
-                    image[v, u, :] = tri_tex[:, i]
+    _, triangle_buffer = rasterize_triangles(vertices, triangles, h, w)
+    mask = triangle_buffer >= 0
+    image[mask] = tri_tex[:, triangle_buffer[mask]].T
     return image
 
 
@@ -132,6 +221,7 @@ def map_texture(src_image, src_vertices, dst_vertices, dst_triangle_buffer, tria
         # dst
         dst_vertices: 3 x nver
         dst_triangle_buffer: height x width. the triangle index of each pixel in dst image
+            (rasterized from dst_vertices if None)
 
     Returns:
         dst_image: height x width x nchannels
@@ -139,50 +229,44 @@ def map_texture(src_image, src_vertices, dst_vertices, dst_triangle_buffer, tria
     '''
     [sh, sw, sc] = src_image.shape
     dst_image = np.zeros((h, w, c))
-    for y in range(h):
-        for x in range(w):
-            tri_ind = dst_triangle_buffer[y,x]
-            if tri_ind < 0: # no tri in dst image
-                continue 
-            #if src_triangles_vis[tri_ind]: # the corresponding triangle in src image is invisible
-            #   continue
-            
-            # then. For this triangle index, map corresponding pixels(in triangles) in src image to dst image
-            # Two Methods:
-            # M1. Calculate the corresponding affine matrix from src triangle to dst triangle. Then find the corresponding src position of this dst pixel.
-            # -- ToDo
-            # M2. Calculate the relative position of three vertices in dst triangle, then find the corresponding src position relative to three src vertices.
-            tri = triangles[:, tri_ind]
-            # dst weight, here directly use the center to approximate because the tri is small
-            # if tri_ind < 366:
-                # print tri_ind
-            w0, w1, w2 = get_point_weight([x, y], dst_vertices[:2, tri])
-            # else:
-            #     w0 = w1 = w2 = 1./3
-            # src
-            src_texel = w0*src_vertices[:2, tri[0]] + w1*src_vertices[:2, tri[1]] + w2*src_vertices[:2, tri[2]] #
-# 
-            if src_texel[0] < 0 or src_texel[0]> sw-1 or src_texel[1]<0 or src_texel[1] > sh-1:
-                dst_image[y, x, :] = 0
-                continue
-            # As the coordinates of the transformed pixel in the image will most likely not lie on a texel, we have to choose how to
-            # calculate the pixel colors depending on the next texels
-            # there are three different texture interpolation methods: area, bilinear and nearest neighbour
-            # print y, x, src_texel
-            # nearest neighbour 
-            if mapping_type == 'nearest':
-                dst_image[y, x, :] = src_image[int(round(src_texel[1])), int(round(src_texel[0])), :]
-            # bilinear
-            elif mapping_type == 'bilinear':
-                # next 4 pixels
-                ul = src_image[int(np.floor(src_texel[1])), int(np.floor(src_texel[0])), :]
-                ur = src_image[int(np.floor(src_texel[1])), int(np.ceil(src_texel[0])), :]
-                dl = src_image[int(np.ceil(src_texel[1])), int(np.floor(src_texel[0])), :]
-                dr = src_image[int(np.ceil(src_texel[1])), int(np.ceil(src_texel[0])), :]
-
-                yd = src_texel[1] - np.floor(src_texel[1])
-                xd = src_texel[0] - np.floor(src_texel[0])
-                dst_image[y, x, :] = ul*(1-xd)*(1-yd) + ur*xd*(1-yd) + dl*(1-xd)*yd + dr*xd*yd
+    if dst_triangle_buffer is None:
+        _, dst_triangle_buffer = rasterize_triangles(dst_vertices, triangles, h, w)
+
+    # pixels with a triangle in dst image
+    y, x = np.nonzero(dst_triangle_buffer >= 0)
+    tri = triangles[:, dst_triangle_buffer[y, x]]
+
+    # Calculate the relative position of the pixel in the dst triangle, then
+    # find the corresponding src position relative to three src vertices.
+    u, v = get_barycentric(x, y, dst_vertices[:2][:, tri])
+    w0, w1, w2 = 1 - u - v, v, u
+    src_texel = w0*src_vertices[:2, tri[0]] + w1*src_vertices[:2, tri[1]] + w2*src_vertices[:2, tri[2]]
+
+    inside = (src_texel[0] >= 0) & (src_texel[0] <= sw-1) & (src_texel[1] >= 0) & (src_texel[1] <= sh-1)
+    y, x, src_texel = y[inside], x[inside], src_texel[:, inside]
+
+    # As the coordinates of the transformed pixel in the image will most likely not lie on a texel, we have to choose how to
+    # calculate the pixel colors depending on the next texels
+    # nearest neighbour 
+    if mapping_type == 'nearest':
+        sy = np.round(src_texel[1]).astype(np.int64)
+        sx = np.round(src_texel[0]).astype(np.int64)
+        dst_image[y, x, :] = src_image[sy, sx, :]
+    # bilinear
+    elif mapping_type == 'bilinear':
+        # next 4 pixels
+        y0 = np.floor(src_texel[1]).astype(np.int64)
+        x0 = np.floor(src_texel[0]).astype(np.int64)
+        y1 = np.ceil(src_texel[1]).astype(np.int64)
+        x1 = np.ceil(src_texel[0]).astype(np.int64)
+        ul = src_image[y0, x0, :]
+        ur = src_image[y0, x1, :]
+        dl = src_image[y1, x0, :]
+        dr = src_image[y1, x1, :]
+
+        yd = (src_texel[1] - y0)[:, np.newaxis]
+        xd = (src_texel[0] - x0)[:, np.newaxis]
+        dst_image[y, x, :] = ul*(1-xd)*(1-yd) + ur*xd*(1-yd) + dl*(1-xd)*yd + dr*xd*yd
                 
     return dst_image
 
@@ -201,38 +285,10 @@ def get_depth_buffer(vertices, triangles, h, w):
         m3. like somewhere is wrong
     # Each triangle has 3 vertices & Each vertex has 3 coordinates x, y, z.
     # Here, the bigger the z, the fronter the point.
+    # The depth of a triangle is the average z of its vertices, drawn on its
+    # whole inner bounding box.
     '''
-    # initial 
-    depth_buffer = np.zeros([h, w]) - 999999. #+ np.min(vertices[2,:]) - 999999. # set the initial z to the farest position
-
-    ## calculate the depth(z) of each triangle
-    #-m1. z = the center of shpere(through 3 vertices)
-    #center3d = (vertices[:, triangles[0,:]] + vertices[:,triangles[1,:]] + vertices[:, triangles[2,:]])/3.
-    #tri_depth = np.sum(center3d**2, axis = 0)
-    #-m2. z = the center of z(v0, v1, v2)
-    tri_depth = (vertices[2, triangles[0,:]] + vertices[2,triangles[1,:]] + vertices[2, triangles[2,:]])/3.
-    
-    for i in range(triangles.shape[1]):
-        tri = triangles[:, i] # 3 vertex indices
-
-        # the inner bounding box
-        umin = max(int(np.ceil(np.min(vertices[0,tri]))), 0)
-        umax = min(int(np.floor(np.max(vertices[0,tri]))), w-1)
-
-        vmin = max(int(np.ceil(np.min(vertices[1,tri]))), 0)
-        vmax = min(int(np.floor(np.max(vertices[1,tri]))), h-1)
-
-        if umax<umin or vmax<vmin:
-            continue
-
-        for u in range(umin, umax+1):
-            for v in range(vmin, vmax+1):
-                #-m3. calculate the accurate depth(z) of each pixel by barycentric weights
-                #w0, w1, w2 = weightsOfpoint([u,v], vertices[:2, tri])
-                #tri_depth = w0*vertices[2,tri[0]] + w1*vertices[2,tri[1]] + w2*vertices[2,tri[2]]
-                if tri_depth[i] > depth_buffer[v, u]: # and is_pointIntri([u,v], vertices[:2, tri]): 
-                    depth_buffer[v, u] = tri_depth[i]
-
+    depth_buffer, _ = rasterize_triangles(vertices, triangles, h, w, inside_test=False)
     return depth_buffer
 
 
@@ -244,46 +300,11 @@ def get_triangle_buffer(vertices, triangles, h, w):
         h: height
         w: width
     Returns:
-        depth_buffer: height x width
-    ToDo:
-        whether to add x, y by 0.5? the center of the pixel?
-        m3. like somewhere is wrong
+        triangle_buffer: height x width. -1 for the pixels without triangle
     # Each triangle has 3 vertices & Each vertex has 3 coordinates x, y, z.
     # Here, the bigger the z, the fronter the point.
     '''
-    # initial 
-    depth_buffer = np.zeros([h, w]) - 999999. #+ np.min(vertices[2,:]) - 999999. # set the initial z to the farest position
-    triangle_buffer = np.zeros_like(depth_buffer, dtype = np.int32) - 1 # if -1, the pixel has no triangle correspondance
-
-    ## calculate the depth(z) of each triangle
-    #-m1. z = the center of shpere(through 3 vertices)
-    #center3d = (vertices[:, triangles[0,:]] + vertices[:,triangles[1,:]] + vertices[:, triangles[2,:]])/3.
-    #tri_depth = np.sum(center3d**2, axis = 0)
-    #-m2. z = the center of z(v0, v1, v2)
-    tri_depth = (vertices[2, triangles[0,:]] + vertices[2,triangles[1,:]] + vertices[2, triangles[2,:]])/3.
-    
-    for i in range(triangles.shape[1]):
-        tri = triangles[:, i] # 3 vertex indices
-
-        # the inner bounding box
-        umin = max(int(np.ceil(np.min(vertices[0,tri]))), 0)
-        umax = min(int(np.floor(np.max(vertices[0,tri]))), w-1)
-
-        vmin = max(int(np.ceil(np.min(vertices[1,tri]))), 0)
-        vmax = min(int(np.floor(np.max(vertices[1,tri]))), h-1)
-
-        if umax<umin or vmax<vmin:
-            continue
-
-        for u in range(umin, umax+1):
-            for v in range(vmin, vmax+1):
-                #-m3. calculate the accurate depth(z) of each pixel by barycentric weights
-                #w0, w1, w2 = weightsOfpoint([u,v], vertices[:2, tri])
-                #tri_depth = w0*vertices[2,tri[0]] + w1*vertices[2,tri[1]] + w2*vertices[2,tri[2]]
-                if tri_depth[i] > depth_buffer[v, u] and isPointInTri([u,v], vertices[:2, tri]): 
-                    depth_buffer[v, u] = tri_depth[i]
-                    triangle_buffer[v, u] = i
-
+    _, triangle_buffer = rasterize_triangles(vertices, triangles, h, w)
     return triangle_buffer
 
 
@@ -296,47 +317,37 @@ def vis_of_vertices(vertices, triangles, h, w, depth_buffer = None):
     Returns:
         vertices_vis: nver. the visibility of each vertex
     '''
-    if depth_buffer == None:
+    if depth_buffer is None:
         depth_buffer = get_depth_buffer(vertices, triangles, h, w)
 
     vertices_vis = np.zeros(vertices.shape[1], dtype = bool)
-    
-    depth_tmp = np.zeros_like(depth_buffer) - 99999
-    for i in range(vertices.shape[1]):
-        vertex = vertices[:, i]
 
-        if np.floor(vertex[0]) < 0 or np.ceil(vertex[0]) > w-1 or np.floor(vertex[1]) < 0 or np.ceil(vertex[1]) > h-1:
-            continue        
-        
-        # bilinear interp 
-        # ul = depth_buffer[int(np.floor(vertex[1])), int(np.floor(vertex[0]))]
-        # ur = depth_buffer[int(np.floor(vertex[1])), int(np.ceil(vertex[0]))]
-        # dl = depth_buffer[int(np.ceil(vertex[1])), int(np.floor(vertex[0]))]
-        # dr = depth_buffer[int(np.ceil(vertex[1])), int(np.ceil(vertex[0]))]
-        
-        # yd = vertex[1] - np.floor(vertex[1])
-        # xd = vertex[0] - np.floor(vertex[0])
-
-        # vertex_depth = ul*(1-xd)*(1-yd) + ur*xd*(1-yd) + dl*(1-xd)*yd + dr*xd*yd
-        
-        # nearest
-        px = int(np.round(vertex[0]))
-        py = int(np.round(vertex[1]))
-
-        # if (vertex[2] > depth_buffer[ul[0], ul[1]]) & (vertex[2] > depth_buffer[ur[0], ur[1]]) & (vertex[2] > depth_buffer[dl[0], dl[1]]) & (vertex[2] > depth_buffer[dr[0], dr[1]]):
-        if vertex[2] < depth_tmp[py, px]:
-            continue
-        
-        # if vertex[2] > depth_buffer[py, px]:
-        #     vertices_vis[i] = True
-        #     depth_tmp[py, px] = vertex[2]
-        # elif np.abs(vertex[2] - depth_buffer[py, px]) < 1:
-        #     vertices_vis[i] = True
-
-        threshold = 2 # need to be optimized.
-        if np.abs(vertex[2] - depth_buffer[py, px]) < threshold:
-        # if np.abs(vertex[2] - vertex_depth) < threshold:
-            vertices_vis[i] = True
-            depth_tmp[py, px] = vertex[2]
+    # vertices inside the image
+    x, y, z = vertices[0], vertices[1], vertices[2]
+    inside = (np.floor(x) >= 0) & (np.ceil(x) <= w-1) & (np.floor(y) >= 0) & (np.ceil(y) <= h-1)
+    ind = np.nonzero(inside)[0]
+
+    # nearest
+    px = np.round(x[ind]).astype(np.int64)
+    py = np.round(y[ind]).astype(np.int64)
+
+    # close to the depth buffer
+    threshold = 2 # need to be optimized.
+    close = (np.abs(z[ind] - depth_buffer[py, px]) < threshold) & (z[ind] >= -99999)
+    ind, pix = ind[close], (py * w + px)[close]
+
+    # A vertex is visible unless a previous visible vertex of the same pixel is
+    # fronter: compare the z rank with the running maximum of each pixel.
+    order = np.argsort(pix, kind='stable')
+    ind, pix = ind[order], pix[order]
+    _, rank = np.unique(z[ind], return_inverse=True)
+    rank = rank.ravel()
+    start = np.ones(len(pix), dtype=bool)
+    start[1:] = pix[1:] != pix[:-1]
+    key = (np.cumsum(start) - 1) * (len(ind) + 1) + rank
+    prev = np.maximum.accumulate(key)
+    visible = start.copy()
+    visible[1:] |= key[1:] >= prev[:-1]
+    vertices_vis[ind[visible]] = True
 
     return vertices_vis
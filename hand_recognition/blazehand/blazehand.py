@@ -12,6 +12,7 @@ from utils import get_base_parser, update_parser, get_savepath  # noqa: E402
 from webcamera_utils import get_capture, get_writer  # noqa: E402
 from image_utils import load_image  # noqa: E402
 from model_utils import check_and_download_models  # noqa: E402
+from mediapipe_utils import LandmarkEstimator  # noqa: E402
 
 # logger
 from logging import getLogger   # noqa: E402
@@ -91,6 +92,8 @@ def recognize_from_image():
     estimator = ailia.Net(
         LANDMARK_MODEL_PATH, LANDMARK_WEIGHT_PATH, env_id=args.env_id
     )
+    # all the hands of an image in one batch
+    estimate_landmarks = LandmarkEstimator(estimator)
 
     # input image loop
     for image_path in args.input:
@@ -109,17 +112,16 @@ def recognize_from_image():
         presence = [0, 0]  # [left, right]
         if detections[0].size != 0:
             imgs, affines, _ = but.estimator_preprocess(src_img, detections[0], scale, pad)
-            estimator.set_input_shape(imgs.shape)
 
             if args.benchmark:
                 logger.info('BENCHMARK mode')
                 for _ in range(5):
                     start = int(round(time.time() * 1000))
-                    flags, handedness, normed_landmarks = estimator.predict([imgs])
+                    flags, handedness, normed_landmarks = estimate_landmarks(imgs)
                     end = int(round(time.time() * 1000))
                     logger.info(f'\tailia processing time {end - start} ms')
             else:
-                flags, handedness, normed_landmarks = estimator.predict([imgs])
+                flags, handedness, normed_landmarks = estimate_landmarks(imgs)
 
             # postprocessing
             landmarks = but.denormalize_landmarks(
@@ -154,6 +156,9 @@ def recognize_from_video():
     detector = ailia.Net(DETECTION_MODEL_PATH, DETECTION_WEIGHT_PATH, env_id=args.env_id)
     estimator = ailia.Net(LANDMARK_MODEL_PATH, LANDMARK_WEIGHT_PATH, env_id=args.env_id)
     num_hands = args.hands
+    # the hands in one padded batch of a fixed size, so the input shape is
+    # not changed with the number of hands
+    estimate_landmarks = LandmarkEstimator(estimator, batch_size=num_hands)
     thresh = 0.5
     tracking = False
     tracked_hands = np.array([0.0] * num_hands)
@@ -190,17 +195,13 @@ def recognize_from_video():
                 tracking = True
                 roi_imgs, affines, _ = but.estimator_preprocess(frame, detections[0][:num_hands], scale, pad)
         else:
-            for i, roi in enumerate(rois):
-                xc, yc, scale, theta = roi
-                roi_img, affine, _ = but.extract_roi(frame, xc, yc, theta, scale)
-                roi_imgs[i] = roi_img[0]
-                affines[i] = affine[0]
+            xc, yc, scale, theta = np.array(rois).T
+            roi_imgs, affines, _ = but.extract_roi(frame, xc, yc, theta, scale)
 
         # Hand landmark estimation
         presence = [0, 0] # [left, right]
         if tracking:
-            estimator.set_input_shape(roi_imgs.shape)
-            hand_flags, handedness, normalized_landmarks = estimator.predict([roi_imgs])
+            hand_flags, handedness, normalized_landmarks = estimate_landmarks(roi_imgs)
 
             # postprocessing
             landmarks = but.denormalize_landmarks(normalized_landmarks, affines)
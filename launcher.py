@@ -1,6 +1,5 @@
 # ailia MODELS launcher
 
-import os
 import cv2
 import numpy
 import subprocess
@@ -9,6 +8,7 @@ import sys
 
 sys.path.append('./util')
 from utils import get_base_parser, update_parser  # noqa: E402
+from launcher_utils import search_model  # noqa: E402
 
 # ======================
 # Arguemnt Parser Config
@@ -27,59 +27,6 @@ BUTTON_MARGIN = 2
 
 WINDOW_ROW = 34
 
-# ======================
-# Model search
-# ======================
-
-IGNORE_LIST = [
-    "commercial_model", "validation", ".git", "log", "prnet", "bert",
-    "illustration2vec", "etl", "vggface2", "anomaly_detection"
-]
-
-try:
-    import transformers
-except ModuleNotFoundError:
-    IGNORE_LIST.append("neural_language_processing")
-    pass
-
-try:
-    import torchaudio
-except ModuleNotFoundError:
-    IGNORE_LIST.append("audio_processing")
-    pass
-
-def search_model():
-    file_list = []
-    for current, subfolders, subfiles in os.walk("./"):
-        file_list.append(current)
-
-    file_list.sort()
-
-    model_list = []
-    category_list = {}
-    model_exist = {}
-    for current in file_list:
-        current = current.replace("\\", "/")
-        files = current.split("/")
-        if len(files) == 3:
-            if (files[1] in IGNORE_LIST) or (files[2] in IGNORE_LIST):
-                continue
-            if files[2] in model_exist:
-                continue
-            script = "./"+files[1]+"/"+files[2]+"/"+files[2]+".py"
-            if os.path.exists(script):
-                if not(files[1] in category_list):
-                    category_list[files[1]] = len(category_list)
-                category_id = category_list[files[1]]
-                model_list.append({
-                    "category": files[1],
-                    "category_id": category_id,
-                    "model": files[2],
-                })
-                model_exist[files[2]] = True
-    return model_list, len(category_list)
-
-
 # ======================
 # Model List
 # ======================
@@ -10,7 +10,7 @@ import ailia
 # import original modules
 sys.path.append('../../util')
 from utils import get_base_parser, update_parser, get_savepath  # noqa: E402
-from model_utils import check_and_download_models  # noqa: E402
+from model_utils import check_and_download_models, get_session  # noqa: E402
 from detector_utils import plot_results, write_predictions, load_image  # noqa: E402
 import webcamera_utils  # noqa: E402
 
@@ -82,10 +82,9 @@ args = update_parser(parser)
 
 
 # ======================
-# Main functions
+# Utils
 # ======================
-def recognize_from_image():
-    # net initialize
+def create_detector():
     detector = ailia.Detector(
         MODEL_PATH,
         WEIGHT_PATH,
@@ -100,6 +99,24 @@ def recognize_from_image():
         detector.set_input_shape(
             args.detection_width, args.detection_height
         )
+    return detector
+
+
+def init_detector():
+    # warm detector shared through the process-wide session cache
+    return get_session(
+        WEIGHT_PATH, MODEL_PATH, args.env_id,
+        input_shape=(args.detection_height, args.detection_width),
+        factory=create_detector, kind='detector',
+    )
+
+
+# ======================
+# Main functions
+# ======================
+def recognize_from_image():
+    # net initialize
+    detector = init_detector()
     if args.profile:
         detector.set_profile_mode(True)
 
@@ -145,20 +162,7 @@ def recognize_from_image():
 
 def recognize_from_video():
     # net initialize
-    detector = ailia.Detector(
-        MODEL_PATH,
-        WEIGHT_PATH,
-        len(COCO_CATEGORY),
-        format=ailia.NETWORK_IMAGE_FORMAT_RGB,
-        channel=ailia.NETWORK_IMAGE_CHANNEL_FIRST,
-        range=ailia.NETWORK_IMAGE_RANGE_U_FP32,
-        algorithm=ailia.DETECTOR_ALGORITHM_YOLOV3,
-        env_id=args.env_id,
-    )
-    if args.detection_width != DETECTION_SIZE or args.detection_height != DETECTION_SIZE:
-        detector.set_input_shape(
-            args.detection_width, args.detection_height
-        )
+    detector = init_detector()
 
     capture = webcamera_utils.get_capture(args.video)
 
@@ -170,31 +174,33 @@ def recognize_from_video():
     else:
         writer = None
 
+    frame_count = 0
     if args.write_prediction:
-        frame_count = 0
         frame_digit = int(math.log10(capture.get(cv2.CAP_PROP_FRAME_COUNT)) + 1)
         video_name = os.path.splitext(os.path.basename(args.video))[0]
 
-    while(True):
-        ret, frame = capture.read()
-        if (cv2.waitKey(1) & 0xFF == ord('q')) or not ret:
-            break
-
+    def predict(frame):
         img = cv2.cvtColor(frame, cv2.COLOR_BGR2BGRA)
         detector.compute(img, args.threshold, args.iou)
-        res_img = plot_results(detector, frame, COCO_CATEGORY, False)
-        cv2.imshow('frame', res_img)
+        # copy the objects, the detector is reused for the next frame
+        return [
+            detector.get_object(i) for i in range(detector.get_object_count())
+        ]
 
-        # save results
-        if writer is not None:
-            writer.write(res_img)
+    def render(frame, detections):
+        nonlocal frame_count
+        res_img = plot_results(detections, frame, COCO_CATEGORY, False)
 
         # write prediction
         if args.write_prediction:
             savepath = get_savepath(args.savepath, video_name, post_fix = '_%s' % (str(frame_count).zfill(frame_digit) + '_res'), ext='.png')
             pred_file = '%s.txt' % savepath.rsplit('.', 1)[0]
-            write_predictions(pred_file, detector, frame, COCO_CATEGORY)
+            write_predictions(pred_file, detections, frame, COCO_CATEGORY)
             frame_count += 1
+        return res_img
+
+    # decode, inference and render/write run on separate threads
+    webcamera_utils.run_video_pipeline(capture, predict, render, writer)
 
     capture.release()
     cv2.destroyAllWindows()
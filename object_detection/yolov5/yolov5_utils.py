@@ -6,6 +6,9 @@ import cv2
 
 import ailia
 
+sys.path.append('../../util')
+import nms_utils  # noqa: E402
+
 
 def sigmoid(x):
     return 1 / (1 + np.exp(-x))
@@ -53,32 +56,13 @@ def non_max_suppression(prediction, num_classes, conf_thres=0.5, nms_thres=0.4):
         class_pred = np.argmax(image_pred[:, 5:5 + num_classes], axis=1)
         class_pred = class_pred.reshape((class_pred.shape[0],1))
         detections = np.concatenate((image_pred[:, :5], class_conf, class_pred), 1)
-        unique_labels = np.unique(detections[:, -1])
-
-        for c in unique_labels:
-            detections_class = detections[detections[:, -1] == c]
-
-            conf_sort_value = np.sort(detections_class[:, 4])
-            conf_sort_value = conf_sort_value[::-1]
-
-            conf_sort_index = np.argsort(detections_class[:, 4])
-            conf_sort_index = conf_sort_index[::-1]
 
-            detections_class = detections_class[conf_sort_index]
-
-            max_detections = []
-            while detections_class.shape[0]:
-                expand_detections_class = np.expand_dims(detections_class[0],0)
-                max_detections.append(expand_detections_class)
-                if len(detections_class) == 1:
-                    break
-                ious = bbox_iou(expand_detections_class, detections_class[1:])
-                detections_class = detections_class[1:][ious < nms_thres]
-
-            max_detections = np.concatenate(max_detections)
-            
-            output[image_i] = max_detections if output[image_i] is None else np.concatenate(
-                (output[image_i], max_detections))
+        # per class NMS in one call
+        keep = nms_utils.batched_nms(
+            detections[:, :4], detections[:, 4], class_pred[:, 0],
+            nms_thres, offset=1, inclusive=True,
+        )
+        output[image_i] = detections[keep]
 
     return output
 
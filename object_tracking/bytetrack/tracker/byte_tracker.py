@@ -1,11 +1,12 @@
 import numpy as np
 
+from kalman_utils import KalmanStateStore, StoredKalmanState
 from .kalman_filter import KalmanFilter
 from .basetrack import BaseTrack, TrackState
 from . import matching
 
 
-class STrack(BaseTrack):
+class STrack(BaseTrack, StoredKalmanState):
     shared_kalman = KalmanFilter()
 
     def __init__(self, tlwh, score):
@@ -26,7 +27,15 @@ class STrack(BaseTrack):
 
     @staticmethod
     def multi_predict(stracks):
-        if len(stracks) > 0:
+        if len(stracks) > 0 and all(
+                st.store is stracks[0].store for st in stracks) and \
+                stracks[0].store is not None:
+            store = stracks[0].store
+            slots = np.array([st.slot for st in stracks])
+            lost = np.array([st.state != TrackState.Tracked for st in stracks])
+            store.means[slots[lost], 7] = 0
+            store.predict(slots)
+        elif len(stracks) > 0:
             multi_mean = np.asarray([st.mean.copy() for st in stracks])
             multi_covariance = np.asarray([st.covariance for st in stracks])
             for i, st in enumerate(stracks):
@@ -37,11 +46,14 @@ class STrack(BaseTrack):
                 stracks[i].mean = mean
                 stracks[i].covariance = cov
 
-    def activate(self, kalman_filter, frame_id):
+    def activate(self, kalman_filter, frame_id, store=None):
         """Start a new tracklet"""
         self.kalman_filter = kalman_filter
         self.track_id = self.next_id()
-        self.mean, self.covariance = self.kalman_filter.initiate(self.tlwh_to_xyah(self._tlwh))
+        if store is not None:
+            self.attach(store, store.initiate(self.tlwh_to_xyah(self._tlwh))[0])
+        else:
+            self.mean, self.covariance = self.kalman_filter.initiate(self.tlwh_to_xyah(self._tlwh))
 
         self.tracklet_len = 0
         self.state = TrackState.Tracked
@@ -51,10 +63,11 @@ class STrack(BaseTrack):
         self.frame_id = frame_id
         self.start_frame = frame_id
 
-    def re_activate(self, new_track, frame_id, new_id=False):
-        self.mean, self.covariance = self.kalman_filter.update(
-            self.mean, self.covariance, self.tlwh_to_xyah(new_track.tlwh)
-        )
+    def re_activate(self, new_track, frame_id, new_id=False, kalman_update=True):
+        if kalman_update:
+            self.mean, self.covariance = self.kalman_filter.update(
+                self.mean, self.covariance, self.tlwh_to_xyah(new_track.tlwh)
+            )
         self.tracklet_len = 0
         self.state = TrackState.Tracked
         self.is_activated = True
@@ -63,20 +76,22 @@ class STrack(BaseTrack):
             self.track_id = self.next_id()
         self.score = new_track.score
 
-    def update(self, new_track, frame_id):
+    def update(self, new_track, frame_id, kalman_update=True):
         """
         Update a matched track
         :type new_track: STrack
         :type frame_id: int
-        :type update_feature: bool
+        :type kalman_update: bool (False when the state is already updated
+            in batch by the tracker)
         :return:
         """
         self.frame_id = frame_id
         self.tracklet_len += 1
 
-        new_tlwh = new_track.tlwh
-        self.mean, self.covariance = self.kalman_filter.update(
-            self.mean, self.covariance, self.tlwh_to_xyah(new_tlwh))
+        if kalman_update:
+            new_tlwh = new_track.tlwh
+            self.mean, self.covariance = self.kalman_filter.update(
+                self.mean, self.covariance, self.tlwh_to_xyah(new_tlwh))
         self.state = TrackState.Tracked
         self.is_activated = True
 
@@ -149,9 +164,11 @@ class BYTETracker(object):
         self.max_time_lost = self.buffer_size
         self.mot20 = mot20
         self.kalman_filter = KalmanFilter()
+        self.store = KalmanStateStore()
 
     def update(self, output_results):
         self.frame_id += 1
+        prev_stracks = self.tracked_stracks + self.lost_stracks
         activated_starcks = []
         refind_stracks = []
         lost_stracks = []
@@ -201,14 +218,15 @@ class BYTETracker(object):
 
         matches, u_track, u_detection = matching.linear_assignment(dists, thresh=self.match_thresh)
 
+        self._batch_update(strack_pool, detections, matches)
         for itracked, idet in matches:
             track = strack_pool[itracked]
             det = detections[idet]
             if track.state == TrackState.Tracked:
-                track.update(detections[idet], self.frame_id)
+                track.update(detections[idet], self.frame_id, kalman_update=False)
                 activated_starcks.append(track)
             else:
-                track.re_activate(det, self.frame_id, new_id=False)
+                track.re_activate(det, self.frame_id, new_id=False, kalman_update=False)
                 refind_stracks.append(track)
 
         ''' Step 3: Second association, with low score detection boxes'''
@@ -222,14 +240,15 @@ class BYTETracker(object):
         r_tracked_stracks = [strack_pool[i] for i in u_track if strack_pool[i].state == TrackState.Tracked]
         dists = matching.iou_distance(r_tracked_stracks, detections_second)
         matches, u_track, u_detection_second = matching.linear_assignment(dists, thresh=0.5)
+        self._batch_update(r_tracked_stracks, detections_second, matches)
         for itracked, idet in matches:
             track = r_tracked_stracks[itracked]
             det = detections_second[idet]
             if track.state == TrackState.Tracked:
-                track.update(det, self.frame_id)
+                track.update(det, self.frame_id, kalman_update=False)
                 activated_starcks.append(track)
             else:
-                track.re_activate(det, self.frame_id, new_id=False)
+                track.re_activate(det, self.frame_id, new_id=False, kalman_update=False)
                 refind_stracks.append(track)
 
         for it in u_track:
@@ -246,8 +265,9 @@ class BYTETracker(object):
 
         matches, u_unconfirmed, u_detection = matching.linear_assignment(dists, thresh=0.7)
 
+        self._batch_update(unconfirmed, detections, matches)
         for itracked, idet in matches:
-            unconfirmed[itracked].update(detections[idet], self.frame_id)
+            unconfirmed[itracked].update(detections[idet], self.frame_id, kalman_update=False)
             activated_starcks.append(unconfirmed[itracked])
         for it in u_unconfirmed:
             track = unconfirmed[it]
@@ -259,7 +279,7 @@ class BYTETracker(object):
             track = detections[inew]
             if track.score < self.det_thresh:
                 continue
-            track.activate(self.kalman_filter, self.frame_id)
+            track.activate(self.kalman_filter, self.frame_id, store=self.store)
             activated_starcks.append(track)
         """ Step 5: Update state"""
         for track in self.lost_stracks:
@@ -278,11 +298,27 @@ class BYTETracker(object):
         self.removed_stracks.extend(removed_stracks)
         self.tracked_stracks, self.lost_stracks = remove_duplicate_stracks(self.tracked_stracks, self.lost_stracks)
 
+        # free the Kalman states of the tracks that are no longer followed
+        alive = set(id(t) for t in self.tracked_stracks + self.lost_stracks)
+        for track in prev_stracks + activated_starcks:
+            if id(track) not in alive:
+                track.detach()
+
         # get scores of lost tracks
         output_stracks = [track for track in self.tracked_stracks if track.is_activated]
 
         return output_stracks
 
+    def _batch_update(self, stracks, detections, matches):
+        """Run the Kalman filter correction step of all matched tracks at once"""
+        if len(matches) == 0:
+            return
+        slots = [stracks[itracked].slot for itracked, _ in matches]
+        measurements = [
+            STrack.tlwh_to_xyah(detections[idet].tlwh) for _, idet in matches
+        ]
+        self.store.update(slots, measurements)
+
 
 def joint_stracks(tlista, tlistb):
     exists = {}
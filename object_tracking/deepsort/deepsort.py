@@ -5,15 +5,15 @@ import numpy as np
 import cv2
 
 import ailia
-from sort.tracker import Tracker
-from sort.nn_matching import NearestNeighborDistanceMetric
-from deepsort_utils import *
 
 # import original modules
 sys.path.append('../../util')
+from sort.tracker import Tracker  # noqa: E402
+from sort.nn_matching import NearestNeighborDistanceMetric  # noqa: E402
+from deepsort_utils import *  # noqa: E402
 from utils import get_base_parser, update_parser  # noqa: E402
 from image_utils import normalize_image  # noqa: E402
-from model_utils import check_and_download_models  # noqa: E402
+from model_utils import check_and_download_models, get_session  # noqa: E402
 from detector_utils import load_image  # noqa: E402
 import webcamera_utils  # noqa: E402
 
@@ -37,6 +37,10 @@ VIDEO_PATH = 'sample.mp4'
 INPUT_HEIGHT = 128
 INPUT_WIDTH = 64
 
+# Batch sizes of the extractor. Crops are padded to the smallest bucket
+# so that the extractor is not reshaped on every frame.
+BATCH_BUCKETS = (1, 8, 16, 32)
+
 # yolo params
 COCO_CATEGORY = [
     "person", "bicycle", "car", "motorcycle", "airplane", "bus", "train",
@@ -84,17 +88,69 @@ def resize(img, size=(INPUT_WIDTH, INPUT_HEIGHT)):
 
 
 def init_detector(env_id):
-    detector = ailia.Detector(
-        DT_MODEL_PATH,
-        DT_WEIGHT_PATH,
-        len(COCO_CATEGORY),
-        format=ailia.NETWORK_IMAGE_FORMAT_RGB,
-        channel=ailia.NETWORK_IMAGE_CHANNEL_FIRST,
-        range=ailia.NETWORK_IMAGE_RANGE_U_FP32,
-        algorithm=ailia.DETECTOR_ALGORITHM_YOLOV3,
-        env_id=env_id,
+    def factory():
+        return ailia.Detector(
+            DT_MODEL_PATH,
+            DT_WEIGHT_PATH,
+            len(COCO_CATEGORY),
+            format=ailia.NETWORK_IMAGE_FORMAT_RGB,
+            channel=ailia.NETWORK_IMAGE_CHANNEL_FIRST,
+            range=ailia.NETWORK_IMAGE_RANGE_U_FP32,
+            algorithm=ailia.DETECTOR_ALGORITHM_YOLOV3,
+            env_id=env_id,
+        )
+    return get_session(
+        DT_WEIGHT_PATH, DT_MODEL_PATH, env_id,
+        factory=factory, kind='detector',
     )
-    return detector
+
+
+def init_extractor(env_id):
+    return get_session(EX_WEIGHT_PATH, EX_MODEL_PATH, env_id)
+
+
+def get_bucket_size(n):
+    for size in BATCH_BUCKETS:
+        if n <= size:
+            return size
+    return BATCH_BUCKETS[-1]
+
+
+def extract_features(extractor, img_batch):
+    """
+    Run the re-ID extractor on all crops with batched predict.
+
+    Parameters
+    ----------
+    extractor: ailia.Net
+    img_batch: numpy array
+        Shape (N, 3, INPUT_HEIGHT, INPUT_WIDTH)
+
+    Returns
+    -------
+    features: numpy array
+        Shape (N, feature_dim)
+    """
+    features = []
+    n = len(img_batch)
+    for start in range(0, n, BATCH_BUCKETS[-1]):
+        chunk = img_batch[start:start + BATCH_BUCKETS[-1]]
+        bucket = get_bucket_size(len(chunk))
+
+        shape = (bucket, 3, INPUT_HEIGHT, INPUT_WIDTH)
+        if tuple(extractor.get_input_shape()) != shape:
+            extractor.set_input_shape(shape)
+
+        if len(chunk) < bucket:
+            pad = np.zeros(
+                (bucket - len(chunk),) + chunk.shape[1:], dtype=np.float32
+            )
+            chunk = np.concatenate([chunk, pad], axis=0)
+
+        output = extractor.predict(chunk.astype(np.float32))
+        features.append(output[:min(bucket, n - start)])
+
+    return np.concatenate(features, axis=0)
 
 
 # ======================
@@ -106,7 +162,7 @@ def recognize_from_video():
 
     # net initialize
     detector = init_detector(args.env_id)
-    extractor = ailia.Net(EX_MODEL_PATH, EX_WEIGHT_PATH, env_id=args.env_id)
+    extractor = init_extractor(args.env_id)
 
     # tracker class instance
     metric = NearestNeighborDistanceMetric(
@@ -169,12 +225,7 @@ def recognize_from_video():
                 for img in img_crops
             ], axis=0).transpose(0, 3, 1, 2)
 
-            # TODO better to pass a batch at once
-            # features = extractor.predict(img_batch)
-            features = []
-            for img in img_batch:
-                features.append(extractor.predict(img[np.newaxis, :, :, :])[0])
-            features = np.array(features)
+            features = extract_features(extractor, img_batch)
         else:
             features = np.array([])
 
@@ -249,7 +300,7 @@ def compare_images():
 
     # net initialize
     detector = init_detector(args.env_id)
-    extractor = ailia.Net(EX_MODEL_PATH, EX_WEIGHT_PATH, env_id=args.env_id)
+    extractor = init_extractor(args.env_id)
 
     # prepare input data
     input_data = []
@@ -300,11 +351,11 @@ def compare_images():
             logger.info('BENCHMARK mode')
             for i in range(5):
                 start = int(round(time.time() * 1000))
-                feature = extractor.predict(img_crop)
+                feature = extract_features(extractor, img_crop)
                 end = int(round(time.time() * 1000))
                 logger.info(f'\tailia processing time {end - start} ms')
         else:
-            feature = extractor.predict(img_crop)
+            feature = extract_features(extractor, img_crop)
 
         features.append(feature[0])
 
@@ -180,8 +180,21 @@ def gate_cost_matrix(
     """
     gating_dim = 2 if only_position else 4
     gating_threshold = kalman_filter.chi2inv95[gating_dim]
+    if len(track_indices) == 0 or len(detection_indices) == 0:
+        return cost_matrix
     measurements = np.asarray(
         [detections[i].to_xyah() for i in detection_indices])
+
+    store = getattr(tracks[track_indices[0]], 'store', None)
+    if store is not None and all(
+            tracks[i].store is store for i in track_indices):
+        # gating of all tracks at once
+        gating_distance = store.gating_distance(
+            [tracks[i].slot for i in track_indices], measurements,
+            only_position)
+        cost_matrix[gating_distance > gating_threshold] = gated_cost
+        return cost_matrix
+
     for row, track_idx in enumerate(track_indices):
         track = tracks[track_idx]
         gating_distance = kf.gating_distance(
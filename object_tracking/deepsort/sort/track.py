@@ -1,3 +1,6 @@
+from kalman_utils import StoredKalmanState
+
+
 class TrackState:
     """
     Enumeration type for the single target track state. Newly created tracks are
@@ -13,12 +16,15 @@ class TrackState:
     Deleted = 3
 
 
-class Track:
+class Track(StoredKalmanState):
     """
     A single target track with state space `(x, y, a, h)` and associated
     velocities, where `(x, y)` is the center of the bounding box, `a` is the
     aspect ratio and `h` is the height.
 
+    The state can be attached to a `kalman_utils.KalmanStateStore` so that
+    the tracker predicts and updates all tracks at once.
+
     Parameters
     ----------
     mean : ndarray
@@ -117,6 +123,11 @@ class Track:
 
         """
         self.mean, self.covariance = kf.predict(self.mean, self.covariance)
+        self.increment_age()
+
+    def increment_age(self):
+        """Count one more frame since the last measurement update.
+        """
         self.age += 1
         self.time_since_update += 1
 
@@ -134,6 +145,18 @@ class Track:
         """
         self.mean, self.covariance = kf.update(
             self.mean, self.covariance, detection.to_xyah())
+        self.mark_hit(detection)
+
+    def mark_hit(self, detection):
+        """Update the feature cache and the track state after the Kalman
+        filter state has been corrected with `detection`.
+
+        Parameters
+        ----------
+        detection : Detection
+            The associated detection.
+
+        """
         self.features.append(detection.feature)
 
         self.hits += 1
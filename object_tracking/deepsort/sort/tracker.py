@@ -1,4 +1,5 @@
 import numpy as np
+from kalman_utils import KalmanStateStore
 from . import kalman_filter
 from . import linear_assignment
 from . import iou_matching
@@ -30,6 +31,9 @@ class Tracker:
         Number of frames that a track remains in initialization phase.
     kf : kalman_filter.KalmanFilter
         A Kalman filter to filter target trajectories in image space.
+    store : kalman_utils.KalmanStateStore
+        Stacked Kalman filter states of all tracks, predicted and updated
+        in one shot.
     tracks : List[Track]
         The list of active tracks at the current time step.
 
@@ -42,6 +46,7 @@ class Tracker:
         self.n_init = n_init
 
         self.kf = kalman_filter.KalmanFilter()
+        self.store = KalmanStateStore()
         self.tracks = []
         self._next_id = 1
 
@@ -50,8 +55,9 @@ class Tracker:
 
         This function should be called once every time step, before `update`.
         """
+        self.store.predict([t.slot for t in self.tracks])
         for track in self.tracks:
-            track.predict(self.kf)
+            track.increment_age()
 
     def update(self, detections):
         """Perform measurement update and track management.
@@ -67,13 +73,20 @@ class Tracker:
             self._match(detections)
 
         # Update track set.
+        self.store.update(
+            [self.tracks[track_idx].slot for track_idx, _ in matches],
+            [detections[detection_idx].to_xyah()
+             for _, detection_idx in matches])
         for track_idx, detection_idx in matches:
-            self.tracks[track_idx].update(
-                self.kf, detections[detection_idx])
+            self.tracks[track_idx].mark_hit(detections[detection_idx])
         for track_idx in unmatched_tracks:
             self.tracks[track_idx].mark_missed()
-        for detection_idx in unmatched_detections:
-            self._initiate_track(detections[detection_idx])
+        self._initiate_tracks(
+            [detections[detection_idx]
+             for detection_idx in unmatched_detections])
+        for t in self.tracks:
+            if t.is_deleted():
+                t.detach()
         self.tracks = [t for t in self.tracks if not t.is_deleted()]
 
         # Update distance metric.
@@ -128,9 +141,14 @@ class Tracker:
         unmatched_tracks = list(set(unmatched_tracks_a + unmatched_tracks_b))
         return matches, unmatched_tracks, unmatched_detections
 
-    def _initiate_track(self, detection):
-        mean, covariance = self.kf.initiate(detection.to_xyah())
-        self.tracks.append(Track(
-            mean, covariance, self._next_id, self.n_init, self.max_age,
-            detection.feature))
-        self._next_id += 1
+    def _initiate_tracks(self, detections):
+        if len(detections) == 0:
+            return
+        slots = self.store.initiate([d.to_xyah() for d in detections])
+        for slot, detection in zip(slots, detections):
+            track = Track(
+                None, None, self._next_id, self.n_init, self.max_age,
+                detection.feature)
+            track.attach(self.store, slot)
+            self.tracks.append(track)
+            self._next_id += 1
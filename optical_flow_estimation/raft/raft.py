@@ -1,10 +1,12 @@
 import time
 import sys
 import platform
+from functools import lru_cache
 
 import numpy as np
 import cv2
 from PIL import Image
+from scipy import interpolate
 
 import ailia
 
@@ -14,6 +16,8 @@ from utils import get_base_parser, update_parser  # noqa: E402
 from model_utils import check_and_download_models  # noqa: E402
 import webcamera_utils  # noqa: E402
 
+from raft_utils import create_corr_block, CORR_MODES  # noqa: E402
+
 # logger
 from logging import getLogger   # noqa: E402
 logger = getLogger(__name__)
@@ -68,6 +72,22 @@ parser.add_argument(
          'If the iterations is small, speed will increase.' + 
          'default value: {\'things\': 12, \'small\': 5}'
 )
+parser.add_argument(
+    '-witr', '--warm_iterations', type=int, default=0,
+    help='Iterations of the video frames warm-started from ' +
+         'the flow of the previous frame. ' +
+         'default value: half of the iterations'
+)
+parser.add_argument(
+    '--no_warm_start', action='store_true',
+    help='Start the flow of each video frame from zero.'
+)
+parser.add_argument(
+    '--corr_mode', default='all_pairs', choices=CORR_MODES,
+    help='all_pairs: precompute the all-pairs correlation volume. ' +
+         'on_demand: compute the correlation of the looked-up windows ' +
+         'only (low memory, for high resolution inputs).'
+)
 args = update_parser(parser)
 
 
@@ -86,9 +106,6 @@ WEIGHT_PATH_UB = 'raft-' + args.model + '_update_block.onnx'
 MODEL_PATH_UB = 'raft-' + args.model + '_update_block.onnx.prototxt'
 REMOTE_PATH_UB = 'https://storage.googleapis.com/ailia-models/raft/'
 
-if (args.iterations > 0):
-    ITERS = args.iterations
-
 if (args.model == 'things'):
     ITERS = 12
     HDIM = 128
@@ -98,6 +115,14 @@ else:
     HDIM = 96
     CORR_RADIUS = 3
 
+if (args.iterations > 0):
+    ITERS = args.iterations
+
+if (args.warm_iterations > 0):
+    WARM_ITERS = args.warm_iterations
+else:
+    WARM_ITERS = max(ITERS // 2, 1)
+
 
 # ======================
 # Sub functions
@@ -128,182 +153,6 @@ class InputPadder:
         return [np.pad(x, self._pad, mode='edge') for x in inputs]
 
 
-class CorrBlock:
-    def __init__(self, fmap1, fmap2, num_levels=4, radius=4):
-        self.num_levels = num_levels
-        self.radius = radius
-        self.corr_pyramid = []
-
-        # all pairs correlation
-        corr = CorrBlock.corr(fmap1, fmap2)
-
-        batch, h1, w1, dim, h2, w2 = corr.shape
-        corr = corr.reshape(batch*h1*w1, dim, h2, w2)
-
-        self.corr_pyramid.append(corr)
-        for i in range(self.num_levels-1):
-            corr = corr[:, :, :(corr.shape[2] - (corr.shape[2] % 2)), 
-                              :(corr.shape[3] - (corr.shape[3] % 2))]
-            corr = corr.reshape(corr.shape[0], corr.shape[1], 
-                                int(corr.shape[2] / 2), 2, 
-                                int(corr.shape[3] / 2), 2)
-            corr = np.mean(np.mean(corr, axis=5), axis=3)
-            self.corr_pyramid.append(corr)
-
-    def __call__(self, coords):
-        r = self.radius
-        coords = coords.transpose(0, 2, 3, 1)
-        batch, h1, w1, _ = coords.shape
-
-        out_pyramid = []
-        for i in range(self.num_levels):
-            corr = self.corr_pyramid[i]
-            dx = np.linspace(-r, r, 2*r+1)
-            dy = np.linspace(-r, r, 2*r+1)
-            delta = np.stack(np.meshgrid(dx, dy)[::-1], axis=-1)
-
-            centroid_lvl = coords.reshape(batch*h1*w1, 1, 1, 2) / 2**i
-            delta_lvl = delta.reshape(1, 2*r+1, 2*r+1, 2)
-            coords_lvl = centroid_lvl + delta_lvl
-
-            corr = bilinear_sampler(corr, coords_lvl)
-            corr = corr.reshape(batch, h1, w1, -1)
-            out_pyramid.append(corr)
-
-        out = np.concatenate(out_pyramid, axis=-1)
-        return out.transpose(0, 3, 1, 2)
-
-    @staticmethod
-    def corr(fmap1, fmap2):
-        batch, dim, ht, wd = fmap1.shape
-        fmap1 = fmap1.reshape(batch, dim, ht*wd)
-        fmap2 = fmap2.reshape(batch, dim, ht*wd) 
-
-        corr = np.matmul(fmap1.transpose(0, 2, 1), fmap2)
-        corr = corr.reshape(batch, ht, wd, 1, ht, wd)
-        return corr / np.sqrt(float(dim))
-
-
-def bilinear_sampler(img, coords, mode='bilinear', mask=False):
-    """ Wrapper for grid_sample, uses pixel coordinates """
-    H, W = img.shape[-2:]
-    xgrid = coords[..., [0]]
-    ygrid = coords[..., [1]]
-    xgrid = 2*xgrid/(W-1) - 1
-    ygrid = 2*ygrid/(H-1) - 1
-
-    grid = np.concatenate([xgrid, ygrid], axis=-1)
-    img = grid_sample(img, grid, align_corners=True)
-
-    if mask:
-        mask = (xgrid > -1) & (ygrid > -1) & (xgrid < 1) & (ygrid < 1)
-        return img, mask.astype(np.float32)
-
-    return img
-
-
-def grid_sampler_unnormalize(coord, side, align_corners):
-    if align_corners:
-        return ((coord + 1) / 2) * (side - 1)
-    else:
-        return ((coord + 1) * side - 1) / 2
-
-
-def grid_sampler_compute_source_index(coord, size, align_corners):
-    coord = grid_sampler_unnormalize(coord, size, align_corners)
-    return coord
-
-
-def safe_get_border(image, n, c, x, y, H, W):
-    x = np.clip(x, 0, (W - 1))
-    y = np.clip(y, 0, (H - 1))
-    value = image[n, c, y, x]
-    return value
-
-
-def safe_get_zero(image, n, c, x, y, H, W):
-    x = x + 1
-    y = y + 1
-    x = np.clip(x, 0, (W + 1))
-    y = np.clip(y, 0, (H + 1))
-    value = np.pad(image, ((0, 0), (0, 0), (1, 1), (1, 1)))
-    value = value[n, c, y, x]
-    return value
-
-
-def safe_get(image, n, c, x, y, H, W, padding_mode='zeros'):
-    if padding_mode == 'border':
-        return safe_get_border(image, n, c, x, y, H, W)
-    else:
-        return safe_get_zero(image, n, c, x, y, H, W)
-
-
-# Originally default value of padding_mode is 'zeros', but change to 'border' for speeding up.
-def grid_sample(image, grid, padding_mode='border', align_corners=False):
-    '''
-         input shape = [N, C, H, W]
-         grid_shape  = [N, H, W, 2]
-
-         output shape = [N, C, H, W]
-    '''
-    # print(image.shape)
-    N, C, H, W = image.shape
-    grid_H = grid.shape[1]
-    grid_W = grid.shape[2]
-
-    output_tensor = np.zeros([N, C, grid_H, grid_W], 
-                             dtype=type(image.reshape(-1)[0]))
-
-    # get corresponding grid x and y
-    y = grid[:, :, :, 1]
-    x = grid[:, :, :, 0]
-
-    y = y[:, np.newaxis, :, :]
-    x = x[:, np.newaxis, :, :]
-    y = y.repeat(C, axis=1)
-    x = x.repeat(C, axis=1)
-
-    c = np.zeros_like(y) + np.arange(C)[np.newaxis, :, np.newaxis, np.newaxis]
-    n = np.zeros_like(y) + np.arange(N)[:, np.newaxis, np.newaxis, np.newaxis]
-    c = c.astype(np.int)
-    n = n.astype(np.int)
-
-    # Unnormalize with align_corners condition
-    ix = grid_sampler_compute_source_index(x, W, align_corners)
-    iy = grid_sampler_compute_source_index(y, H, align_corners)
-
-    x0 = np.floor(ix)
-    x1 = x0 + 1
-
-    y0 = np.floor(iy)
-    y1 = y0 + 1
-
-    # Get W matrix before I matrix, as I matrix requires Channel information
-    wa = (x1 - ix) * (y1 - iy)
-    wb = (x1 - ix) * (iy - y0)
-    wc = (ix - x0) * (y1 - iy)
-    wd = (ix - x0) * (iy - y0)
-
-    # Get values of the image by provided x0,y0,x1,y1 by channel
-
-    # image, n, c, x, y, H, W
-    x0 = x0.astype(np.int)
-    y0 = y0.astype(np.int)
-    x1 = x1.astype(np.int)
-    y1 = y1.astype(np.int)
-    Ia = safe_get(image, n, c, x0, y0, H, W, padding_mode)
-    Ib = safe_get(image, n, c, x0, y1, H, W, padding_mode)
-    Ic = safe_get(image, n, c, x1, y0, H, W, padding_mode)
-    Id = safe_get(image, n, c, x1, y1, H, W, padding_mode)
-    out_ch_val = (
-            (Ia * wa) + (Ib * wb) + \
-            (Ic * wc) + (Id * wd))
-
-    output_tensor[:, :, :, :] = out_ch_val
-
-    return output_tensor
-
-
 def initialize_flow(img):
     """ Flow is represented as difference between two coordinate grids flow = coords1 - coords0"""
     N, C, H, W = img.shape
@@ -342,12 +191,37 @@ def upflow8(flow, mode='bilinear'):
                          for i in range(flow.shape[0])])
 
 
+def forward_interpolate(flow):
+    """ Forward-project a [N, 2, H, W] flow to the next frame (nearest neighbor) """
+    out = np.zeros_like(flow)
+    for n in range(flow.shape[0]):
+        dx, dy = flow[n, 0], flow[n, 1]
+        ht, wd = dx.shape
+        x0, y0 = np.meshgrid(np.arange(wd), np.arange(ht))
+
+        x1 = (x0 + dx).reshape(-1)
+        y1 = (y0 + dy).reshape(-1)
+        dx = dx.reshape(-1)
+        dy = dy.reshape(-1)
+
+        valid = (x1 > 0) & (x1 < wd) & (y1 > 0) & (y1 < ht)
+        if not np.any(valid):
+            continue
+        points = (x1[valid], y1[valid])
+        out[n, 0] = interpolate.griddata(
+            points, dx[valid], (x0, y0), method='nearest', fill_value=0)
+        out[n, 1] = interpolate.griddata(
+            points, dy[valid], (x0, y0), method='nearest', fill_value=0)
+    return out
+
+
 def softmax(x, axis):
     x = np.exp(x - np.max(x, axis=axis))
     x = x / np.sum(x, axis=axis)
     return x
 
 
+@lru_cache(maxsize=8)
 def get_indices(X_shape, HF, WF, stride, pad):
     """
         Returns index matrices in order to transform our input image into a matrix.
@@ -365,6 +239,8 @@ def get_indices(X_shape, HF, WF, stride, pad):
         -d: matrix of index d. 
             (Use to mark delimitation for each channel
             during multi-dimensional arrays indexing).
+
+        The matrices are cached by shape, do not modify them.
     """
     # get input size
     m, n_C, n_H, n_W = X_shape
@@ -557,6 +433,111 @@ def flow_to_image(flow_uv, clip_flow=None, convert_to_bgr=False):
     return flow_uv_to_colors(u, v, convert_to_bgr)
 
 
+def refine_flow(update_block, corr_fn, net, inp, coords0, coords1, iters):
+    """ Iterative update of coords1, returns the upsampled flow """
+    for itr in range(iters):
+        corr = corr_fn(coords1)  # index correlation volume
+
+        flow = coords1 - coords0
+        logger.info('[iter:%d] Start predicting optical flow...' % (itr+1))
+        net, up_mask, delta_flow = update_block.run([net, inp, corr, flow])
+
+        # F(t+1) = F(t) + \Delta(t)
+        coords1 = coords1 + delta_flow
+
+    # upsample predictions
+    if (args.model == 'small'):
+        flow_up = upflow8(coords1 - coords0)
+    else:
+        flow_up = upsample_flow(coords1 - coords0, up_mask)
+
+    return coords1, flow_up
+
+
+def run_net(net, x):
+    if tuple(net.get_input_shape()) != x.shape:
+        net.set_input_shape(x.shape)
+    return net.run(x)[0]
+
+
+class FlowStream:
+    """
+    Optical flow of consecutive video frames.
+
+    The feature map of each frame is computed once and reused as fmap1
+    of the next pair, and the context of each frame is computed once
+    when it becomes the first frame of a pair. With `warm_start`, the
+    flow of a pair starts from the forward-projected flow of the
+    previous pair, and only `warm_iters` iterations are run.
+    """
+
+    def __init__(
+            self, fnet, cnet, update_block,
+            iters=ITERS, warm_iters=WARM_ITERS, warm_start=True):
+        self.fnet = fnet
+        self.cnet = cnet
+        self.update_block = update_block
+        self.iters = iters
+        self.warm_iters = warm_iters
+        self.warm_start = warm_start
+
+        self.image = None
+        self.fmap = None
+        self.flow = None
+
+    def reset(self):
+        self.image = None
+        self.fmap = None
+        self.flow = None
+
+    def __call__(self, image):
+        """
+        Parameters
+        ----------
+        image: numpy array
+            [1, 3, H, W] normalized and padded frame
+
+        Returns
+        -------
+        flow_up: numpy array
+            [1, 2, H, W] flow from the previous frame to this frame
+            (None for the first frame)
+        """
+        if self.image is not None and self.image.shape != image.shape:
+            self.reset()
+
+        logger.info('Start calculating feature map...')
+        fmap = run_net(self.fnet, image)
+        if self.image is None:
+            self.image, self.fmap = image, fmap
+            return None
+        fmap1, image1 = self.fmap, self.image
+        self.image, self.fmap = image, fmap
+
+        # calculate correlation of pixel of feature map
+        corr_fn = create_corr_block(
+            fmap1, fmap, radius=CORR_RADIUS, mode=args.corr_mode)
+
+        # calculate context
+        logger.info('Start calculating context...')
+        cmap = run_net(self.cnet, image1)
+        net = np.tanh(cmap[:, :HDIM])
+        inp = np.clip(cmap[:, HDIM:], 0, None)
+
+        # initialize coordinates
+        coords0, coords1 = initialize_flow(image1)
+        iters = self.iters
+        if self.warm_start and self.flow is not None:
+            coords1 = coords1 + forward_interpolate(self.flow)
+            iters = self.warm_iters
+
+        coords1, flow_up = refine_flow(
+            self.update_block, corr_fn, net, inp, coords0, coords1, iters)
+        self.flow = coords1 - coords0
+
+        return flow_up
+
+
 # ======================
 # Main functions
 # ======================
@@ -598,7 +579,8 @@ def recognize_from_image():
     fmap1 = fmap[0][[0]]
     fmap2 = fmap[0][[1]]
     # calculate correlation of pixel of feature map
-    corr_fn = CorrBlock(fmap1, fmap2, radius=CORR_RADIUS)
+    corr_fn = create_corr_block(
+        fmap1, fmap2, radius=CORR_RADIUS, mode=args.corr_mode)
 
     # calculate context
     logger.info('Start calculating context...')
@@ -620,34 +602,8 @@ def recognize_from_image():
     coords0, coords1 = initialize_flow(image1)
 
     # predict optical flow
-    flow_predictions = []
-    for itr in range(ITERS):
-
-        corr = corr_fn(coords1)  # index correlation volume
-
-        flow = coords1 - coords0
-        logger.info('[iter:%d] Start predicting optical flow...' % (itr+1))
-        if args.benchmark:
-            logger.info('BENCHMARK mode')
-            for i in range(args.benchmark_count):
-                start = int(round(time.time() * 1000))
-                cmap = cnet.run(image1)[0]
-                end = int(round(time.time() * 1000))
-                logger.info(f'\tailia processing time {end - start} ms')
-        else:
-            cmap = cnet.run(image1)[0]
-        net, up_mask, delta_flow = update_block.run([net, inp, corr, flow])
-
-        # F(t+1) = F(t) + \Delta(t)
-        coords1 = coords1 + delta_flow
-
-        # upsample predictions
-        if (args.model == 'small'):
-            flow_up = upflow8(coords1 - coords0)
-        else:
-            flow_up = upsample_flow(coords1 - coords0, up_mask)
-
-        flow_predictions.append(flow_up)
+    _, flow_up = refine_flow(
+        update_block, corr_fn, net, inp, coords0, coords1, ITERS)
 
     # visualize
     img_BGR = viz(image1_org, image2_org, flow_up)
@@ -683,104 +639,37 @@ def recognize_from_video():
     else:
         writer = None
 
-    # read frame
-    ret, frame_before = capture.read()
-    if RESIZE_ENABLE:
-        frame_before = cv2.resize(frame_before, (W,H))
-    frame_before = frame_before[..., ::-1]  # BGR2RGB
+    stream = FlowStream(
+        fnet, cnet, update_block, warm_start=not args.no_warm_start)
+
+    frame_before = None
     while(True):
         # read frame
         ret, frame_after = capture.read()
-        if RESIZE_ENABLE:
-            frame_after = cv2.resize(frame_after, (W,H))
         if (cv2.waitKey(1) & 0xFF == ord('q')) or not ret:
             break
+        if RESIZE_ENABLE:
+            frame_after = cv2.resize(frame_after, (W,H))
 
         # preprocessing
         frame_after = frame_after[..., ::-1]  # BGR2RGB
-        image1 = frame_before.copy()
-        image2 = frame_after.copy()
-        image1 = prep_input(image1)
-        image2 = prep_input(image2)
-        image1_org = image1.copy()
-        image2_org = image2.copy()
+        image = prep_input(frame_after.copy())
 
         # padding for adjust
-        padder = InputPadder(image1.shape)
-        image1, image2 = padder.pad(image1, image2)
+        padder = InputPadder(image.shape)
+        image, = padder.pad(image)
         # normalize
-        image1 = 2 * (image1 / 255.0) - 1.0
-        image2 = 2 * (image2 / 255.0) - 1.0
-
-        # calculate feature map
-        logger.info('Start calculating feature map...')
-        if args.benchmark:
-            logger.info('BENCHMARK mode')
-            for i in range(args.benchmark_count):
-                start = int(round(time.time() * 1000))
-                fmap = fnet.run(np.concatenate([image1, image2], axis=0))
-                end = int(round(time.time() * 1000))
-                logger.info(f'\tailia processing time {end - start} ms')
-        else:
-            fmap = fnet.run(np.concatenate([image1, image2], axis=0))
-        fmap1 = fmap[0][[0]]
-        fmap2 = fmap[0][[1]]
-        # calculate correlation of pixel of feature map
-        corr_fn = CorrBlock(fmap1, fmap2, radius=CORR_RADIUS)
-
-        # calculate context
-        logger.info('Start calculating context...')
-        if args.benchmark:
-            logger.info('BENCHMARK mode')
-            for i in range(args.benchmark_count):
-                start = int(round(time.time() * 1000))
-                cmap = cnet.run(image1)[0]
-                end = int(round(time.time() * 1000))
-                logger.info(f'\tailia processing time {end - start} ms')
-        else:
-            cmap = cnet.run(image1)[0]
-        net = cmap[:, :HDIM]
-        inp = cmap[:, HDIM:]
-        net = np.tanh(net)
-        inp = np.clip(inp, 0, None)
-
-        # initialize coordinates
-        coords0, coords1 = initialize_flow(image1)
+        image = 2 * (image / 255.0) - 1.0
 
         # predict optical flow
-        flow_predictions = []
-        for itr in range(ITERS):
-
-            corr = corr_fn(coords1)  # index correlation volume
-
-            flow = coords1 - coords0
-            logger.info('[iter:%d] Start predicting optical flow...' % (itr+1))
-            if args.benchmark:
-                logger.info('BENCHMARK mode')
-                for i in range(args.benchmark_count):
-                    start = int(round(time.time() * 1000))
-                    cmap = cnet.run(image1)[0]
-                    end = int(round(time.time() * 1000))
-                    logger.info(f'\tailia processing time {end - start} ms')
-            else:
-                cmap = cnet.run(image1)[0]
-            net, up_mask, delta_flow = update_block.run([net, inp, corr, flow])
-
-            # F(t+1) = F(t) + \Delta(t)
-            coords1 = coords1 + delta_flow
-
-            # upsample predictions
-            if (args.model == 'small'):
-                flow_up = upflow8(coords1 - coords0)
-            else:
-                flow_up = upsample_flow(coords1 - coords0, up_mask)
-
-            flow_predictions.append(flow_up)
+        flow_up = stream(image)
+        if flow_up is None:
+            frame_before = frame_after
+            continue
 
         # visualize
-        img_BGR = viz(image1_org, image2_org, flow_up)
-        # save visualization
-        logger.info(f'saved at : {args.savepath}')
+        img_BGR = viz(
+            prep_input(frame_before), prep_input(frame_after), flow_up)
 
         # view result figure
         cv2.imshow('frame', img_BGR)
@@ -0,0 +1,223 @@
+import numpy as np
+
+
+CORR_MODES = ('all_pairs', 'on_demand')
+
+
+# ======================
+# Window lookup
+# ======================
+def window_grid(coords, radius, height, width):
+    """
+    Integer sampling grid of the (2r+1)x(2r+1) bilinear windows.
+
+    All the points of a window share the fractional part of its center,
+    so the window is interpolated from the (2r+2)x(2r+2) integer points
+    around it with the same 4 weights.
+
+    Parameters
+    ----------
+    coords: numpy array
+        (Q, 2) window centers (x, y) in pixels
+    radius: int
+    height, width: int
+        size of the sampled map (indices are clamped to the border)
+
+    Returns
+    -------
+    xs, ys: numpy array
+        (Q, 2r+2) integer x and y of the grid
+    wx, wy: numpy array
+        (Q, 1, 1) interpolation weights of the right / bottom neighbors
+    """
+    x0 = np.floor(coords[:, 0])
+    y0 = np.floor(coords[:, 1])
+    wx = (coords[:, 0] - x0)[:, None, None]
+    wy = (coords[:, 1] - y0)[:, None, None]
+
+    offset = np.arange(-radius, radius + 2)
+    xs = np.clip(x0.astype(np.int64)[:, None] + offset, 0, width - 1)
+    ys = np.clip(y0.astype(np.int64)[:, None] + offset, 0, height - 1)
+    return xs, ys, wx, wy
+
+
+def interpolate_window(grid_values, wx, wy):
+    """
+    Bilinear interpolation of the windows from their integer grid.
+
+    Parameters
+    ----------
+    grid_values: numpy array
+        (Q, 2r+2, 2r+2) values at (y, x) of the integer grid
+
+    Returns
+    -------
+    numpy array
+        (Q, 2r+1, 2r+1) values, indexed by (x offset, y offset) like
+        the window of the original RAFT
+    """
+    v = grid_values
+    out = (1 - wy) * ((1 - wx) * v[:, :-1, :-1] + wx * v[:, :-1, 1:]) + \
+        wy * ((1 - wx) * v[:, 1:, :-1] + wx * v[:, 1:, 1:])
+    return out.transpose(0, 2, 1)
+
+
+def sample_window(volume, coords, radius):
+    """
+    Sample (2r+1)x(2r+1) windows of per-query maps.
+
+    Equivalent to `grid_sample` with `align_corners=True` and border
+    padding at `coords + delta`, without the full-size index tensors.
+
+    Parameters
+    ----------
+    volume: numpy array
+        (Q, H, W) one map for each query
+    coords: numpy array
+        (Q, 2) window centers (x, y)
+    radius: int
+
+    Returns
+    -------
+    numpy array
+        (Q, (2r+1)**2) sampled values
+    """
+    q, h, w = volume.shape
+    xs, ys, wx, wy = window_grid(coords, radius, h, w)
+    idx = ys[:, :, None] * w + xs[:, None, :]
+    values = np.take_along_axis(
+        volume.reshape(q, h * w), idx.reshape(q, -1), axis=1)
+    values = values.reshape(idx.shape)
+    return interpolate_window(values, wx, wy).reshape(q, -1)
+
+
+def avg_pool2(x):
+    """ 2x2 average pooling of the last two axes (odd border is dropped) """
+    h, w = x.shape[-2:]
+    x = x[..., :h - h % 2, :w - w % 2]
+    x = x.reshape(x.shape[:-2] + (h // 2, 2, w // 2, 2))
+    return x.mean(axis=(-3, -1))
+
+
+# ======================
+# Correlation blocks
+# ======================
+class CorrBlock:
+    """
+    All-pairs correlation pyramid.
+
+    The (H*W)x(H*W) volume is computed once, then each lookup samples a
+    (2r+1)x(2r+1) window at every query point of every level.
+    """
+
+    def __init__(self, fmap1, fmap2, num_levels=4, radius=4):
+        self.num_levels = num_levels
+        self.radius = radius
+        self.corr_pyramid = []
+
+        # all pairs correlation
+        corr = CorrBlock.corr(fmap1, fmap2)
+
+        batch, h1, w1, dim, h2, w2 = corr.shape
+        corr = corr.reshape(batch*h1*w1, h2, w2)
+
+        self.corr_pyramid.append(corr)
+        for i in range(self.num_levels-1):
+            corr = avg_pool2(corr)
+            self.corr_pyramid.append(corr)
+
+    def __call__(self, coords):
+        r = self.radius
+        coords = coords.transpose(0, 2, 3, 1)
+        batch, h1, w1, _ = coords.shape
+        coords = coords.reshape(batch*h1*w1, 2)
+
+        out_pyramid = []
+        for i in range(self.num_levels):
+            corr = sample_window(self.corr_pyramid[i], coords / 2**i, r)
+            out_pyramid.append(corr.reshape(batch, h1, w1, -1))
+
+        out = np.concatenate(out_pyramid, axis=-1)
+        return out.transpose(0, 3, 1, 2)
+
+    @staticmethod
+    def corr(fmap1, fmap2):
+        batch, dim, ht, wd = fmap1.shape
+        fmap1 = fmap1.reshape(batch, dim, ht*wd)
+        fmap2 = fmap2.reshape(batch, dim, ht*wd)
+
+        corr = np.matmul(fmap1.transpose(0, 2, 1), fmap2)
+        corr = corr.reshape(batch, ht, wd, 1, ht, wd)
+        return corr / np.sqrt(float(dim)).astype(corr.dtype)
+
+
+class AlternateCorrBlock:
+    """
+    On-demand correlation lookup.
+
+    Instead of the all-pairs volume, only the pooled feature maps of the
+    second image are kept. Since the correlation is linear in fmap2,
+    pooling and bilinear sampling can be done on the features, and the
+    dot products are computed only on the (2r+2)x(2r+2) grid around each
+    query point. The result equals `CorrBlock`, with O(H*W) memory.
+
+    Queries are processed `chunk_size` at a time to bound the size of
+    the gathered features.
+    """
+
+    def __init__(self, fmap1, fmap2, num_levels=4, radius=4, chunk_size=1024):
+        self.num_levels = num_levels
+        self.radius = radius
+        self.chunk_size = chunk_size
+
+        batch, dim, ht, wd = fmap1.shape
+        self.batch = batch
+        self.scale = 1 / np.sqrt(float(dim))
+
+        # (B, H*W, C) query features
+        self.fmap1 = fmap1.reshape(batch, dim, ht*wd).transpose(0, 2, 1)
+
+        # (B, h, w, C) pooled features of each level
+        self.fmap2_pyramid = []
+        fmap2 = fmap2
+        for i in range(self.num_levels):
+            self.fmap2_pyramid.append(
+                np.ascontiguousarray(fmap2.transpose(0, 2, 3, 1)))
+            fmap2 = avg_pool2(fmap2)
+
+    def __call__(self, coords):
+        r = self.radius
+        coords = coords.transpose(0, 2, 3, 1)
+        batch, h1, w1, _ = coords.shape
+        coords = coords.reshape(batch, h1*w1, 2)
+
+        out = np.empty(
+            (batch, h1*w1, self.num_levels, (2*r+1)**2),
+            dtype=self.fmap1.dtype)
+        for b in range(batch):
+            for i in range(self.num_levels):
+                fmap2 = self.fmap2_pyramid[i][b]
+                h2, w2, dim = fmap2.shape
+                fmap2 = fmap2.reshape(h2*w2, dim)
+                for start in range(0, h1*w1, self.chunk_size):
+                    end = start + self.chunk_size
+                    f1 = self.fmap1[b, start:end]
+                    xs, ys, wx, wy = window_grid(
+                        coords[b, start:end] / 2**i, r, h2, w2)
+                    idx = ys[:, :, None] * w2 + xs[:, None, :]
+                    corr = np.einsum('qkc,qc->qk', fmap2[idx.reshape(len(idx), -1)], f1)
+                    corr = corr.reshape(idx.shape) * self.scale
+                    out[b, start:end, i] = \
+                        interpolate_window(corr, wx, wy).reshape(len(idx), -1)
+
+        out = out.reshape(batch, h1, w1, -1)
+        return out.transpose(0, 3, 1, 2)
+
+
+def create_corr_block(fmap1, fmap2, radius=4, mode='all_pairs'):
+    if mode == 'all_pairs':
+        return CorrBlock(fmap1, fmap2, radius=radius)
+    elif mode == 'on_demand':
+        return AlternateCorrBlock(fmap1, fmap2, radius=radius)
+    else:
+        raise ValueError('unknown correlation mode: %s' % mode)
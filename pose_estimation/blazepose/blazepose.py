@@ -11,6 +11,8 @@ sys.path.append('../../util')
 from utils import get_base_parser, update_parser, get_savepath  # noqa: E402
 from model_utils import check_and_download_models  # noqa: E402
 import webcamera_utils  # noqa: E402
+from roi_tracking_utils import RoiTracker  # noqa: E402
+from mediapipe_utils import LandmarkEstimator  # noqa: E402
 
 # logger
 from logging import getLogger   # noqa: E402
@@ -35,6 +37,12 @@ parser = get_base_parser(
     IMAGE_PATH,
     SAVE_IMAGE_PATH,
 )
+parser.add_argument(
+    '--detection_interval', metavar='N', type=int, default=30,
+    help='In the video mode, the person is tracked from the landmarks, ' +
+    'and the person detector only runs when the person is lost or every ' +
+    'N frames (0: only when the person is lost, 1: every frame)'
+)
 args = update_parser(parser)
 
 
@@ -173,6 +181,8 @@ def recognize_from_image():
     estimator = ailia.Net(
         ESTIMATOR_MODEL_PATH, ESTIMATOR_WEIGHT_PATH, env_id=args.env_id
     )
+    # the estimator takes one person per inference
+    estimate_landmarks = LandmarkEstimator(estimator, batch_size=1)
 
     # input image loop
     for image_path in args.input:
@@ -206,7 +216,7 @@ def recognize_from_image():
                     img, affine, _ = but.estimator_preprocess(
                         src_img, detections, scale, pad
                     )
-                    flags, normalized_landmarks, _ = estimator.predict([img])
+                    flags, normalized_landmarks, _ = estimate_landmarks(img)
                     landmarks = but.denormalize_landmarks(
                         normalized_landmarks, affine
                     )
@@ -236,7 +246,7 @@ def recognize_from_image():
                 img, affine, _ = but.estimator_preprocess(
                     src_img, detections, scale, pad
                 )
-                flags, normalized_landmarks, _ = estimator.predict([img])
+                flags, normalized_landmarks, _ = estimate_landmarks(img)
                 landmarks = but.denormalize_landmarks(
                     normalized_landmarks, affine
                 )
@@ -258,6 +268,34 @@ def recognize_from_video():
     estimator = ailia.Net(
         ESTIMATOR_MODEL_PATH, ESTIMATOR_WEIGHT_PATH, env_id=args.env_id
     )
+    # the estimator takes one person per inference
+    estimate_landmarks = LandmarkEstimator(estimator, batch_size=1)
+
+    def detect(frame):
+        # Person detection
+        _, img128, scale, pad = but.resize_pad(frame[:, :, ::-1])
+        input_data = img128.astype('float32') / 255.
+        input_data = np.expand_dims(np.moveaxis(input_data, -1, 0), 0)
+        detector_out = detector.predict([input_data])
+        detections = but.detector_postprocess(detector_out)
+        if detections[0].size == 0:
+            return np.zeros((0, 4))
+        detections = but.denormalize_detections(detections[0], scale, pad)
+        return np.stack(but.detection2roi(detections), axis=1)
+
+    def estimate(frame, rois):
+        # Pose estimation
+        xc, yc, scale, theta = rois.T
+        img, affine, _ = but.extract_roi(frame, xc, yc, theta, scale)
+        flags, normalized_landmarks, _ = estimate_landmarks(img)
+        landmarks = but.denormalize_landmarks(normalized_landmarks, affine)
+        return landmarks, flags, but.landmarks2roi(landmarks)
+
+    tracker = RoiTracker(
+        detect, estimate,
+        max_subjects=1,
+        detection_interval=args.detection_interval,
+    )
 
     capture = webcamera_utils.get_capture(args.video)
 
@@ -274,25 +312,9 @@ def recognize_from_video():
         if (cv2.waitKey(1) & 0xFF == ord('q')) or not ret:
             break
 
-        _, img128, scale, pad = but.resize_pad(frame[:, :, ::-1])
-        input_data = img128.astype('float32') / 255.
-        input_data = np.expand_dims(np.moveaxis(input_data, -1, 0), 0)
-
         # inference
-        # Person detection
-        detector_out = detector.predict([input_data])
-        detections = but.detector_postprocess(detector_out)
-        count = len(detections) if detections[0].size > 0 else 0
-
-        # Pose estimation
-        landmarks = []
-        flags = []
-        if count > 0:
-            img, affine, _ = but.estimator_preprocess(
-                frame, detections, scale, pad
-            )
-            flags, normalized_landmarks, _ = estimator.predict([img])
-            landmarks = but.denormalize_landmarks(normalized_landmarks, affine)
+        landmarks, flags, _ = tracker(frame)
+        count = len(landmarks)
 
         # postprocessing
         display_result(frame, count, landmarks, flags)
@@ -306,8 +328,11 @@ def recognize_from_video():
     cv2.destroyAllWindows()
     if writer is not None:
         writer.release()
+    logger.info(
+        f'person detection ran on {tracker.num_detections}/'
+        f'{tracker.num_frames} frames'
+    )
     logger.info('Script finished successfully.')
-    pass
 
 
 def main():
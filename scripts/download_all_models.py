@@ -0,0 +1,379 @@
+# Download the onnx and prototxt files of all the models in parallel
+#
+# The `check_and_download_models` calls of each model script are resolved
+# statically (module constants, dictionaries of model variants, ...), so the
+# scripts are not run. The scripts whose calls can not be resolved are
+# listed, and can be run with `-b` by `--run_unresolved`
+# (like download_all_models.sh).
+
+import os
+import sys
+import ast
+import argparse
+import itertools
+import subprocess
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(ROOT, 'util'))
+from log_init import logger  # noqa: E402
+from launcher_utils import search_model  # noqa: E402
+import download_utils  # noqa: E402
+
+# ======================
+# Arguemnt Parser Config
+# ======================
+parser = argparse.ArgumentParser(
+    description='Download the model files of ailia MODELS')
+parser.add_argument(
+    '--models', metavar='NAME', nargs='+', default=None,
+    help='model or category names to download (default: all the models)'
+)
+parser.add_argument(
+    '-j', '--jobs', metavar='N', type=int, default=8,
+    help='number of concurrent downloads'
+)
+parser.add_argument(
+    '--cache', metavar='DIR', default=None,
+    help='content cache directory (default: AILIA_MODELS_CACHE or '
+         '~/.cache/ailia-models, "" to disable the cache)'
+)
+parser.add_argument(
+    '--mirror', metavar='URL', default=None,
+    help='base url replacing https://storage.googleapis.com/ailia-models/ '
+         '(default: AILIA_MODELS_MIRROR)'
+)
+parser.add_argument(
+    '--manifest', metavar='FILE', default=None,
+    help='checksum manifest (default: AILIA_MODELS_MANIFEST or '
+         'manifest.json of the cache directory)'
+)
+parser.add_argument(
+    '--verify', action='store_true',
+    help='check the sha256 of all the files against the manifest'
+)
+parser.add_argument(
+    '--refresh', action='store_true',
+    help='check the files without a manifest entry against the size given '
+         'by the server (default: AILIA_MODELS_REFRESH)'
+)
+parser.add_argument(
+    '--run_unresolved', action='store_true',
+    help='run the scripts whose downloads can not be resolved with -b'
+)
+parser.add_argument(
+    '--dry_run', action='store_true',
+    help='list the files without downloading them'
+)
+
+# limit of the candidates of an expression
+MAX_CANDIDATES = 64
+
+
+# ======================
+# Static resolution
+# ======================
+
+class Choices(list):
+    """
+    Any of the values of a dictionary or a list (its subscript).
+    """
+
+
+class ScriptScanner:
+    """
+    Candidate values of the arguments of `check_and_download_models` in a
+    script. The assignments of every scope are merged, and the branches
+    of conditional expressions, the values of dictionaries and the choices
+    of the command line options (`args.xxx`) are all candidates.
+    """
+
+    def __init__(self, path):
+        with open(path, encoding='utf-8') as f:
+            self.tree = ast.parse(f.read(), path)
+        self.assigns = defaultdict(list)
+        for node in ast.walk(self.tree):
+            if isinstance(node, ast.Assign):
+                for target in node.targets:
+                    self._bind(target, node.value, ())
+            elif isinstance(node, ast.AnnAssign) and node.value is not None:
+                self._bind(node.target, node.value, ())
+        self.options = {}
+        for node in ast.walk(self.tree):
+            if isinstance(node, ast.Call) and \
+                    getattr(node.func, 'attr', None) == 'add_argument':
+                self._add_option(node)
+
+    def _add_option(self, call):
+        names = [a.value for a in call.args
+                 if isinstance(a, ast.Constant) and isinstance(a.value, str)]
+        kwargs = {k.arg: k.value for k in call.keywords}
+        if 'dest' in kwargs and isinstance(kwargs['dest'], ast.Constant):
+            dest = kwargs['dest'].value
+        else:
+            long_names = [n for n in names if n.startswith('--')]
+            if len(long_names) == 0:
+                return
+            dest = long_names[0][2:].replace('-', '_')
+        if 'choices' in kwargs:
+            values = []
+            for v in self.values(kwargs['choices']):
+                if isinstance(v, (tuple, list)):
+                    values.extend(v)
+        elif 'default' in kwargs:
+            values = self.values(kwargs['default'])
+        else:
+            return
+        self.options[dest] = values
+
+    def _bind(self, target, value, index):
+        if isinstance(target, ast.Name):
+            self.assigns[target.id].append((value, index))
+        elif isinstance(target, (ast.Tuple, ast.List)):
+            for i, elt in enumerate(target.elts):
+                self._bind(elt, value, index + (i,))
+
+    def calls(self):
+        for node in ast.walk(self.tree):
+            if not isinstance(node, ast.Call) or len(node.args) != 3:
+                continue
+            func = node.func
+            name = func.id if isinstance(func, ast.Name) else \
+                getattr(func, 'attr', None)
+            if name == 'check_and_download_models':
+                yield node
+
+    def values(self, node, depth=0, seen=()):
+        if depth > 16:
+            return []
+        depth += 1
+        if isinstance(node, ast.Constant):
+            return [node.value]
+        if isinstance(node, ast.Name):
+            if node.id in seen:
+                return []
+            seen = seen + (node.id,)
+            result = []
+            for value, index in self.assigns.get(node.id, []):
+                for v in self.values(value, depth, seen):
+                    v = self._unpack(v, index)
+                    if v is not None:
+                        result.extend(v)
+            return self._unique(result)
+        if isinstance(node, ast.Attribute) and \
+                isinstance(node.value, ast.Name) and node.value.id == 'args':
+            return self._unique(self.options.get(node.attr, []))
+        if isinstance(node, ast.Call) and \
+                isinstance(node.func, ast.Name) and node.func.id == 'str':
+            return [str(v) for v in self.values(node.args[0], depth, seen)
+                    if isinstance(v, (str, int, float))]
+        if isinstance(node, ast.IfExp):
+            return self._unique(
+                self.values(node.body, depth, seen) +
+                self.values(node.orelse, depth, seen))
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+            return self._concat([
+                self.values(node.left, depth, seen),
+                self.values(node.right, depth, seen)])
+        if isinstance(node, ast.JoinedStr):
+            parts = []
+            for value in node.values:
+                if isinstance(value, ast.FormattedValue):
+                    value = value.value
+                parts.append([
+                    v if isinstance(v, str) else str(v)
+                    for v in self.values(value, depth, seen)
+                    if isinstance(v, (str, int))])
+            return self._concat(parts)
+        if isinstance(node, (ast.Tuple, ast.List)):
+            elts = [self.values(e, depth, seen) for e in node.elts]
+            return [tuple(t) for t in self._product(elts)]
+        if isinstance(node, ast.Dict):
+            values = []
+            for value in node.values:
+                values.extend(self.values(value, depth, seen))
+            return [Choices(self._unique(values))]
+        if isinstance(node, ast.Subscript):
+            result = []
+            for v in self.values(node.value, depth, seen):
+                if isinstance(v, (Choices, tuple, list)):
+                    result.extend(v)
+            return self._unique(result)
+        return []
+
+    @staticmethod
+    def _unpack(value, index):
+        values = [value]
+        for i in index:
+            unpacked = []
+            for v in values:
+                if isinstance(v, Choices):
+                    v = [c[i] for c in v
+                         if isinstance(c, (tuple, list)) and len(c) > i]
+                    unpacked.extend(v)
+                elif isinstance(v, (tuple, list)) and len(v) > i:
+                    unpacked.append(v[i])
+            values = unpacked
+        return values
+
+    @staticmethod
+    def _unique(values):
+        result = []
+        for v in values:
+            if v not in result:
+                result.append(v)
+        return result[:MAX_CANDIDATES]
+
+    @staticmethod
+    def _product(lists):
+        return list(itertools.islice(
+            itertools.product(*lists), MAX_CANDIDATES))
+
+    def _concat(self, lists):
+        return self._unique([
+            ''.join(t) for t in self._product(lists)
+            if all(isinstance(s, str) for s in t)])
+
+
+def resolve_downloads(script_path):
+    """
+    (weight, model, remote) of each download of a script.
+
+    Returns
+    -------
+    items: list of tuple
+    resolved: bool
+        False if a call could not be resolved
+    """
+    scanner = ScriptScanner(script_path)
+    items = []
+    resolved = True
+    for call in scanner.calls():
+        weights, models, remotes = [
+            scanner.values(arg) for arg in call.args]
+        weights = [w for w in weights if isinstance(w, str)]
+        remotes = [r for r in remotes if isinstance(r, str)]
+        if len(weights) == 0 or len(remotes) != 1:
+            resolved = False
+            continue
+
+        for i, weight in enumerate(weights):
+            if weight + '.prototxt' in models:
+                model = weight + '.prototxt'
+            elif len(models) == 1 and (
+                    models[0] is None or isinstance(models[0], str)):
+                model = models[0]
+            elif len(models) == len(weights):
+                # variants assigned in the same order
+                model = models[i]
+            else:
+                resolved = False
+                continue
+            items.append((weight, model, remotes[0]))
+    return items, resolved
+
+
+# ======================
+# Main functions
+# ======================
+
+def run_script(model):
+    model_dir = os.path.join(ROOT, model['category'], model['model'])
+    cmd = [sys.executable, model['model'] + '.py', '-b']
+    logger.info(f'run {model["category"]}/{model["model"]} -b')
+    proc = subprocess.run(
+        cmd, cwd=model_dir, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+    return proc.returncode == 0
+
+
+def main():
+    args = parser.parse_args()
+
+    model_list, _ = search_model(ROOT)
+    if args.models:
+        model_list = [
+            m for m in model_list
+            if m['model'] in args.models or m['category'] in args.models
+        ]
+
+    files = []
+    unresolved = []
+    for model in model_list:
+        model_dir = os.path.join(ROOT, model['category'], model['model'])
+        script = os.path.join(model_dir, model['model'] + '.py')
+        items, resolved = resolve_downloads(script)
+        if not resolved:
+            unresolved.append(model)
+        for weight, model_path, remote in items:
+            for name in (weight, model_path):
+                if name is not None:
+                    files.append((
+                        remote + os.path.basename(name),
+                        os.path.join(model_dir, name)))
+
+    logger.info(
+        f'{len(files)} files of {len(model_list)} models '
+        f'({len(unresolved)} models not fully resolved)')
+
+    if args.dry_run:
+        for url, path in files:
+            print(url, os.path.relpath(path, ROOT))
+        for model in unresolved:
+            print('unresolved', f'{model["category"]}/{model["model"]}')
+        return
+
+    params = dict(max_workers=args.jobs, progress=False)
+    if args.cache is not None:
+        params['cache_dir'] = args.cache or None
+    if args.mirror is not None:
+        params['mirror'] = args.mirror
+    if args.manifest is not None:
+        params['manifest_path'] = args.manifest
+    if args.refresh:
+        params['refresh'] = True
+    manager = download_utils.DownloadManager.from_env(**params)
+
+    # the files which fail are reported together at the end
+    missing = []
+
+    def download(item):
+        url, path = item
+        try:
+            manager.download(url, path)
+        except download_utils.DownloadError as e:
+            if e.code == 404:
+                # a combination of options which has no model
+                logger.info(f'not found : {url}')
+                missing.append(url)
+                return None
+            return f'{e}'
+        if args.verify and not manager.verify(url, path):
+            return f'checksum mismatch : {path}'
+        return None
+
+    with ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as executor:
+        errors = [e for e in executor.map(download, files) if e]
+    num_ok = len(files) - len(errors) - len(missing)
+
+    if args.run_unresolved:
+        for model in unresolved:
+            if not run_script(model):
+                errors.append(
+                    f'failed to run {model["category"]}/{model["model"]}')
+    elif unresolved:
+        logger.info(
+            'models to download with -b (or --run_unresolved): ' +
+            ', '.join(m['model'] for m in unresolved))
+
+    for e in errors:
+        logger.error(e)
+    logger.info(
+        f'{num_ok}/{len(files)} files prepared ({len(missing)} not found)')
+    if errors:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,5 @@
+# Runs every model script with -b. scripts/download_all_models.py downloads
+# the model files in parallel without running the models.
 export OPTION=-b
 cd ../
 cd action_recognition/mars; python3 mars.py ${OPTION}
@@ -9,10 +9,11 @@ ssl._create_default_https_context = ssl._create_unverified_context
 
 # import original modules
 sys.path.append('../../util')
-from image_utils import load_image, get_image_shape  # noqa: E402
 from utils import get_base_parser, update_parser, get_savepath  # noqa: E402
 import webcamera_utils  # noqa: E402
 from model_utils import check_and_download_models  # noqa: E402
+from tiling_utils import tiled_predict  # noqa: E402
+from benchmark_utils import Benchmark  # noqa: E402
 
 # logger
 from logging import getLogger   # noqa: E402
@@ -39,6 +40,19 @@ parser.add_argument(
     action='store_true',
     help='execute bilinear version.'
 )
+parser.add_argument(
+    '--tile_size', type=int, default=128,
+    help='Size of the tiles fed to the model. ' +
+         '0 feeds the whole image at once (needs much memory for large images).'
+)
+parser.add_argument(
+    '--tile_overlap', type=int, default=16,
+    help='Overlap of the tiles in pixels'
+)
+parser.add_argument(
+    '--tile_batch', type=int, default=4,
+    help='Number of tiles per inference'
+)
 args = update_parser(parser)
 
 
@@ -54,54 +68,67 @@ MODEL_PATH = 'edsr_scale' + args.scale + '.onnx.prototxt'
 # Main functions
 # ======================
 
+def super_resolve(net, input_data):
+    if args.tile_size <= 0:
+        net.set_input_shape(input_data.shape)
+        return net.predict(input_data)[0]
+
+    return tiled_predict(
+        net, input_data, args.tile_size,
+        overlap=args.tile_overlap, batch_size=args.tile_batch,
+        scale=int(args.scale)
+    )[0]
+
+
 def recognize_from_image():
     if args.bilinear:
         logger.error('bilinear mode only supporting in video input')
         return
 
     # net initialize
-    net = ailia.Net(MODEL_PATH, WEIGHT_PATH, env_id=-1)
+    net = ailia.Net(MODEL_PATH, WEIGHT_PATH, env_id=args.env_id)
     logger.info(IMAGE_PATH)
 
+    bench = Benchmark.from_args(args, name='edsr')
     for image_path in args.input:
-
-        IMAGE_HEIGHT, IMAGE_WIDTH = get_image_shape(image_path)
-
-        # prepare input data
         logger.info(image_path)
-        input_data = load_image(
-            image_path,
-            (IMAGE_HEIGHT, IMAGE_WIDTH),
-            gen_input_ailia=True,
-            normalize_type='None'
-        )
-        net.set_input_shape((1,3,IMAGE_HEIGHT,IMAGE_WIDTH))
+        savepath = get_savepath(args.savepath, image_path, ext='.png')
+
+        def process():
+            # prepare input data
+            with bench.stage('decode'):
+                img = cv2.imread(image_path)
+            with bench.stage('preprocess'):
+                img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+                input_data = img.transpose(2, 0, 1)[np.newaxis]
+
+            # inference
+            with bench.stage('inference'):
+                preds_ailia = super_resolve(net, input_data)
+
+            # postprocessing
+            with bench.stage('postprocess'):
+                output_img = preds_ailia.transpose(1, 2, 0)
+                output_img = np.clip(output_img, 0, 255)
+                output_img = cv2.cvtColor(output_img, cv2.COLOR_RGB2BGR)
+            with bench.stage('render'):
+                cv2.imwrite(savepath, output_img)
 
-        # inference
         logger.info('Start inference...')
         if args.benchmark:
             logger.info('BENCHMARK mode')
-            for i in range(5):
-                start = int(round(time.time() * 1000))
-                preds_ailia = net.predict(input_data)
-                end = int(round(time.time() * 1000))
-                logger.info(f'\tailia processing time {end - start} ms')
+            bench.run(process, args.benchmark_count)
         else:
-            preds_ailia = net.predict(input=input_data)[0]
-
-        # postprocessing
-        output_img = preds_ailia.transpose(1, 2, 0)
-        output_img = np.clip(output_img, 0, 255)
-        output_img = cv2.cvtColor(output_img, cv2.COLOR_RGB2BGR)
-        savepath = get_savepath(args.savepath, image_path, ext='.png')
+            process()
         logger.info(f'saved at : {savepath}')
-        cv2.imwrite(savepath, output_img)
+
+    bench.finish(args.benchmark_output)
     logger.info('Script finished successfully.')
 
 
 def recognize_from_video():
     # net initialize
-    net = ailia.Net(MODEL_PATH, WEIGHT_PATH, env_id=-1)
+    net = ailia.Net(MODEL_PATH, WEIGHT_PATH, env_id=args.env_id)
 
     capture = webcamera_utils.get_capture(args.video)
 
@@ -132,10 +159,9 @@ def recognize_from_video():
             input_image, input_data = webcamera_utils.preprocess_frame(
                 frame, IMAGE_HEIGHT, IMAGE_WIDTH, normalize_type='None'
             )
-            net.set_input_shape((1,3,IMAGE_HEIGHT,IMAGE_WIDTH))
 
             # Inference
-            preds_ailia = net.predict(input_data)[0] 
+            preds_ailia = super_resolve(net, input_data)
 
             # Postprocessing
             output_img = preds_ailia.transpose(1, 2, 0)
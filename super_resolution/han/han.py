@@ -13,6 +13,7 @@ from utils import get_base_parser, update_parser, get_savepath  # noqa: E402
 from model_utils import check_and_download_models  # noqa: E402
 from image_utils import load_image  # noqa: E402
 import webcamera_utils  # noqa: E402
+from tiling_utils import tiled_predict  # noqa: E402
 
 # logger
 from logging import getLogger   # noqa: E402
@@ -48,6 +49,19 @@ parser.add_argument(
           'but with this option, you can switch to the model trained on images degraded with the Blur-downscale Degradation Model (BD). ' +
           'A scale of 3 can only be used in combination with this option.')
 )
+parser.add_argument(
+    '--tile_size', type=int, default=128,
+    help='Size of the tiles fed to the model. ' +
+         '0 feeds the whole image at once (needs much memory for large images).'
+)
+parser.add_argument(
+    '--tile_overlap', type=int, default=16,
+    help='Overlap of the tiles in pixels'
+)
+parser.add_argument(
+    '--tile_batch', type=int, default=4,
+    help='Number of tiles per inference'
+)
 args = update_parser(parser)
 
 
@@ -108,6 +122,19 @@ def quantize(img, rgb_range):
     aux = np.around(aux)
     return aux / pixel_range
 
+
+def super_resolve(net, img):
+    if args.tile_size <= 0:
+        net.set_input_shape(img.shape)
+        return net.predict(img)
+
+    return tiled_predict(
+        net, img, args.tile_size,
+        overlap=args.tile_overlap, batch_size=args.tile_batch,
+        scale=args.scale
+    )
+
+
 def recognize_from_image(net):
     # input image loop
     for image_path in args.input:
@@ -127,20 +154,17 @@ def recognize_from_image(net):
 
         img = img[np.newaxis, :, :, :] # (batch_size, channel, h, w)
 
-        # Ailia Net input
-        net.set_input_shape((1, 3, img.shape[3], img.shape[2]))
-
         # inference
         logger.info('Start inference...')
         if args.benchmark:
             logger.info('BENCHMARK mode')
             for i in range(5):
                 start = int(round(time.time() * 1000))
-                preds_ailia = net.predict(img)
+                preds_ailia = super_resolve(net, img)
                 end = int(round(time.time() * 1000))
                 logger.info(f'\tailia processing time {end - start} ms')
         else:
-            preds_ailia = net.predict(img)
+            preds_ailia = super_resolve(net, img)
 
         # postprocessing
         output_img = quantize(preds_ailia[0], 255)
@@ -176,11 +200,9 @@ def recognize_from_video(net):
         img = img[np.newaxis, :, :, :] # (batch_size, channel, h, w)
         img = img.astype(np.float32)
 
-        net.set_input_shape((1, 3, IMAGE_HEIGHT, IMAGE_WIDTH))
-
-        output = net.run(img)
+        output = super_resolve(net, img)
 
-        out_img = quantize(output[0][0], 255)
+        out_img = quantize(output[0], 255)
         out_img = out_img.astype(np.uint8).transpose(1, 2, 0)
         cv2.imshow('output', out_img)
 
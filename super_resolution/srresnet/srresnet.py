@@ -12,6 +12,7 @@ from utils import get_base_parser, update_parser, get_savepath  # noqa: E402
 from model_utils import check_and_download_models  # noqa: E402
 from image_utils import load_image  # noqa: E402
 import webcamera_utils  # noqa: E402
+from tiling_utils import tiled_predict  # noqa: E402
 
 # logger
 from logging import getLogger   # noqa: E402
@@ -45,6 +46,14 @@ parser.add_argument(
     help=('Instead of resizing input image when loading it, ' +
           ' padding input and output image')
 )
+parser.add_argument(
+    '--tile_overlap', type=int, default=8,
+    help='Overlap of the tiles in pixels (padding mode and video mode)'
+)
+parser.add_argument(
+    '--tile_batch', type=int, default=4,
+    help='Number of tiles per inference (padding mode and video mode)'
+)
 args = update_parser(parser)
 
 
@@ -101,51 +110,26 @@ def recognize_from_image():
 
 def tiling(net, img):
     h, w = img.shape[0], img.shape[1]
-
-    padding_w = int((w + IMAGE_WIDTH - 1) / IMAGE_WIDTH) * IMAGE_WIDTH
-    padding_h = int((h+IMAGE_HEIGHT-1) / IMAGE_HEIGHT) * IMAGE_HEIGHT
     scale = int(OUTPUT_HEIGHT / IMAGE_HEIGHT)
-    output_padding_w = padding_w * scale
-    output_padding_h = padding_h * scale
-    output_w = w * scale
-    output_h = h * scale
 
     logger.debug(f'input image : {h}x{w}')
-    logger.debug(f'output image : {output_w}x{output_h}')
+    logger.debug(f'output image : {w * scale}x{h * scale}')
 
     img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-    img = img / 255.0
+    img = img.astype(np.float32) / 255.0
     img = img.transpose(2, 0, 1)
-    img = img[np.newaxis, :, :, :]
-
-    pad_img = np.zeros((1, 3, padding_h, padding_w))
-    pad_img[:, :, 0:h, 0:w] = img
-
-    output_pad_img = np.zeros((1, 3, output_padding_h, output_padding_w))
-    tile_x = int(padding_w / IMAGE_WIDTH)
-    tile_y = int(padding_h / IMAGE_HEIGHT)
 
     # Inference
     start = int(round(time.time() * 1000))
-    for y in range(tile_y):
-        for x in range(tile_x):
-            output_pad_img[
-                :,
-                :,
-                y*OUTPUT_HEIGHT:(y+1)*OUTPUT_HEIGHT,
-                x*OUTPUT_WIDTH:(x+1)*OUTPUT_WIDTH
-            ] = net.predict(pad_img[
-                :,
-                :,
-                y*IMAGE_HEIGHT:(y+1)*IMAGE_HEIGHT,
-                x*IMAGE_WIDTH:(x+1)*IMAGE_WIDTH
-            ])
+    output_img = tiled_predict(
+        net, img, (IMAGE_HEIGHT, IMAGE_WIDTH),
+        overlap=args.tile_overlap, batch_size=args.tile_batch, scale=scale
+    )
     end = int(round(time.time() * 1000))
     logger.info(f'ailia processing time {end - start} ms')
 
     # Postprocessing
-    output_img = output_pad_img[0, :, :output_h, :output_w]
-    output_img = output_img.transpose(1, 2, 0).astype(np.float32)
+    output_img = output_img[0].transpose(1, 2, 0)
     output_img = cv2.cvtColor(output_img, cv2.COLOR_RGB2BGR)
 
     return output_img
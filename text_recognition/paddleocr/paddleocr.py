@@ -9,6 +9,7 @@ import math
 import time
 from PIL import Image, ImageDraw, ImageFont
 import unicodedata
+from concurrent.futures import ThreadPoolExecutor
 
 import ailia
 
@@ -17,6 +18,7 @@ import ailia
 sys.path.append('../../util')
 from utils import get_base_parser, update_parser  # noqa: E402
 from model_utils import check_and_download_models  # noqa: E402
+from text_box_utils import db_boxes_from_bitmap  # noqa: E402
 import webcamera_utils  # noqa: E402
 
 # logger
@@ -141,6 +143,8 @@ def get_default_config():
     dc['rec_bbox_padding'] = 0.1
     dc['limited_max_width'] = 1280
     dc['limited_min_width'] = 16
+    dc['rec_width_buckets'] = (80, 160, 320, 640, 1280)
+    dc['crop_workers'] = 4
 
     # params for text classifier
     dc['use_angle_cls'] = True
@@ -405,151 +409,12 @@ class DBPostProcess(object):
         _bitmap: single map with shape (1, H, W),
                 whose values are binarized as {0, 1}
         '''
-
-        bitmap = _bitmap
-        height, width = bitmap.shape
-
-        outs = cv2.findContours((bitmap * 255).astype(np.uint8), cv2.RETR_LIST,
-                                cv2.CHAIN_APPROX_SIMPLE)
-        if len(outs) == 3:
-            img, contours, _ = outs[0], outs[1], outs[2]
-        elif len(outs) == 2:
-            contours, _ = outs[0], outs[1]
-
-        num_contours = min(len(contours), self.max_candidates)
-
-        boxes = []
-        scores = []
-        for index in range(num_contours):
-            contour = contours[index]
-            points, sside = self.get_mini_boxes(contour)
-            if sside < self.min_size:
-                continue
-            points = np.array(points)
-            score = self.box_score_fast(pred, points.reshape(-1, 2))
-            if self.box_thresh > score:
-                continue
-
-            box = self.unclip(points).reshape(-1, 1, 2)
-            box, sside = self.get_mini_boxes(box)
-            if sside < self.min_size + 2:
-                continue
-            box = np.array(box)
-
-            box[:, 0] = np.clip(
-                np.round(box[:, 0] / width * dest_width), 0, dest_width)
-            box[:, 1] = np.clip(
-                np.round(box[:, 1] / height * dest_height), 0, dest_height)
-            boxes.append(box.astype(np.int16))
-            scores.append(score)
-        return np.array(boxes, dtype=np.int16), scores
-
-    def xyrotate(self, coord_xy, angle, center_xy):
-        # exec rotate
-        rotation_matrix = cv2.getRotationMatrix2D((center_xy[0], center_xy[1]), angle, 1)
-        # make variable for output
-        coord_xy_rotated = np.zeros(np.shape(coord_xy))
-        # loop of coordinate
-        for coord_i in range(len(coord_xy)):
-            # set x, y
-            coord_x_tmp = coord_xy[coord_i, 0]
-            coord_y_tmp = coord_xy[coord_i, 1]
-            # slide to suit center of rotation
-            coord_x_tmp -= center_xy[0]
-            coord_y_tmp -= center_xy[1]
-            # exec rotation
-            coord_xy_tmp        = np.array([coord_x_tmp, coord_y_tmp])[:, np.newaxis]
-            rotation_matrix_tmp = np.array([[np.cos(-angle/180*np.pi), 
-                                            -np.sin(-angle/180*np.pi)], 
-                                            [np.sin(-angle/180*np.pi), 
-                                            np.cos(-angle/180*np.pi)]])
-            coord_xy_tmp        = rotation_matrix_tmp @ coord_xy_tmp
-            # re-slide to suit center of rotation
-            coord_xy_tmp     = coord_xy_tmp.reshape(-1)
-            coord_xy_tmp[0] += center_xy[0]
-            coord_xy_tmp[1] += center_xy[1]
-            # stock
-            coord_xy_rotated[coord_i, :] = coord_xy_tmp
-
-        return coord_xy_rotated
-
-    def unclip(self, box):
-        unclip_ratio = self.unclip_ratio
-        poly_area = (np.sqrt(np.sum((box[0, :] - box[1, :])**2)) * 
-                     np.sqrt(np.sum((box[0, :] - box[3, :])**2)))
-        poly_length = (np.sqrt(np.sum((box[0, :] - box[1, :])**2)) + 
-                       np.sqrt(np.sum((box[0, :] - box[3, :])**2))) * 2
-        distance = poly_area * unclip_ratio / poly_length
-        # calc angle between upper side of bbox with x axis
-        u = box[1] - box[0]
-        v = box[1] - box[0]
-        v[1] = 0
-        i = np.inner(u, v)
-        n = np.linalg.norm(u) * np.linalg.norm(v)
-        c = i / n
-        angle = np.rad2deg(np.arccos(np.clip(c, -1.0, 1.0)))
-        # exec coordinates rotation 
-        box_ = self.xyrotate(coord_xy=box, angle=angle, 
-                             center_xy=np.mean(box, axis=0))
-        # calculate circle coordinates
-        pitch = 10
-        x_upper = np.cos(np.arange(1, 0, (-1/pitch)) * np.pi) * distance
-        y_upper = -np.sqrt(distance**2 - x_upper**2)
-        x_lower = np.cos(np.arange(0, 1, (1/pitch)) * np.pi) * distance
-        y_lower = np.sqrt(distance**2 - x_lower**2)
-        x = np.concatenate([x_upper, x_lower])
-        y = np.concatenate([y_upper, y_lower])
-        circle = np.concatenate([x[:, np.newaxis], y[:, np.newaxis]], axis=1)
-        # calculate circle coordinates around four corners
-        expanded = []
-        for box_tmp in box_:
-            expanded.append(circle + box_tmp)
-        expanded = np.array(expanded).reshape(-1, 2)
-        # narrow down circle coordinates to outside 
-        expanded = expanded[[25, 26, 27, 28, 29, 30, 50, 51, 52, 53, 54, 55, 
-                             75, 76, 77, 78, 79, 60,  0,  1,  2,  3,  4,  5]]
-        # exec coordinates re-rotation 
-        expanded = self.xyrotate(coord_xy=expanded, angle=-angle, 
-                                 center_xy=np.mean(box_, axis=0))
-        expanded = np.round(expanded).astype(np.int64)
-        return expanded
-
-    def get_mini_boxes(self, contour):
-        bounding_box = cv2.minAreaRect(contour)
-        points = sorted(list(cv2.boxPoints(bounding_box)), key=lambda x: x[0])
-
-        index_1, index_2, index_3, index_4 = 0, 1, 2, 3
-        if points[1][1] > points[0][1]:
-            index_1 = 0
-            index_4 = 1
-        else:
-            index_1 = 1
-            index_4 = 0
-        if points[3][1] > points[2][1]:
-            index_2 = 2
-            index_3 = 3
-        else:
-            index_2 = 3
-            index_3 = 2
-
-        box = [
-            points[index_1], points[index_2], points[index_3], points[index_4]
-        ]
-        return box, min(bounding_box[1])
-
-    def box_score_fast(self, bitmap, _box):
-        h, w = bitmap.shape[:2]
-        box = _box.copy()
-        xmin = np.clip(np.floor(box[:, 0].min()).astype(np.int), 0, w - 1)
-        xmax = np.clip(np.ceil(box[:, 0].max()).astype(np.int), 0, w - 1)
-        ymin = np.clip(np.floor(box[:, 1].min()).astype(np.int), 0, h - 1)
-        ymax = np.clip(np.ceil(box[:, 1].max()).astype(np.int), 0, h - 1)
-
-        mask = np.zeros((ymax - ymin + 1, xmax - xmin + 1), dtype=np.uint8)
-        box[:, 0] = box[:, 0] - xmin
-        box[:, 1] = box[:, 1] - ymin
-        cv2.fillPoly(mask, box.reshape(1, -1, 2).astype(np.int32), 1)
-        return cv2.mean(bitmap[ymin:ymax + 1, xmin:xmax + 1], mask)[0]
+        return db_boxes_from_bitmap(
+            pred, _bitmap, dest_width, dest_height,
+            box_thresh=self.box_thresh,
+            max_candidates=self.max_candidates,
+            unclip_ratio=self.unclip_ratio,
+            min_size=self.min_size)
 
     def __call__(self, outs_dict, shape_list):
         pred = outs_dict['maps']
@@ -795,9 +660,12 @@ class TextDetector():
         starttime = time.time()
 
         # net initialize, Text Detection
-        if self.net==None or self.net.get_input_shape()!=img.shape:
+        # (reshape the net for a new image size instead of reloading it)
+        if self.net is None:
             self.net = ailia.Net(self.config['det_model_path']+'.prototxt',
                                  self.config['det_model_path'], env_id=self.env_id)
+        if tuple(self.net.get_input_shape()) != img.shape:
+            self.net.set_input_shape(img.shape)
         outputs = self.net.predict(img)
 
         preds = {}
@@ -852,7 +720,7 @@ class TextClassifier():
         return padding_im
 
     def __call__(self, img_list):
-        img_list = copy.deepcopy(img_list)
+        img_list = list(img_list)
         img_num = len(img_list)
         # Calculate the aspect ratio of all text bars
         width_list = []
@@ -864,29 +732,24 @@ class TextClassifier():
         cls_res = [['', 0.0]] * img_num
         batch_num = self.cls_batch_num
         elapse = 0
+
+        # net initialize, Detection Boxes Rectify
+        # (the input shape is fixed: the last batch is padded)
+        batch_shape = (batch_num, *self.cls_image_shape)
+        if self.net is None:
+            self.net = ailia.Net(self.cfg['cls_model_path']+'.prototxt',
+                                 self.cfg['cls_model_path'], env_id=self.env_id)
+            self.net.set_input_shape(batch_shape)
+
         for beg_img_no in range(0, img_num, batch_num):
             end_img_no = min(img_num, beg_img_no + batch_num)
-            norm_img_batch = []
-            max_wh_ratio = 0
-            for ino in range(beg_img_no, end_img_no):
-                h, w = img_list[indices[ino]].shape[0:2]
-                wh_ratio = w * 1.0 / h
-                max_wh_ratio = max(max_wh_ratio, wh_ratio)
-            for ino in range(beg_img_no, end_img_no):
-                norm_img = self.resize_norm_img(img_list[indices[ino]])
-                norm_img = norm_img[np.newaxis, :]
-                norm_img_batch.append(norm_img)
-            norm_img_batch = np.concatenate(norm_img_batch)
-            norm_img_batch = norm_img_batch.copy()
+            norm_img_batch = np.zeros(batch_shape, dtype=np.float32)
+            for i, ino in enumerate(range(beg_img_no, end_img_no)):
+                norm_img_batch[i] = self.resize_norm_img(img_list[indices[ino]])
             starttime = time.time()
 
-
-            # net initialize, Detection Boxes Rectify
-            if self.net==None or self.net.get_input_shape()!=norm_img_batch.shape:
-                self.net = ailia.Net(self.cfg['cls_model_path']+'.prototxt',
-                                     self.cfg['cls_model_path'], env_id=self.env_id)
-            self.net.set_input_shape(norm_img_batch.shape)
             prob_out = self.net.predict(norm_img_batch)
+            prob_out = prob_out[:end_img_no - beg_img_no]
 
             cls_result = self.postprocess_op(prob_out)
             elapse += time.time() - starttime
@@ -919,14 +782,43 @@ class TextRecognizer():
             "use_space_char": OCR_CFG['use_space_char']
         }
         self.postprocess_op = build_post_process(postprocess_params)
-        self.net = None
 
-    def resize_norm_img(self, img, max_wh_ratio):
-        imgC, imgH, imgW = self.rec_image_shape
-        assert imgC == img.shape[2]
+        # input widths of the net, each with its own net
+        buckets = [
+            max(min(w, self.limited_max_width), self.limited_min_width)
+            for w in OCR_CFG['rec_width_buckets']
+        ]
+        self.width_buckets = sorted(set(buckets) | {self.limited_max_width})
+        self.nets = {}
+
+    def get_net(self, width):
+        """
+        Net for the width bucket, created on the first use. The input
+        shape of each net is set once and never changes, so the nets stay
+        ready for the next batch of the same bucket.
+        """
+        if width not in self.nets:
+            imgC, imgH, _ = self.rec_image_shape
+            net = ailia.Net(self.config['rec_model_path']+'.prototxt',
+                            self.config['rec_model_path'], env_id=self.env_id)
+            net.set_input_shape((self.rec_batch_num, imgC, imgH, width))
+            self.nets[width] = net
+        return self.nets[width]
+
+    def get_bucket(self, wh_ratio):
+        """ Smallest bucket wide enough for a text bar of the aspect ratio """
+        imgW = self.rec_image_shape[2]
         if self.character_type == "ch":
-            imgW = int((32 * max_wh_ratio))
+            imgW = int((32 * wh_ratio))
         imgW = max(min(imgW, self.limited_max_width), self.limited_min_width)
+        for width in self.width_buckets:
+            if imgW <= width:
+                return width
+        return self.width_buckets[-1]
+
+    def resize_img(self, img, imgW):
+        imgC, imgH, _ = self.rec_image_shape
+        assert imgC == img.shape[2]
         h, w = img.shape[:2]
         ratio = w / float(h)
         ratio_imgH = math.ceil(imgH * ratio)
@@ -935,14 +827,23 @@ class TextRecognizer():
             resized_w = imgW
         else:
             resized_w = int(math.ceil(imgH * ratio))
-        resized_image = cv2.resize(img, (resized_w, imgH))
-        resized_image = resized_image.astype('float32')
-        resized_image = resized_image.transpose((2, 0, 1)) / 255
-        resized_image -= 0.5
-        resized_image /= 0.5
-        padding_im = np.zeros((imgC, imgH, imgW), dtype=np.float32)
-        padding_im[:, :, 0:resized_w] = resized_image
-        return padding_im
+        return cv2.resize(img, (resized_w, imgH))
+
+    def norm_img_batch(self, img_list, imgW):
+        """
+        Resize the text bars to the height of the net, and normalize them
+        into a (rec_batch_num, C, H, imgW) batch. The right of each bar
+        and the unused rows of the batch are padded with zeros.
+        """
+        imgC, imgH, _ = self.rec_image_shape
+        # 127.5 is 0 after normalization
+        batch = np.full(
+            (self.rec_batch_num, imgH, imgW, imgC), 127.5, dtype=np.float32)
+        for i, img in enumerate(img_list):
+            resized_image = self.resize_img(img, imgW)
+            batch[i, :, :resized_image.shape[1]] = resized_image
+        batch = batch.transpose((0, 3, 1, 2)) / 127.5 - 1
+        return np.ascontiguousarray(batch, dtype=np.float32)
 
     def __call__(self, img_list):
         img_num = len(img_list)
@@ -953,39 +854,31 @@ class TextRecognizer():
         # Sorting can speed up the recognition process
         indices = np.argsort(np.array(width_list))
 
-        # rec_res = []
+        # Group the sorted text bars by width bucket, so that the batches
+        # only use a few input shapes
+        groups = {}
+        for ino in indices:
+            bucket = self.get_bucket(width_list[ino])
+            groups.setdefault(bucket, []).append(ino)
+
         rec_res = [['', 0.0]] * img_num
         batch_num = self.rec_batch_num
         elapse = 0
-        for beg_img_no in range(0, img_num, batch_num):
-            end_img_no = min(img_num, beg_img_no + batch_num)
-            norm_img_batch = []
-            max_wh_ratio = 0
-            for ino in range(beg_img_no, end_img_no):
-                # h, w = img_list[ino].shape[0:2]
-                h, w = img_list[indices[ino]].shape[0:2]
-                wh_ratio = w * 1.0 / h
-                max_wh_ratio = max(max_wh_ratio, wh_ratio)
-            for ino in range(beg_img_no, end_img_no):
-                # norm_img = self.resize_norm_img(img_list[ino], max_wh_ratio)
-                norm_img = self.resize_norm_img(img_list[indices[ino]],
-                                                max_wh_ratio)
-                norm_img = norm_img[np.newaxis, :]
-                norm_img_batch.append(norm_img)
-            norm_img_batch = np.concatenate(norm_img_batch)
-            norm_img_batch = norm_img_batch.copy()
-            starttime = time.time()
-
-            # net initialize, Text Recognition
-            if self.net==None or self.net.get_input_shape()!=norm_img_batch.shape:
-                self.net = ailia.Net(self.config['rec_model_path']+'.prototxt',
-                                     self.config['rec_model_path'], env_id=self.env_id)
-            preds = self.net.predict(norm_img_batch)
-
-            rec_result = self.postprocess_op(preds)
-            for rno in range(len(rec_result)):
-                rec_res[indices[beg_img_no + rno]] = rec_result[rno]
-            elapse += time.time() - starttime
+        for width, group in groups.items():
+            net = self.get_net(width)
+            for beg_img_no in range(0, len(group), batch_num):
+                batch_indices = group[beg_img_no:beg_img_no + batch_num]
+                norm_img_batch = self.norm_img_batch(
+                    [img_list[ino] for ino in batch_indices], width)
+                starttime = time.time()
+
+                preds = net.predict(norm_img_batch)
+                preds = preds[:len(batch_indices)]
+
+                rec_result = self.postprocess_op(preds)
+                for rno in range(len(rec_result)):
+                    rec_res[batch_indices[rno]] = rec_result[rno]
+                elapse += time.time() - starttime
         return rec_res, elapse
 
 
@@ -1000,6 +893,9 @@ class TextSystem(object):
         self.drop_score = OCR_CFG['drop_score']
         if self.use_angle_cls:
             self.text_classifier = TextClassifier(OCR_CFG, env_id)
+        # cv2 releases the GIL, so the crops are warped in parallel
+        self.crop_executor = ThreadPoolExecutor(
+            max_workers=OCR_CFG['crop_workers'])
 
     def get_rotate_crop_image(self, img, points):
         '''
@@ -1034,14 +930,16 @@ class TextSystem(object):
             dst_img = np.rot90(dst_img)
         return dst_img
 
-    def __call__(self, img):
+    def detect(self, img):
+        """
+        Detect the text boxes of the image, and crop the text bars.
+        """
         ori_im = img.copy()
         dt_boxes, elapse = self.text_detector(img)
-        logger.info("dt_boxes num : {}, elapse : {}".format(
-            len(dt_boxes), elapse))
         if dt_boxes is None:
             return None, None
-        img_crop_list = []
+        logger.info("dt_boxes num : {}, elapse : {}".format(
+            len(dt_boxes), elapse))
 
         dt_boxes = sorted_boxes(dt_boxes)
 
@@ -1063,10 +961,18 @@ class TextSystem(object):
             dt_boxes[:, 1, :] -= padding_vec
             dt_boxes[:, 3, :] += padding_vec
 
-        for bno in range(len(dt_boxes)):
-            tmp_box = copy.deepcopy(dt_boxes[bno])
-            img_crop = self.get_rotate_crop_image(ori_im, tmp_box)
-            img_crop_list.append(img_crop)
+        img_crop_list = list(self.crop_executor.map(
+            lambda box: self.get_rotate_crop_image(ori_im, box.copy()),
+            dt_boxes))
+        return dt_boxes, img_crop_list
+
+    def recognize(self, dt_boxes, img_crop_list):
+        """
+        Classify the angle of the text bars, recognize them, and drop
+        the results below `drop_score`.
+        """
+        if dt_boxes is None:
+            return None, None
         if self.use_angle_cls:
             img_crop_list, angle_list, elapse = self.text_classifier(
                 img_crop_list)
@@ -1084,6 +990,32 @@ class TextSystem(object):
                 filter_rec_res.append(rec_reuslt)
         return filter_boxes, filter_rec_res
 
+    def __call__(self, img):
+        dt_boxes, img_crop_list = self.detect(img)
+        return self.recognize(dt_boxes, img_crop_list)
+
+    def pipeline(self, images):
+        """
+        OCR of a sequence of images. The text of the next image is
+        detected in a background thread while the text bars of the
+        current image are classified and recognized.
+
+        Yields
+        ------
+        (img, dt_boxes, rec_res) for each image
+        """
+        images = iter(images)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            img = next(images, None)
+            future = None if img is None else executor.submit(self.detect, img)
+            while future is not None:
+                dt_boxes, img_crop_list = future.result()
+                cur_img = img
+                img = next(images, None)
+                future = None if img is None else executor.submit(self.detect, img)
+                dt_boxes, rec_res = self.recognize(dt_boxes, img_crop_list)
+                yield cur_img, dt_boxes, rec_res
+
 
 def sorted_boxes(dt_boxes):
     """
@@ -1177,12 +1109,13 @@ def adjust_half_and_full(txts):
 
 def recognize_from_image(config, text_sys):
 
-    for img_path in args.input:
-        # read image
-        img = cv2.imread(img_path)
+    # read the images one by one while the previous ones are processed
+    images = (cv2.imread(img_path) for img_path in args.input)
 
-        # exec ocr
-        dt_boxes, rec_res = text_sys(img)
+    # exec ocr
+    for img, dt_boxes, rec_res in text_sys.pipeline(images):
+        if dt_boxes is None:
+            continue
 
         image = Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
         boxes = dt_boxes
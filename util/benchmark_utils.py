@@ -0,0 +1,378 @@
+import os
+import csv
+import json
+import time
+import atexit
+import threading
+import functools
+from contextlib import contextmanager
+
+import numpy as np
+
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+STAGES = ('decode', 'preprocess', 'inference', 'postprocess', 'render')
+PERCENTILES = (50, 90, 99)
+CSV_FIELDS = (
+    'name', 'env_id', 'stage', 'count',
+    'mean_ms', 'min_ms', 'max_ms', 'p50_ms', 'p90_ms', 'p99_ms',
+    'throughput',
+)
+
+
+def stage_stats(samples_ns):
+    """
+    Statistics of the timings of a stage.
+
+    Parameters
+    ----------
+    samples_ns: list of int
+        timings in nanoseconds
+
+    Returns
+    -------
+    dict
+        count, mean, min, max and percentiles in milliseconds
+    """
+    samples = np.asarray(samples_ns, dtype=np.float64) / 1e6
+    stats = {'count': len(samples)}
+    if len(samples) == 0:
+        return stats
+    stats['mean_ms'] = float(samples.mean())
+    stats['min_ms'] = float(samples.min())
+    stats['max_ms'] = float(samples.max())
+    for p, v in zip(PERCENTILES, np.percentile(samples, PERCENTILES)):
+        stats['p%d_ms' % p] = float(v)
+    return stats
+
+
+class Benchmark:
+    """
+    Per-stage timer of a model script.
+
+    Each iteration of the benchmark is wrapped in `iteration()`, and the
+    stages inside it in `stage(name)`. Timings are measured with
+    `time.perf_counter_ns`. The first `warmup` iterations are run but
+    not recorded. A stage entered several times in an iteration (e.g.
+    tiles or batches) is summed.
+
+    When `enabled` is False, `stage` and `iteration` do nothing, so the
+    scripts can keep the instrumentation in the normal path.
+
+    The inference calls of the sessions are also timed by `time_sessions`.
+    In a script without iterations, each call is a sample of the
+    'inference' stage of its session ('inference_1', 'inference_2'...
+    when there are several), and the first `warmup` calls of each
+    session are not recorded.
+
+    Parameters
+    ----------
+    name: str
+        model name written in the results
+    warmup: int
+        number of iterations excluded from the statistics
+    env_id: int
+    enabled: bool
+    """
+
+    def __init__(self, name='', warmup=1, env_id=None, enabled=True):
+        self.name = name
+        self.warmup = warmup
+        self.env_id = env_id
+        self.enabled = enabled
+        self.samples = {}
+        self.totals = []
+        self.num_iterations = 0
+        self.calls = {}
+        self.finished = False
+        self._current = None
+        self._stage_depth = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_args(cls, args, name=''):
+        """
+        Benchmark configured by the common arguments of `get_base_parser`.
+        The benchmark of the process is returned if `update_parser` has
+        created it.
+        """
+        if _benchmark is not None:
+            if name:
+                _benchmark.name = name
+            return _benchmark
+        return cls(
+            name=name,
+            warmup=getattr(args, 'benchmark_warmup', 1),
+            env_id=getattr(args, 'env_id', None),
+            enabled=getattr(args, 'benchmark', False),
+        )
+
+    @property
+    def recording(self):
+        return self.enabled and self.num_iterations > self.warmup
+
+    @contextmanager
+    def iteration(self):
+        if not self.enabled:
+            yield
+            return
+        self.num_iterations += 1
+        self._current = {}
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            total = time.perf_counter_ns() - start
+            if self.recording:
+                self.totals.append(total)
+                for stage, ns in self._current.items():
+                    self.samples.setdefault(stage, []).append(ns)
+            self._current = None
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        self._stage_depth += 1
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self._stage_depth -= 1
+            self.record(name, time.perf_counter_ns() - start)
+
+    def record(self, name, ns):
+        """
+        Add a timing measured elsewhere to the current iteration.
+        """
+        if self._current is None:
+            # outside of an iteration: one sample per call
+            if self.enabled:
+                self.samples.setdefault(name, []).append(ns)
+            return
+        self._current[name] = self._current.get(name, 0) + ns
+
+    def record_call(self, session, ns):
+        """
+        Add the timing of an inference call of `session`.
+        """
+        if not self.enabled or self._stage_depth > 0:
+            # already in a stage of the script
+            return
+        if self._current is not None:
+            self.record('inference', ns)
+            return
+        with self._lock:
+            calls = self.calls.setdefault(id(session), [0, []])
+            calls[0] += 1
+            if calls[0] > self.warmup:
+                calls[1].append(ns)
+
+    def run(self, func, count):
+        """
+        Call `func()` for `warmup + count` iterations.
+
+        Returns
+        -------
+        the result of the last call
+        """
+        result = None
+        for _ in range(self.warmup + count):
+            with self.iteration():
+                result = func()
+        return result
+
+    # -------------------------------------------------------------------------
+    # results
+    # -------------------------------------------------------------------------
+    def summary(self):
+        """
+        Returns
+        -------
+        dict
+            name, env_id, iterations, warmup, per-stage statistics, total
+            statistics and throughput (iterations per second)
+        """
+        samples = self.samples
+        if self.num_iterations > 0:
+            timing = 'iterations'
+            totals = self.totals
+        else:
+            # script without iterations: the session calls
+            timing = 'session_calls'
+            sessions = [s for _, s in self.calls.values()]
+            if len(sessions) == 1:
+                samples = dict(samples, inference=sessions[0])
+            else:
+                samples = dict(samples, **{
+                    'inference_%d' % (i + 1): s
+                    for i, s in enumerate(sessions)})
+            totals = [ns for s in sessions for ns in s]
+        stages = [s for s in STAGES if s in samples] + \
+            [s for s in samples if s not in STAGES]
+        total = stage_stats(totals)
+        throughput = None
+        if totals:
+            throughput = len(totals) / (sum(totals) / 1e9)
+        return {
+            'name': self.name,
+            'env_id': self.env_id,
+            'timing': timing,
+            'iterations': len(totals),
+            'warmup': self.warmup,
+            'stages': {s: stage_stats(samples[s]) for s in stages},
+            'total': total,
+            'throughput': throughput,
+        }
+
+    def log_summary(self):
+        summary = self.summary()
+        logger.info(
+            f'benchmark: {summary["iterations"]} iterations '
+            f'(+{summary["warmup"]} warmup)')
+        rows = list(summary['stages'].items()) + [('total', summary['total'])]
+        for stage, stats in rows:
+            if stats['count'] == 0:
+                continue
+            logger.info(
+                f'\t{stage:<12s} mean {stats["mean_ms"]:9.3f} ms  '
+                f'p50 {stats["p50_ms"]:9.3f}  p90 {stats["p90_ms"]:9.3f}  '
+                f'p99 {stats["p99_ms"]:9.3f}')
+        if summary['throughput'] is not None:
+            logger.info(f'\tthroughput   {summary["throughput"]:.3f} it/s')
+
+    def save(self, path):
+        """
+        Save the summary as .json, or as .csv (one row per stage).
+        """
+        summary = self.summary()
+        if os.path.splitext(path)[1].lower() == '.csv':
+            write_csv(path, summary_rows(summary))
+        else:
+            dirname = os.path.dirname(path)
+            if dirname:
+                os.makedirs(dirname, exist_ok=True)
+            with open(path, 'w') as f:
+                json.dump(summary, f, indent=2)
+        logger.info(f'benchmark results saved at : {path}')
+
+    def finish(self, path=None):
+        """
+        Log the summary, and save it if `path` is given.
+        Only the first call does something.
+        """
+        if not self.enabled or self.finished:
+            return
+        self.finished = True
+        self.log_summary()
+        if path:
+            self.save(path)
+
+
+
+# =============================================================================
+# Session timing
+# =============================================================================
+# inference methods timed by `time_sessions`
+AILIA_SESSION_METHODS = (
+    ('Net', ('predict', 'run')),
+    ('Detector', ('compute',)),
+    ('Classifier', ('compute',)),
+    ('PoseEstimator', ('compute',)),
+)
+
+_benchmark = None
+_timing = threading.local()
+
+
+def _timed(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if _benchmark is None or getattr(_timing, 'active', False):
+            # not enabled, or called by another timed method
+            return method(self, *args, **kwargs)
+        _timing.active = True
+        start = time.perf_counter_ns()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            _timing.active = False
+            _benchmark.record_call(self, time.perf_counter_ns() - start)
+    wrapper._benchmark_timed = True
+    return wrapper
+
+
+def time_sessions():
+    """
+    Time the inference calls of the ailia and onnxruntime sessions.
+    """
+    targets = []
+    try:
+        import ailia
+        for name, methods in AILIA_SESSION_METHODS:
+            if hasattr(ailia, name):
+                targets.append((getattr(ailia, name), methods))
+    except ImportError:
+        pass
+    try:
+        import onnxruntime
+        targets.append((onnxruntime.InferenceSession, ('run',)))
+    except ImportError:
+        pass
+
+    for cls, methods in targets:
+        for method in methods:
+            func = getattr(cls, method, None)
+            if func is None or getattr(func, '_benchmark_timed', False):
+                continue
+            setattr(cls, method, _timed(func))
+
+
+def enable_benchmark(args, name=''):
+    """
+    Benchmark of the process, for the --benchmark mode of the scripts.
+
+    The inference calls of the sessions are timed, and the summary is
+    logged and saved to --benchmark_output at exit (or when the script
+    calls `finish`). The scripts which time their own stages get the
+    same benchmark from `Benchmark.from_args`.
+    """
+    global _benchmark
+    if _benchmark is None:
+        _benchmark = Benchmark.from_args(args, name=name)
+        time_sessions()
+        atexit.register(
+            _benchmark.finish, getattr(args, 'benchmark_output', None))
+    return _benchmark
+
+
+def summary_rows(summary, **extra):
+    """
+    Flatten a summary into CSV rows (one for each stage and the total).
+    """
+    rows = []
+    stages = list(summary['stages'].items()) + [('total', summary['total'])]
+    for stage, stats in stages:
+        row = {
+            'name': summary['name'], 'env_id': summary['env_id'],
+            'stage': stage, 'throughput': summary['throughput'],
+        }
+        row.update(stats)
+        row.update(extra)
+        rows.append(row)
+    return rows
+
+
+def write_csv(path, rows, fields=CSV_FIELDS):
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    fields = list(fields) + sorted(
+        {k for row in rows for k in row} - set(fields))
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        writer.writerows(rows)
@@ -0,0 +1,555 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import http.client
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: the downloads are only locked inside the process
+    fcntl = None
+
+# logger
+from logging import getLogger
+logger = getLogger(__name__)
+
+MODELS_BASE_URL = 'https://storage.googleapis.com/ailia-models/'
+
+# environment variables
+CACHE_ENV = 'AILIA_MODELS_CACHE'
+MIRROR_ENV = 'AILIA_MODELS_MIRROR'
+MANIFEST_ENV = 'AILIA_MODELS_MANIFEST'
+WORKERS_ENV = 'AILIA_MODELS_DOWNLOAD_WORKERS'
+REFRESH_ENV = 'AILIA_MODELS_REFRESH'
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser('~'), '.cache', 'ailia-models')
+
+CHUNK_SIZE = 1 << 20
+
+
+def get_cache_dir():
+    """
+    Content cache directory (None when `AILIA_MODELS_CACHE` is empty).
+    """
+    cache_dir = os.environ.get(CACHE_ENV, DEFAULT_CACHE_DIR)
+    return os.path.expanduser(cache_dir) if cache_dir else None
+
+
+def mirror_url(url, mirror=None):
+    """
+    Replace the ailia MODELS storage prefix of `url` by the `mirror` base
+    url (by default `AILIA_MODELS_MIRROR`). Other urls are unchanged.
+    """
+    if mirror is None:
+        mirror = os.environ.get(MIRROR_ENV)
+    if not mirror or not url.startswith(MODELS_BASE_URL):
+        return url
+    return mirror.rstrip('/') + '/' + url[len(MODELS_BASE_URL):]
+
+
+def manifest_key(url):
+    """
+    Key of a file in the manifest: the path relative to the storage, so
+    that a manifest is valid for every mirror.
+    """
+    if url.startswith(MODELS_BASE_URL):
+        return url[len(MODELS_BASE_URL):]
+    return url
+
+
+def file_sha256(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def file_stat(path):
+    """
+    Identity of the file at `path` (None when it does not exist).
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime_ns
+
+
+@contextmanager
+def file_lock(path):
+    """
+    Exclusive lock on `path` shared by all the processes of the machine.
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class DownloadError(RuntimeError):
+    """
+    Failed download. `code` is the HTTP status of a client error.
+    """
+
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+
+class Manifest:
+    """
+    sha256 and size of the downloaded files, keyed by `manifest_key`.
+
+    Files without an entry are recorded when they are first downloaded,
+    and the entries are checked on the next downloads. A manifest built
+    on a trusted machine can be pinned with `AILIA_MODELS_MANIFEST`.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def get(self, url):
+        with self._lock:
+            return self.entries.get(manifest_key(url))
+
+    def add(self, url, sha256, size):
+        entry = {'sha256': sha256, 'size': size}
+        with self._lock:
+            key = manifest_key(url)
+            if self.entries.get(key) == entry:
+                return
+            self.entries[key] = entry
+            if self.path is not None:
+                self._save()
+
+    def _save(self):
+        # merge the entries written by the other processes
+        dirname = os.path.dirname(self.path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        with file_lock(self.path + '.lock'):
+            if os.path.exists(self.path):
+                with open(self.path) as f:
+                    entries = json.load(f)
+                entries.update(self.entries)
+                self.entries = entries
+            tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(self.entries, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.path)
+
+
+class DownloadManager:
+    """
+    Downloader of the model files.
+
+    - The files are downloaded to a `.part` file and renamed when they are
+      complete and verified, so an interrupted download never leaves a
+      truncated file at the destination.
+    - An interrupted download is resumed with an HTTP range request, on
+      the next attempt or on the next run.
+    - The sha256 and size of each file are checked against the manifest.
+    - With a cache directory, the files are stored once by content
+      (`objects/<sha256>`) and symbolic links to them are created in the
+      model directories (hard links or copies where symbolic links are not
+      available). Without a cache directory, the files are downloaded to
+      the model directories.
+
+    Parameters
+    ----------
+    cache_dir: string
+        content cache directory (None: no cache)
+    mirror: string
+        base url replacing https://storage.googleapis.com/ailia-models/
+    manifest_path: string
+        manifest file (default: manifest.json of the cache directory)
+    max_workers: int
+        number of concurrent downloads of `download_all`
+    retries: int
+        number of attempts of a download
+    progress: bool
+        display a progress bar
+    refresh: bool
+        check the local files without a manifest entry against the size
+        given by the server (by default they are trusted without any
+        network access)
+    """
+
+    def __init__(
+            self, cache_dir=None, mirror=None, manifest_path=None,
+            max_workers=4, retries=3, timeout=60, progress=True,
+            refresh=False):
+        self.cache_dir = cache_dir
+        self.mirror = mirror
+        if manifest_path is None and cache_dir is not None:
+            manifest_path = os.path.join(cache_dir, 'manifest.json')
+        self.manifest = Manifest(manifest_path)
+        self.max_workers = max_workers
+        self.retries = retries
+        self.timeout = timeout
+        self.progress = progress
+        self.refresh = refresh
+
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        self._active = 0
+
+    @classmethod
+    def from_env(cls, **kwargs):
+        """
+        Download manager configured by the AILIA_MODELS_* variables.
+        """
+        params = dict(
+            cache_dir=get_cache_dir(),
+            mirror=os.environ.get(MIRROR_ENV),
+            manifest_path=os.environ.get(MANIFEST_ENV),
+            max_workers=int(os.environ.get(WORKERS_ENV, 4)),
+            refresh=os.environ.get(REFRESH_ENV, '') not in ('', '0'),
+        )
+        params.update(kwargs)
+        return cls(**params)
+
+    # -------------------------------------------------------------------------
+    # public
+    # -------------------------------------------------------------------------
+    def download(self, url, path):
+        """
+        Make `path` a verified copy (or link) of the file at `url`.
+
+        Returns
+        -------
+        bool
+            True when the file was fetched or linked, False when `path`
+            was already valid.
+        """
+        with self._thread_lock(os.path.abspath(path)):
+            if self.is_valid(url, path):
+                return False
+            logger.info(f'Downloading {os.path.basename(path)}... '
+                        f'(save path: {path})')
+            if self.cache_dir is None:
+                self._fetch(url, path)
+            else:
+                self._link(self._cached_object(url), path)
+            return True
+
+    def download_all(self, items):
+        """
+        Download the `(url, path)` items concurrently.
+
+        All the items are tried, and the first error is raised at the end.
+        """
+        items = list(dict((os.path.abspath(p), (u, p)) for u, p in items)
+                     .values())
+        if len(items) == 0:
+            return []
+        workers = max(min(self.max_workers, len(items)), 1)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(self.download, u, p) for u, p in items]
+        errors = [f.exception() for f in futures if f.exception()]
+        if errors:
+            raise errors[0]
+        return [f.result() for f in futures]
+
+    def verify(self, url, path):
+        """
+        Check the sha256 of `path` against the manifest.
+        """
+        entry = self.manifest.get(url)
+        if entry is None:
+            return True
+        return file_sha256(path) == entry['sha256']
+
+    # -------------------------------------------------------------------------
+    # local files
+    # -------------------------------------------------------------------------
+    @contextmanager
+    def _thread_lock(self, key):
+        with self._locks_lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            yield
+
+    @contextmanager
+    def _count_active(self):
+        # the progress bar is only displayed for a single download
+        with self._locks_lock:
+            self._active += 1
+            active = self._active
+        try:
+            yield active
+        finally:
+            with self._locks_lock:
+                self._active -= 1
+
+    def is_valid(self, url, path):
+        """
+        Check that `path` exists and has the size of the manifest.
+
+        A file without a manifest entry is trusted without any network
+        access, as the downloads only place complete files. With
+        `refresh`, such a file (for example left by an interrupted
+        download of a previous version) is checked against the size
+        given by the server, and recorded in the manifest when it
+        matches.
+        """
+        # a broken link does not exist
+        if not os.path.exists(path):
+            return False
+        size = os.path.getsize(path)
+        entry = self.manifest.get(url)
+        if entry is not None:
+            if size != entry['size']:
+                logger.warning(
+                    f'{path} does not match the manifest, download again')
+                return False
+            return True
+        if os.path.islink(path) or not self.refresh:
+            # the objects of the cache and the downloaded files are
+            # complete
+            return True
+
+        remote_size = self._remote_size(url)
+        if remote_size is None:
+            logger.warning(f'{path} could not be verified (offline ?)')
+            return True
+        if size != remote_size:
+            logger.warning(
+                f'{path} is incomplete ({size}/{remote_size} bytes), '
+                'download again')
+            return False
+        self.manifest.add(url, file_sha256(path), size)
+        return True
+
+    def _object_path(self, sha256):
+        return os.path.join(self.cache_dir, 'objects', sha256[:2], sha256)
+
+    def _cached_object(self, url):
+        entry = self.manifest.get(url)
+        if entry is not None:
+            obj = self._object_path(entry['sha256'])
+            if os.path.exists(obj) and os.path.getsize(obj) == entry['size']:
+                return obj
+
+        name = hashlib.sha1(manifest_key(url).encode()).hexdigest()
+        tmp_dir = os.path.join(self.cache_dir, 'tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+        part_path = os.path.join(tmp_dir, name + '.part')
+        with self._thread_lock(part_path), file_lock(part_path + '.lock'):
+            # another process may have finished it while waiting
+            entry = self.manifest.get(url)
+            if entry is not None:
+                obj = self._object_path(entry['sha256'])
+                if os.path.exists(obj):
+                    return obj
+            sha256, _ = self._download(url, part_path)
+            obj = self._object_path(sha256)
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            os.replace(part_path, obj)
+        return obj
+
+    def _fetch(self, url, path):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        part_path = path + '.part'
+        name = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+        lock_path = os.path.join(
+            tempfile.gettempdir(), f'ailia-models-{name}.lock')
+        # `path` was checked by the caller, it is only checked again if
+        # another process replaced it while waiting for the lock
+        before = file_stat(path)
+        with file_lock(lock_path):
+            if file_stat(path) != before and self.is_valid(url, path):
+                return
+            self._download(url, part_path)
+            if os.path.islink(path):
+                os.remove(path)
+            os.replace(part_path, path)
+
+    def _link(self, obj, path):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        if os.path.lexists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            os.symlink(os.path.abspath(obj), tmp_path)
+        except (OSError, NotImplementedError):
+            try:
+                os.link(obj, tmp_path)
+            except OSError:
+                shutil.copyfile(obj, tmp_path)
+        os.replace(tmp_path, path)
+
+    # -------------------------------------------------------------------------
+    # network
+    # -------------------------------------------------------------------------
+    def _remote_size(self, url):
+        """
+        Size of the file at `url` (None when it is not available).
+        """
+        src = mirror_url(url, self.mirror)
+        request = urllib.request.Request(src, method='HEAD')
+        try:
+            with urllib.request.urlopen(
+                    request, timeout=self.timeout) as response:
+                length = response.headers.get('Content-Length')
+        except (OSError, http.client.HTTPException):
+            return None
+        return int(length) if length is not None else None
+
+    def _download(self, url, part_path):
+        """
+        Download `url` to `part_path`, resuming the existing part.
+
+        Returns
+        -------
+        sha256: string
+        size: int
+        """
+        src = mirror_url(url, self.mirror)
+        entry = self.manifest.get(url)
+        error = None
+        for attempt in range(self.retries):
+            if attempt > 0:
+                time.sleep(min(2 ** attempt, 30))
+                logger.info(f'retry {attempt}/{self.retries - 1} : {src}')
+            try:
+                size = self._request(src, part_path, entry)
+            except urllib.error.HTTPError as e:
+                if e.code < 500:
+                    raise DownloadError(
+                        f'failed to download {src} : {e}', e.code)
+                error = e
+                continue
+            except (OSError, http.client.HTTPException) as e:
+                # resumed on the next attempt
+                error = e
+                continue
+
+            sha256 = file_sha256(part_path)
+            if entry is not None and (
+                    sha256 != entry['sha256'] or size != entry['size']):
+                error = DownloadError(f'checksum mismatch : {src}')
+                os.remove(part_path)
+                continue
+            if entry is None:
+                self.manifest.add(url, sha256, size)
+            return sha256, size
+
+        raise DownloadError(f'failed to download {src} : {error}')
+
+    def _request(self, src, part_path, entry):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) \
+            else 0
+        if entry is not None and offset > entry['size']:
+            offset = 0
+
+        request = urllib.request.Request(src)
+        if offset > 0:
+            request.add_header('Range', f'bytes={offset}-')
+        try:
+            response = urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            if e.code != 416:
+                raise
+            # range not satisfiable: the part is complete, or is not a
+            # part of this file
+            content_range = e.headers.get('Content-Range', '')
+            e.close()
+            if content_range == f'bytes */{offset}':
+                return offset
+            os.remove(part_path)
+            raise urllib.error.URLError('invalid partial download')
+
+        with response, self._count_active() as active:
+            show_progress = self.progress and active == 1
+            if response.status == 206:
+                mode = 'ab'
+            else:
+                # the server ignored the range
+                mode = 'wb'
+                offset = 0
+            length = response.headers.get('Content-Length')
+            total = offset + int(length) if length is not None else None
+
+            size = offset
+            with open(part_path, mode) as f:
+                while True:
+                    chunk = response.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    size += len(chunk)
+                    if show_progress and total:
+                        progress_print(size, 1, total)
+            if show_progress and total:
+                logger.info('\n')
+
+        if total is not None and size != total:
+            raise urllib.error.URLError(
+                f'incomplete download ({size}/{total} bytes)')
+        return size
+
+
+def progress_print(block_count, block_size, total_size):
+    """
+    Callback function to display the progress
+    (ref: https://qiita.com/jesus_isao/items/ffa63778e7d3952537db)
+
+    Parameters
+    ----------
+    block_count:
+    block_size:
+    total_size:
+    """
+    percentage = 100.0 * block_count * block_size / total_size
+    if percentage > 100:
+        # Bigger than 100 does not look good, so...
+        percentage = 100
+    max_bar = 50
+    bar_num = int(percentage / (100 / max_bar))
+    progress_element = '=' * bar_num
+    if bar_num != max_bar:
+        progress_element += '>'
+    bar_fill = ' '  # fill the blanks
+    bar = progress_element.ljust(max_bar, bar_fill)
+    total_size_kb = total_size / 1024
+    print(f'[{bar} {percentage:.2f}% ( {total_size_kb:.0f}KB )]', end='\r')
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_download_manager():
+    """
+    Process-wide download manager configured by the environment.
+    """
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = DownloadManager.from_env()
+        return _manager
@@ -0,0 +1,330 @@
+import numpy as np
+
+
+class KalmanStateStore:
+    """
+    Structure-of-arrays store of the Kalman filter states of many tracks.
+
+    The means and covariances of all tracks are kept in stacked arrays, so
+    that predict, update and gating run for all tracks in one shot.
+    The model is the constant velocity model of SORT / DeepSORT / ByteTrack.
+
+    The 8-dimensional state space
+
+        x, y, a, h, vx, vy, va, vh
+
+    contains the bounding box center position (x, y), aspect ratio a,
+    height h, and their respective velocities.
+
+    Parameters
+    ----------
+    capacity: int
+        Initial number of slots. The store grows automatically.
+    std_weight_position: float
+    std_weight_velocity: float
+        Motion and observation uncertainty relative to the box height.
+    """
+
+    ndim = 4
+
+    def __init__(
+            self, capacity=64,
+            std_weight_position=1. / 20, std_weight_velocity=1. / 160,
+    ):
+        ndim, dt = self.ndim, 1.
+
+        self._motion_mat = np.eye(2 * ndim, 2 * ndim)
+        for i in range(ndim):
+            self._motion_mat[i, ndim + i] = dt
+
+        self._std_weight_position = std_weight_position
+        self._std_weight_velocity = std_weight_velocity
+
+        self.means = np.zeros((capacity, 2 * ndim))
+        self.covariances = np.zeros((capacity, 2 * ndim, 2 * ndim))
+        self.in_use = np.zeros(capacity, dtype=bool)
+
+    def __len__(self):
+        return int(self.in_use.sum())
+
+    # -------------------------------------------------------------------------
+    # slot management
+    # -------------------------------------------------------------------------
+    def _grow(self, n):
+        capacity = len(self.in_use)
+        new_capacity = max(capacity * 2, capacity + n)
+        means = np.zeros((new_capacity,) + self.means.shape[1:])
+        covariances = np.zeros((new_capacity,) + self.covariances.shape[1:])
+        in_use = np.zeros(new_capacity, dtype=bool)
+        means[:capacity] = self.means
+        covariances[:capacity] = self.covariances
+        in_use[:capacity] = self.in_use
+        self.means, self.covariances, self.in_use = means, covariances, in_use
+
+    def allocate(self, means, covariances):
+        """
+        Store new states.
+
+        Parameters
+        ----------
+        means: ndarray
+            Nx8 mean vectors.
+        covariances: ndarray
+            Nx8x8 covariance matrices.
+
+        Returns
+        -------
+        ndarray
+            Slot index of each state.
+        """
+        means = np.asarray(means).reshape(-1, 2 * self.ndim)
+        n = len(means)
+        free = np.nonzero(~self.in_use)[0]
+        if len(free) < n:
+            self._grow(n - len(free))
+            free = np.nonzero(~self.in_use)[0]
+        slots = free[:n]
+        self.means[slots] = means
+        self.covariances[slots] = covariances
+        self.in_use[slots] = True
+        return slots
+
+    def release(self, slots):
+        self.in_use[np.asarray(slots, dtype=np.int64)] = False
+
+    # -------------------------------------------------------------------------
+    # batched Kalman filter
+    # -------------------------------------------------------------------------
+    def initiate(self, measurements):
+        """
+        Create tracks from unassociated measurements.
+
+        Parameters
+        ----------
+        measurements: ndarray
+            Nx4 bounding boxes (x, y, a, h).
+
+        Returns
+        -------
+        ndarray
+            Slot index of each new track. Unobserved velocities are
+            initialized to 0 mean.
+        """
+        measurements = np.asarray(measurements, dtype=np.float64)
+        measurements = measurements.reshape(-1, self.ndim)
+        n = len(measurements)
+        h = measurements[:, 3]
+
+        means = np.concatenate([measurements, np.zeros_like(measurements)], 1)
+        std = np.stack([
+            2 * self._std_weight_position * h,
+            2 * self._std_weight_position * h,
+            np.full(n, 1e-2),
+            2 * self._std_weight_position * h,
+            10 * self._std_weight_velocity * h,
+            10 * self._std_weight_velocity * h,
+            np.full(n, 1e-5),
+            10 * self._std_weight_velocity * h], axis=1)
+        covariances = _batch_diag(np.square(std))
+        return self.allocate(means, covariances)
+
+    def predict(self, slots):
+        """
+        Run Kalman filter prediction step on the given tracks in place.
+
+        Parameters
+        ----------
+        slots: array_like
+            Slot indices of the tracks.
+        """
+        slots = np.asarray(slots, dtype=np.int64)
+        if len(slots) == 0:
+            return
+
+        mean = self.means[slots]
+        h = mean[:, 3]
+        n = len(slots)
+        std = np.stack([
+            self._std_weight_position * h,
+            self._std_weight_position * h,
+            np.full(n, 1e-2),
+            self._std_weight_position * h,
+            self._std_weight_velocity * h,
+            self._std_weight_velocity * h,
+            np.full(n, 1e-5),
+            self._std_weight_velocity * h], axis=1)
+        motion_cov = _batch_diag(np.square(std))
+
+        F = self._motion_mat
+        self.means[slots] = mean @ F.T
+        self.covariances[slots] = F @ self.covariances[slots] @ F.T + \
+            motion_cov
+
+    def project(self, slots):
+        """
+        Project the state distributions to measurement space.
+
+        Returns
+        -------
+        (ndarray, ndarray)
+            Kx4 projected means and Kx4x4 projected covariances.
+        """
+        slots = np.asarray(slots, dtype=np.int64)
+        mean = self.means[slots]
+        h = mean[:, 3]
+        std = np.stack([
+            self._std_weight_position * h,
+            self._std_weight_position * h,
+            np.full(len(slots), 1e-1),
+            self._std_weight_position * h], axis=1)
+        innovation_cov = _batch_diag(np.square(std))
+
+        ndim = self.ndim
+        covariance = self.covariances[slots][:, :ndim, :ndim]
+        return mean[:, :ndim], covariance + innovation_cov
+
+    def update(self, slots, measurements):
+        """
+        Run Kalman filter correction step on the given tracks in place.
+
+        Parameters
+        ----------
+        slots: array_like
+            Slot indices of the tracks.
+        measurements: ndarray
+            Kx4 measurements (x, y, a, h), one for each track.
+        """
+        slots = np.asarray(slots, dtype=np.int64)
+        if len(slots) == 0:
+            return
+
+        ndim = self.ndim
+        projected_mean, projected_cov = self.project(slots)
+        covariance = self.covariances[slots]
+
+        # K = P H^T S^-1, computed as (S^-1 H P)^T since S is symmetric
+        kalman_gain = np.linalg.solve(
+            projected_cov, covariance[:, :ndim, :]
+        ).transpose(0, 2, 1)
+        innovation = np.asarray(measurements).reshape(-1, ndim) - \
+            projected_mean
+
+        self.means[slots] += np.einsum('kij,kj->ki', kalman_gain, innovation)
+        self.covariances[slots] = covariance - \
+            kalman_gain @ projected_cov @ kalman_gain.transpose(0, 2, 1)
+
+    def gating_distance(
+            self, slots, measurements, only_position=False, metric='maha',
+    ):
+        """
+        Compute gating distance between the states and measurements.
+
+        A suitable distance threshold can be obtained from `chi2inv95`.
+        If `only_position` is False, the chi-square distribution has
+        4 degrees of freedom, otherwise 2.
+
+        Parameters
+        ----------
+        slots: array_like
+            Slot indices of K tracks.
+        measurements: ndarray
+            Mx4 measurements (x, y, a, h).
+        only_position: bool
+            If True, distance computation is done with respect to the
+            bounding box center position only.
+        metric: str
+            'maha' (squared Mahalanobis distance) or 'gaussian'
+            (squared Euclidean distance).
+
+        Returns
+        -------
+        ndarray
+            KxM matrix of distances.
+        """
+        slots = np.asarray(slots, dtype=np.int64)
+        measurements = np.asarray(measurements).reshape(-1, self.ndim)
+        mean, covariance = self.project(slots)
+        if only_position:
+            mean, covariance = mean[:, :2], covariance[:, :2, :2]
+            measurements = measurements[:, :2]
+
+        d = measurements[None, :, :] - mean[:, None, :]
+        if metric == 'gaussian':
+            return np.sum(d * d, axis=2)
+        elif metric == 'maha':
+            cholesky_factor = np.linalg.cholesky(covariance)
+            z = np.linalg.solve(cholesky_factor, d.transpose(0, 2, 1))
+            return np.sum(z * z, axis=1)
+        else:
+            raise ValueError('invalid distance metric')
+
+
+class StoredKalmanState:
+    """
+    Mixin for track classes whose `mean` / `covariance` live in a
+    `KalmanStateStore`.
+
+    While attached, `mean` and `covariance` are views of the store
+    arrays. Detached tracks keep their own copies, so the existing
+    single-track code keeps working.
+    """
+
+    _store = None
+    _slot = None
+    _mean = None
+    _covariance = None
+
+    @property
+    def store(self):
+        return self._store
+
+    @property
+    def slot(self):
+        return self._slot
+
+    def attach(self, store, slot):
+        self._store = store
+        self._slot = int(slot)
+
+    def detach(self):
+        if self._store is None:
+            return
+        self._mean = self._store.means[self._slot].copy()
+        self._covariance = self._store.covariances[self._slot].copy()
+        self._store.release([self._slot])
+        self._store = None
+        self._slot = None
+
+    @property
+    def mean(self):
+        if self._store is None:
+            return self._mean
+        return self._store.means[self._slot]
+
+    @mean.setter
+    def mean(self, value):
+        if self._store is None:
+            self._mean = value
+        else:
+            self._store.means[self._slot] = value
+
+    @property
+    def covariance(self):
+        if self._store is None:
+            return self._covariance
+        return self._store.covariances[self._slot]
+
+    @covariance.setter
+    def covariance(self, value):
+        if self._store is None:
+            self._covariance = value
+        else:
+            self._store.covariances[self._slot] = value
+
+
+def _batch_diag(values):
+    n, d = values.shape
+    out = np.zeros((n, d, d), dtype=values.dtype)
+    idx = np.arange(d)
+    out[:, idx, idx] = values
+    return out
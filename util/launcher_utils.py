@@ -0,0 +1,63 @@
+import os
+
+# ======================
+# Model search
+# ======================
+
+IGNORE_LIST = [
+    "commercial_model", "validation", ".git", "log", "prnet", "bert",
+    "illustration2vec", "etl", "vggface2", "anomaly_detection"
+]
+
+try:
+    import transformers
+except ModuleNotFoundError:
+    IGNORE_LIST.append("neural_language_processing")
+    pass
+
+try:
+    import torchaudio
+except ModuleNotFoundError:
+    IGNORE_LIST.append("audio_processing")
+    pass
+
+
+def search_model(root="./", ignore_list=IGNORE_LIST):
+    """
+    Find the model scripts: <root>/<category>/<model>/<model>.py
+
+    Returns
+    -------
+    model_list: list of dict
+        category, category_id and model name of each script
+    category_count: int
+    """
+    file_list = []
+    for current, subfolders, subfiles in os.walk(root):
+        file_list.append(os.path.relpath(current, root))
+
+    file_list.sort()
+
+    model_list = []
+    category_list = {}
+    model_exist = {}
+    for current in file_list:
+        current = current.replace("\\", "/")
+        files = ["."] + current.split("/")
+        if len(files) == 3:
+            if (files[1] in ignore_list) or (files[2] in ignore_list):
+                continue
+            if files[2] in model_exist:
+                continue
+            script = os.path.join(root, files[1], files[2], files[2] + ".py")
+            if os.path.exists(script):
+                if not(files[1] in category_list):
+                    category_list[files[1]] = len(category_list)
+                category_id = category_list[files[1]]
+                model_list.append({
+                    "category": files[1],
+                    "category_id": category_id,
+                    "model": files[2],
+                })
+                model_exist[files[2]] = True
+    return model_list, len(category_list)
@@ -0,0 +1,380 @@
+import os
+
+import cv2
+import numpy as np
+from scipy.special import expit
+
+import nms_utils
+from roi_tracking_utils import roi_corners
+
+
+# =============================================================================
+# Detector
+# =============================================================================
+# Shared post process of the BlazeFace / BlazePalm / BlazePose detectors.
+# The model specific parameters (box scale, number of keypoints, ...) are
+# given by the utils module of each model.
+
+_anchors_cache = {}
+
+
+def load_anchors(path):
+    """
+    Anchors of a detector, loaded once per file.
+    """
+    key = os.path.abspath(path)
+    anchors = _anchors_cache.get(key)
+    if anchors is None:
+        anchors = np.load(path).astype(np.float32)
+        _anchors_cache[key] = anchors
+    return anchors
+
+
+def resize_pad(img):
+    """ resize and pad images to be input to the detectors
+
+    The face and palm detector networks take 256x256 and 128x128 images
+    as input. As such the input image is padded and resized to fit the
+    size while maintaing the aspect ratio.
+
+    Returns:
+        img1: 256x256
+        img2: 128x128
+        scale: scale factor between original image and 256x256 image
+        pad: pixels of padding in the original image
+    """
+
+    size0 = img.shape
+    if size0[0] >= size0[1]:
+        h1 = 256
+        w1 = 256 * size0[1] // size0[0]
+        padh = 0
+        padw = 256 - w1
+        scale = size0[1] / w1
+    else:
+        h1 = 256 * size0[0] // size0[1]
+        w1 = 256
+        padh = 256 - h1
+        padw = 0
+        scale = size0[0] / h1
+    padh1 = padh//2
+    padh2 = padh//2 + padh % 2
+    padw1 = padw//2
+    padw2 = padw//2 + padw % 2
+    img1 = cv2.resize(img, (w1, h1))
+    img1 = np.pad(img1, ((padh1, padh2), (padw1, padw2), (0, 0)), mode='constant')
+    pad = (int(padh1 * scale), int(padw1 * scale))
+    img2 = cv2.resize(img1, (128, 128))
+    return img1, img2, scale, pad
+
+
+def decode_boxes(raw_boxes, anchors, box_scale, num_keypoints):
+    """
+    Converts the predictions into actual coordinates using the anchor boxes.
+    Processes the entire batch (and all the keypoints) at once.
+
+    Parameters
+    ----------
+    raw_boxes: numpy array
+        (b, num_anchors, 4 + 2 * num_keypoints) regressor predictions
+    anchors: numpy array
+        (num_anchors, 4) anchors as (x center, y center, w, h)
+    box_scale: float
+        input size of the detector the regressor is relative to
+    num_keypoints: int
+    """
+    boxes = np.zeros_like(raw_boxes)
+    anchor_center = anchors[:, :2]
+    anchor_size = anchors[:, 2:4]
+
+    center = raw_boxes[..., :2] / box_scale * anchor_size + anchor_center
+    size = raw_boxes[..., 2:4] / box_scale * anchor_size
+
+    boxes[..., 0] = center[..., 1] - size[..., 1] / 2.  # ymin
+    boxes[..., 1] = center[..., 0] - size[..., 0] / 2.  # xmin
+    boxes[..., 2] = center[..., 1] + size[..., 1] / 2.  # ymax
+    boxes[..., 3] = center[..., 0] + size[..., 0] / 2.  # xmax
+
+    end = 4 + 2 * num_keypoints
+    keypoints = raw_boxes[..., 4:end].reshape(
+        raw_boxes.shape[:-1] + (num_keypoints, 2))
+    keypoints = keypoints / box_scale * anchor_size[:, None] + \
+        anchor_center[:, None]
+    boxes[..., 4:end] = keypoints.reshape(raw_boxes.shape[:-1] + (-1,))
+
+    return boxes
+
+
+def raw_output_to_detections(
+        raw_box, raw_score, anchors, box_scale, num_keypoints,
+        min_score_thresh=0.75):
+    """The output of the neural network is an array of shape
+    (b, num_anchors, num_coords) containing the bounding box regressor
+    predictions, as well as an array of shape (b, num_anchors, 1) with the
+    classification confidences.
+
+    This function converts these two "raw" arrays into proper detections.
+    Returns a list of (num_detections, num_coords + 1) arrays, one for each
+    image in the batch.
+
+    This is based on the source code from:
+    mediapipe/calculators/tflite/tflite_tensors_to_detections_calculator.cc
+    mediapipe/calculators/tflite/tflite_tensors_to_detections_calculator.proto
+    """
+    detection_boxes = decode_boxes(raw_box, anchors, box_scale, num_keypoints)
+
+    thresh = 100.0
+    raw_score = raw_score.clip(-thresh, thresh)
+    detection_scores = expit(raw_score).squeeze(axis=-1)
+
+    # only one class: the boxes with a too low confidence are masked out
+    mask = detection_scores >= min_score_thresh
+
+    # each image from the batch can have a different number of detections
+    output_detections = []
+    for i in range(raw_box.shape[0]):
+        boxes = detection_boxes[i, mask[i]]
+        scores = detection_scores[i, mask[i], None]
+        output_detections.append(np.concatenate((boxes, scores), axis=-1))
+
+    return output_detections
+
+
+def detector_postprocess(
+        preds_ailia, anchor_path, box_scale, num_keypoints,
+        min_score_thresh=0.75, min_suppression_threshold=0.3):
+    """
+    Process detection predictions from ailia and return filtered detections
+
+    The overlapping detections are blended by the weighted NMS of the
+    BlazeFace paper (mediapipe/calculators/util/non_max_suppression_calculator.cc).
+
+    Returns
+    -------
+    list of numpy array
+        (num_detections, num_coords + 1) detections of each image
+    """
+    raw_box = preds_ailia[0]  # (b, num_anchors, num_coords)
+    raw_score = preds_ailia[1]  # (b, num_anchors, 1)
+    num_coords = 4 + 2 * num_keypoints
+
+    anchors = load_anchors(anchor_path)
+
+    # Postprocess the raw predictions:
+    detections = raw_output_to_detections(
+        raw_box, raw_score, anchors, box_scale, num_keypoints,
+        min_score_thresh)
+
+    # Non-maximum suppression to remove overlapping detections:
+    filtered_detections = []
+    for dets in detections:
+        if len(dets) == 0:
+            filtered_detections.append(np.zeros((0, num_coords + 1)))
+            continue
+        filtered_detections.append(nms_utils.weighted_nms(
+            dets, min_suppression_threshold, score_index=num_coords))
+
+    return filtered_detections
+
+
+def denormalize_detections(detections, scale, pad):
+    """ maps detection coordinates from [0,1] to image coordinates
+
+    The face and palm detector networks take 256x256 and 128x128 images
+    as input. As such the input image is padded and resized to fit the
+    size while maintaing the aspect ratio. This function maps the
+    normalized coordinates back to the original image coordinates.
+
+    Inputs:
+        detections: nxm tensor. n is the number of detections.
+            m is 4+2*k where the first 4 valuse are the bounding
+            box coordinates and k is the number of additional
+            keypoints output by the detector.
+        scale: scalar that was used to resize the image
+        pad: padding in the x and y dimensions
+
+    """
+    detections[:, 0:4:2] = detections[:, 0:4:2] * scale * 256 - pad[0]
+    detections[:, 1:4:2] = detections[:, 1:4:2] * scale * 256 - pad[1]
+
+    detections[:, 4::2] = detections[:, 4::2] * scale * 256 - pad[1]
+    detections[:, 5::2] = detections[:, 5::2] * scale * 256 - pad[0]
+    return detections
+
+
+# =============================================================================
+# ROI
+# =============================================================================
+def roi_affines(xc, yc, theta, scale, resolution):
+    """
+    Affine transforms of all the ROIs, in one step.
+
+    The corners (-1, -1), (-1, 1) and (1, -1) of a ROI are mapped to the
+    pixels (0, 0), (0, res-1) and (res-1, 0) of its image, as with
+    `cv2.getAffineTransform` of the corner points.
+
+    Returns
+    -------
+    affines: numpy array
+        (N, 2, 3) transforms from the image to the ROI images
+    inverses: numpy array
+        (N, 2, 3) transforms from the ROI images back to the image
+    """
+    xc, yc, theta, scale = [
+        np.reshape(v, -1).astype(np.float64) for v in (xc, yc, theta, scale)]
+    half = (resolution - 1) / 2
+    c, s = np.cos(theta), np.sin(theta)
+
+    # ROI image -> image: rotation scaled by the pixel size, around the center
+    k = scale / (resolution - 1)
+    inverses = np.empty((len(xc), 2, 3))
+    inverses[:, 0, 0] = k * c
+    inverses[:, 0, 1] = -k * s
+    inverses[:, 1, 0] = k * s
+    inverses[:, 1, 1] = k * c
+    inverses[:, 0, 2] = xc - half * (inverses[:, 0, 0] + inverses[:, 0, 1])
+    inverses[:, 1, 2] = yc - half * (inverses[:, 1, 0] + inverses[:, 1, 1])
+
+    # image -> ROI image: the transposed rotation divided by the pixel size
+    k = (resolution - 1) / scale
+    affines = np.empty((len(xc), 2, 3))
+    affines[:, 0, 0] = k * c
+    affines[:, 0, 1] = k * s
+    affines[:, 1, 0] = -k * s
+    affines[:, 1, 1] = k * c
+    affines[:, 0, 2] = half - (affines[:, 0, 0] * xc + affines[:, 0, 1] * yc)
+    affines[:, 1, 2] = half - (affines[:, 1, 0] * xc + affines[:, 1, 1] * yc)
+
+    return affines, inverses
+
+
+def extract_roi(
+        frame, xc, yc, theta, scale, resolution,
+        border_value=0., value_range=(0., 1.)):
+    """
+    Crop the rotated square ROIs of the frame.
+
+    Parameters
+    ----------
+    frame: numpy array
+        (H, W, 3) uint8 image
+    xc, yc, theta, scale: numpy array
+        (N,) ROIs
+    resolution: int
+        size of the ROI images
+    border_value: float or tuple
+        borderValue of cv2.warpAffine
+    value_range: tuple of float
+        range the pixel values [0, 255] are mapped to
+
+    Returns
+    -------
+    imgs: numpy array
+        (N, 3, res, res) float32 input of the landmark model
+    affines: numpy array
+        (N, 2, 3) float32 transforms from the ROI images back to the frame
+    points: numpy array
+        (N, 2, 4) corners of the ROIs
+    """
+    res = resolution
+    frame = np.ascontiguousarray(frame)
+    points = roi_corners(np.stack([
+        np.reshape(v, -1) for v in (xc, yc, scale, theta)], axis=1))
+    affines, inverses = roi_affines(xc, yc, theta, scale, res)
+
+    # warpAffine into one buffer (a single remap over the stacked maps of
+    # all the ROIs is slower)
+    n = len(affines)
+    imgs = np.empty((n, res, res) + frame.shape[2:], dtype=frame.dtype)
+    for i in range(n):
+        cv2.warpAffine(
+            frame, affines[i], (res, res), dst=imgs[i],
+            borderValue=border_value)
+
+    low, high = value_range
+    imgs = np.moveaxis(imgs, 3, 1).astype(np.float32)
+    imgs *= (high - low) / 255.
+    imgs += low
+
+    return imgs, inverses.astype(np.float32), points
+
+
+# =============================================================================
+# Landmarks
+# =============================================================================
+def denormalize_landmarks(landmarks, affines, resolution):
+    """
+    Map the landmarks from the normalized ROI coordinates back to the
+    image, with one batched matmul for all the ROIs.
+
+    Parameters
+    ----------
+    landmarks: numpy array
+        (N, K, C) landmarks, x and y in [0, 1] (the other values are kept)
+    affines: numpy array
+        (N, 2, 3) transforms from the ROI images to the image
+    resolution: int
+        size of the ROI images
+
+    Returns
+    -------
+    numpy array
+        (N, K, C) landmarks in image coordinates
+    """
+    landmarks = np.array(landmarks, dtype=np.float32)
+    affines = np.asarray(affines)
+    xy = landmarks[:, :, :2] * resolution
+    landmarks[:, :, :2] = \
+        xy @ np.swapaxes(affines[:, :, :2], 1, 2) + affines[:, None, :, 2]
+    return landmarks
+
+
+class LandmarkEstimator:
+    """
+    Runs a landmark model on the ROI images in batches of a fixed size.
+
+    The last batch is padded with zeros, so the input shape of the model
+    is set once instead of on each change of the number of subjects.
+
+    Parameters
+    ----------
+    net: ailia.Net
+    batch_size: int or None
+        None to run all the ROI images in one batch of their own size
+        (for the still images)
+    """
+
+    def __init__(self, net, batch_size=None):
+        self.net = net
+        self.batch_size = batch_size
+        self.shape = None
+
+    def set_input_shape(self, shape):
+        if self.shape is None:
+            self.shape = tuple(self.net.get_input_shape())
+        if self.shape != shape:
+            self.net.set_input_shape(shape)
+            self.shape = shape
+
+    def __call__(self, imgs):
+        """
+        Returns
+        -------
+        list of numpy array
+            outputs of the model for the N ROI images
+        """
+        n = len(imgs)
+        batch_size = self.batch_size or max(n, 1)
+        shape = (batch_size,) + tuple(imgs.shape[1:])
+        self.set_input_shape(shape)
+
+        batch = np.zeros(shape, dtype=np.float32)
+        outputs = []
+        for start in range(0, max(n, 1), batch_size):
+            group = imgs[start:start + batch_size]
+            batch[:len(group)] = group
+            batch[len(group):] = 0
+            preds = self.net.predict([batch])
+            outputs.append([np.array(p[:len(group)]) for p in preds])
+
+        return [np.concatenate(out) for out in zip(*outputs)]
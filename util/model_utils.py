@@ -1,42 +1,27 @@
 import os
-import urllib.request
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from queue import Queue
+
+from download_utils import get_download_manager, progress_print  # noqa: F401
 
 # logger
 from logging import getLogger
 logger = getLogger(__name__)
 
 
-def progress_print(block_count, block_size, total_size):
-    """
-    Callback function to display the progress
-    (ref: https://qiita.com/jesus_isao/items/ffa63778e7d3952537db)
-
-    Parameters
-    ----------
-    block_count:
-    block_size:
-    total_size:
-    """
-    percentage = 100.0 * block_count * block_size / total_size
-    if percentage > 100:
-        # Bigger than 100 does not look good, so...
-        percentage = 100
-    max_bar = 50
-    bar_num = int(percentage / (100 / max_bar))
-    progress_element = '=' * bar_num
-    if bar_num != max_bar:
-        progress_element += '>'
-    bar_fill = ' '  # fill the blanks
-    bar = progress_element.ljust(max_bar, bar_fill)
-    total_size_kb = total_size / 1024
-    print(f'[{bar} {percentage:.2f}% ( {total_size_kb:.0f}KB )]', end='\r')
-
-
 def check_and_download_models(weight_path, model_path, remote_path):
     """
     Check if the onnx file and prototxt file exists,
     and if necessary, download the files to the given path.
 
+    The files are fetched concurrently by the download manager of
+    `download_utils`: interrupted downloads are resumed, the files are
+    verified against the checksum manifest, and they are shared through
+    the content cache (`AILIA_MODELS_CACHE`). `AILIA_MODELS_MIRROR`
+    replaces the storage url.
+
     Parameters
     ----------
     weight_path: string
@@ -47,21 +32,306 @@ def check_and_download_models(weight_path, model_path, remote_path):
         The url where the onnx file and prototxt file are saved.
         ex. "https://storage.googleapis.com/ailia-models/mobilenetv2/"
     """
+    items = [(remote_path + os.path.basename(weight_path), weight_path)]
+    if model_path is not None:
+        items.append((remote_path + os.path.basename(model_path), model_path))
 
-    if not os.path.exists(weight_path):
-        logger.info(f'Downloading onnx file... (save path: {weight_path})')
-        urllib.request.urlretrieve(
-            remote_path + os.path.basename(weight_path),
-            weight_path,
-            progress_print,
-        )
-        logger.info('\n')
-    if model_path!=None and not os.path.exists(model_path):
-        logger.info(f'Downloading prototxt file... (save path: {model_path})')
-        urllib.request.urlretrieve(
-            remote_path + os.path.basename(model_path),
-            model_path,
-            progress_print,
-        )
-        logger.info('\n')
+    get_download_manager().download_all(items)
     logger.info('ONNX file and Prototxt file are prepared!')
+
+
+def download_models(items, max_workers=None):
+    """
+    Download the files of several models concurrently.
+
+    Parameters
+    ----------
+    items: list of tuple
+        (weight_path, model_path, remote_path) of each model, as given to
+        `check_and_download_models` (model_path may be None)
+    max_workers: int
+        number of concurrent downloads
+    """
+    files = []
+    for weight_path, model_path, remote_path in items:
+        for path in (weight_path, model_path):
+            if path is not None:
+                files.append((remote_path + os.path.basename(path), path))
+
+    manager = get_download_manager()
+    if max_workers is not None:
+        manager.max_workers = max_workers
+    return manager.download_all(files)
+
+
+class SessionRegistry:
+    """
+    Process-wide cache of loaded ailia sessions (ailia.Net / ailia.Detector).
+
+    Sessions are stored with LRU ordering. When the number of sessions
+    exceeds `capacity` or their estimated memory exceeds `memory_budget`,
+    the least recently used ones are released.
+
+    The entries are built outside of the registry lock, so loading a
+    model does not block the lookups of the others. Concurrent misses on
+    the same key wait for a single build.
+
+    Parameters
+    ----------
+    capacity: int
+        Maximum number of cached entries (None: unlimited).
+    memory_budget: int
+        Maximum estimated memory of cached entries in bytes
+        (None: unlimited). The estimation is the size of the weight file.
+    """
+
+    def __init__(self, capacity=16, memory_budget=None):
+        self.capacity = capacity
+        self.memory_budget = memory_budget
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self._loading = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    @property
+    def memory_usage(self):
+        return sum(nbytes for _, nbytes in self._entries.values())
+
+    def get(self, key, factory, nbytes=0):
+        """
+        Return the cached entry for `key`, or build it with `factory()`.
+
+        Parameters
+        ----------
+        key: hashable
+        factory: callable
+            Called without arguments to create the entry on a cache miss.
+        nbytes: int
+            Estimated memory of the entry, used for the memory budget.
+
+        Returns
+        -------
+        entry: object
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+            key_lock = self._loading.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self._lock:
+                # built by another thread while waiting
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+                    return self._entries[key][0]
+            try:
+                entry = factory()
+                with self._lock:
+                    self._entries[key] = (entry, nbytes)
+                    self._evict()
+            finally:
+                with self._lock:
+                    self._loading.pop(key, None)
+            return entry
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return None if entry is None else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _evict(self):
+        # the most recently added entry is always kept
+        while len(self._entries) > 1:
+            over_capacity = \
+                self.capacity is not None and \
+                len(self._entries) > self.capacity
+            over_budget = \
+                self.memory_budget is not None and \
+                self.memory_usage > self.memory_budget
+            if not (over_capacity or over_budget):
+                break
+            key, _ = self._entries.popitem(last=False)
+            logger.debug(f'release session: {key}')
+
+
+class SessionPool:
+    """
+    Thread-safe pool of `size` instances of the same model.
+
+    Parameters
+    ----------
+    factory: callable
+        Called without arguments to create one instance.
+    size: int
+        Number of instances. They are created lazily on first use.
+
+    Examples
+    --------
+    >>> pool = SessionPool(lambda: ailia.Net(MODEL_PATH, WEIGHT_PATH), 4)
+    >>> with pool.acquire() as net:
+    ...     output = net.predict(input_data)
+    """
+
+    def __init__(self, factory, size=1):
+        if size < 1:
+            raise ValueError(f'pool size must be positive: {size}')
+        self.factory = factory
+        self.size = size
+        self._idle = Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+
+    def _take(self, timeout=None):
+        with self._lock:
+            if self._idle.empty() and self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if create:
+            try:
+                return self.factory()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        return self._idle.get(timeout=timeout)
+
+    @contextmanager
+    def acquire(self, timeout=None):
+        """
+        Borrow one instance. Blocks while all instances are in use.
+        """
+        session = self._take(timeout)
+        try:
+            yield session
+        finally:
+            self._idle.put(session)
+
+
+_session_registry = SessionRegistry()
+
+
+def _session_key(weight_path, model_path, env_id, input_shape, kind):
+    if input_shape is not None:
+        input_shape = tuple(input_shape)
+    return (
+        kind,
+        None if model_path is None else os.path.abspath(model_path),
+        os.path.abspath(weight_path),
+        env_id,
+        input_shape,
+    )
+
+
+def _weight_size(weight_path):
+    try:
+        return os.path.getsize(weight_path)
+    except OSError:
+        return 0
+
+
+def _net_factory(weight_path, model_path, env_id, input_shape):
+    def factory():
+        import ailia
+        net = ailia.Net(model_path, weight_path, env_id=env_id)
+        if input_shape is not None:
+            net.set_input_shape(tuple(input_shape))
+        return net
+    return factory
+
+
+def get_session_registry():
+    return _session_registry
+
+
+def configure_session_cache(capacity=None, memory_budget=None):
+    """
+    Update the limits of the process-wide session cache.
+
+    Parameters
+    ----------
+    capacity: int
+        Maximum number of cached sessions.
+    memory_budget: int
+        Maximum estimated memory of cached sessions in bytes.
+    """
+    with _session_registry._lock:
+        _session_registry.capacity = capacity
+        _session_registry.memory_budget = memory_budget
+        _session_registry._evict()
+
+
+def get_session(
+        weight_path, model_path, env_id=0, input_shape=None,
+        factory=None, kind='net',
+):
+    """
+    Get a warm session from the process-wide cache.
+
+    The session is created on the first call and shared afterwards,
+    so it should not be used from several threads at the same time
+    (use `get_session_pool` for concurrent requests).
+
+    Parameters
+    ----------
+    weight_path: string
+        The path of onnx file.
+    model_path: string
+        The path of prototxt file for ailia.
+    env_id: int
+    input_shape: tuple
+        Input shape given to `set_input_shape` (None: default shape).
+    factory: callable
+        Called without arguments to create the session.
+        By default, `ailia.Net(model_path, weight_path, env_id=env_id)`.
+    kind: string
+        Distinguishes sessions of different types (ex. 'net', 'detector')
+        built from the same files.
+
+    Returns
+    -------
+    session: ailia.Net or the object returned by `factory`
+    """
+    if factory is None:
+        factory = _net_factory(weight_path, model_path, env_id, input_shape)
+    key = _session_key(weight_path, model_path, env_id, input_shape, kind)
+    return _session_registry.get(key, factory, _weight_size(weight_path))
+
+
+def get_session_pool(
+        weight_path, model_path, env_id=0, input_shape=None,
+        factory=None, kind='net', size=1,
+):
+    """
+    Get a pool of `size` sessions from the process-wide cache.
+
+    Parameters are the same as `get_session`.
+
+    Returns
+    -------
+    pool: SessionPool
+    """
+    if factory is None:
+        factory = _net_factory(weight_path, model_path, env_id, input_shape)
+    key = _session_key(weight_path, model_path, env_id, input_shape, kind)
+    key = key + ('pool', size)
+    return _session_registry.get(
+        key,
+        lambda: SessionPool(factory, size),
+        _weight_size(weight_path) * size,
+    )
+
+
+def clear_sessions():
+    _session_registry.clear()
@@ -3,6 +3,437 @@ import sys
 import numpy as np
 import cv2
 
+
+# =============================================================================
+# Vectorized NMS engine
+# =============================================================================
+def box_iou(boxes_a, boxes_b, offset=0, mode='iou'):
+    """
+    Compute the pairwise overlap of two sets of boxes.
+
+    Parameters
+    ----------
+    boxes_a: numpy array
+        Shape (A, 4), boxes as (x1, y1, x2, y2).
+    boxes_b: numpy array
+        Shape (B, 4), boxes as (x1, y1, x2, y2).
+    offset: int
+        1 for inclusive pixel coordinates (width = x2 - x1 + 1).
+    mode: string
+        - 'iou': intersection over union
+        - 'ioa': intersection over the area of `boxes_b`
+
+    Returns
+    -------
+    overlap: numpy array
+        Shape (A, B)
+    """
+    boxes_a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=np.float32).reshape(-1, 4)
+
+    lt = np.maximum(boxes_a[:, None, :2], boxes_b[None, :, :2])
+    rb = np.minimum(boxes_a[:, None, 2:], boxes_b[None, :, 2:])
+    wh = np.clip(rb - lt + offset, 0, None)
+    inter = wh[..., 0] * wh[..., 1]
+
+    area_b = (boxes_b[:, 2] - boxes_b[:, 0] + offset) * \
+        (boxes_b[:, 3] - boxes_b[:, 1] + offset)
+    if mode == 'ioa':
+        denom = np.broadcast_to(area_b[None, :], inter.shape)
+    elif mode == 'iou':
+        area_a = (boxes_a[:, 2] - boxes_a[:, 0] + offset) * \
+            (boxes_a[:, 3] - boxes_a[:, 1] + offset)
+        denom = area_a[:, None] + area_b[None, :] - inter
+    else:
+        raise ValueError(f'unknown mode: {mode}')
+
+    return inter / np.maximum(denom, np.finfo(np.float32).eps)
+
+
+def _top_k_order(scores, top_k):
+    # indices sorted by descending score, limited to the top_k candidates
+    scores = np.asarray(scores)
+    if 0 < top_k < len(scores):
+        order = np.argpartition(-scores, top_k - 1)[:top_k]
+        return order[np.argsort(-scores[order], kind='stable')]
+    return np.argsort(-scores, kind='stable')
+
+
+# Number of boxes compared at once. The overlaps of a block of boxes are
+# computed against a block of kept boxes, so the memory does not grow
+# with the square of the number of candidates.
+NMS_BLOCK_SIZE = 1024
+
+
+def _overlap_over(overlap, iou_threshold, inclusive):
+    if inclusive:
+        return overlap >= iou_threshold
+    return overlap > iou_threshold
+
+
+def _greedy_suppress(
+        boxes, iou_threshold, offset=0, mode='iou', inclusive=False,
+):
+    # boxes are sorted by descending score; a box is kept when no kept box
+    # with higher score overlaps it more than iou_threshold
+    n = len(boxes)
+    keep = np.zeros(n, dtype=bool)
+    for start in range(0, n, NMS_BLOCK_SIZE):
+        block = boxes[start:start + NMS_BLOCK_SIZE]
+
+        # suppressed by the boxes kept in the previous blocks
+        alive = np.ones(len(block), dtype=bool)
+        kept = boxes[:start][keep[:start]]
+        for k in range(0, len(kept), NMS_BLOCK_SIZE):
+            overlap = box_iou(
+                kept[k:k + NMS_BLOCK_SIZE], block[alive],
+                offset=offset, mode=mode)
+            alive[alive] = ~np.any(
+                _overlap_over(overlap, iou_threshold, inclusive), axis=0)
+
+        # greedy over the rest of the block
+        idx = np.nonzero(alive)[0]
+        overlap = box_iou(block[idx], block[idx], offset=offset, mode=mode)
+        suppress = np.triu(
+            _overlap_over(overlap, iou_threshold, inclusive), k=1)
+        local = np.ones(len(idx), dtype=bool)
+        for i in range(len(idx)):
+            if local[i]:
+                local &= ~suppress[i]
+        keep[start + idx[local]] = True
+    return keep
+
+
+def nms(
+        boxes, scores, iou_threshold, top_k=-1, max_output=-1,
+        offset=0, mode='iou', inclusive=False,
+):
+    """
+    Hard NMS over one set of boxes.
+
+    Parameters
+    ----------
+    boxes: numpy array
+        Shape (N, 4), boxes as (x1, y1, x2, y2).
+    scores: numpy array
+        Shape (N,)
+    iou_threshold: float
+        Boxes overlapping a higher scored box more than this are removed.
+    top_k: int
+        Only the `top_k` highest scored boxes are considered (-1: all).
+    max_output: int
+        Maximum number of kept boxes (-1: all).
+    offset, mode:
+        See `box_iou`.
+    inclusive: bool
+        Also remove the boxes overlapping exactly `iou_threshold`.
+
+    Returns
+    -------
+    keep: numpy array
+        Indices of kept boxes, sorted by descending score.
+    """
+    if len(boxes) == 0:
+        return np.zeros((0,), dtype=np.int64)
+
+    order = _top_k_order(scores, top_k)
+    sorted_boxes = np.asarray(boxes, dtype=np.float32)[order]
+    keep = order[_greedy_suppress(
+        sorted_boxes, iou_threshold, offset=offset, mode=mode,
+        inclusive=inclusive)]
+    if max_output > 0:
+        keep = keep[:max_output]
+    return keep
+
+
+def batched_nms(
+        boxes, scores, idxs, iou_threshold, top_k=-1, max_output=-1,
+        offset=0, mode='iou', inclusive=False,
+):
+    """
+    Class-aware NMS: boxes with different `idxs` never suppress each other.
+
+    Each group is processed by its own `nms` call, and the kept boxes of
+    all the groups are merged by descending score.
+
+    Parameters
+    ----------
+    idxs: numpy array
+        Shape (N,), group id of each box (ex. class id, or
+        image id * num_classes + class id).
+    Other parameters are the same as `nms`.
+
+    Returns
+    -------
+    keep: numpy array
+        Indices of kept boxes, sorted by descending score.
+    """
+    if len(boxes) == 0:
+        return np.zeros((0,), dtype=np.int64)
+
+    boxes = np.asarray(boxes)
+    scores = np.asarray(scores)
+    idxs = np.asarray(idxs)
+    candidates = np.sort(_top_k_order(scores, top_k))
+
+    keep = []
+    order = np.argsort(idxs[candidates], kind='stable')
+    groups = np.split(
+        candidates[order],
+        np.nonzero(np.diff(idxs[candidates][order]))[0] + 1)
+    for group in groups:
+        k = nms(
+            boxes[group], scores[group], iou_threshold,
+            offset=offset, mode=mode, inclusive=inclusive)
+        keep.append(group[k])
+    keep = np.concatenate(keep)
+
+    # descending score, ties in index order as `nms`
+    keep = keep[np.lexsort((keep, -scores[keep]))]
+    if max_output > 0:
+        keep = keep[:max_output]
+    return keep
+
+
+def multiclass_nms(
+        boxes, scores, iou_threshold, score_threshold,
+        class_agnostic=True, top_k=-1, offset=0,
+):
+    """
+    NMS over per-class scores.
+
+    Parameters
+    ----------
+    boxes: numpy array
+        Shape (N, 4), boxes as (x1, y1, x2, y2).
+    scores: numpy array
+        Shape (N, C)
+    iou_threshold: float
+    score_threshold: float
+        Candidates with score not greater than this are discarded.
+    class_agnostic: bool
+        When True, each box keeps only its best class and boxes of
+        different classes suppress each other.
+
+    Returns
+    -------
+    dets: numpy array
+        Shape (M, 6) as (x1, y1, x2, y2, score, class),
+        sorted by descending score. None if nothing is kept.
+    """
+    boxes = np.asarray(boxes)
+    scores = np.asarray(scores)
+
+    if class_agnostic:
+        cls_inds = scores.argmax(1)
+        cls_scores = scores[np.arange(len(cls_inds)), cls_inds]
+        box_inds = np.nonzero(cls_scores > score_threshold)[0]
+        cls_inds = cls_inds[box_inds]
+        cls_scores = cls_scores[box_inds]
+        keep = nms(
+            boxes[box_inds], cls_scores, iou_threshold,
+            top_k=top_k, offset=offset,
+        )
+    else:
+        box_inds, cls_inds = np.nonzero(scores > score_threshold)
+        cls_scores = scores[box_inds, cls_inds]
+        keep = batched_nms(
+            boxes[box_inds], cls_scores, cls_inds, iou_threshold,
+            top_k=top_k, offset=offset,
+        )
+
+    if len(keep) == 0:
+        return None
+    return np.concatenate([
+        boxes[box_inds[keep]],
+        cls_scores[keep, None],
+        cls_inds[keep, None].astype(boxes.dtype),
+    ], 1)
+
+
+def batched_images_nms(
+        boxes, scores, iou_threshold, classes=None, top_k=-1,
+        max_output=-1, offset=0,
+):
+    """
+    NMS over a batch of images in one call.
+
+    Parameters
+    ----------
+    boxes: numpy array
+        Shape (B, N, 4), boxes as (x1, y1, x2, y2).
+    scores: numpy array
+        Shape (B, N). Boxes with score <= 0 should be filtered beforehand
+        by the caller or set to a negative value and are discarded.
+    classes: numpy array
+        Shape (B, N), class id of each box. None means class-agnostic.
+    top_k: int
+        Pre-filter applied per image.
+    max_output: int
+        Maximum number of kept boxes per image.
+
+    Returns
+    -------
+    keeps: list of numpy array
+        For each image, indices of kept boxes sorted by descending score.
+    """
+    boxes = np.asarray(boxes)
+    scores = np.asarray(scores)
+    n_images, n_boxes = scores.shape
+
+    # top-k pre-filter per image
+    valid = scores > 0
+    if 0 < top_k < n_boxes:
+        kth = np.partition(-scores, top_k - 1, axis=1)[:, top_k - 1:top_k]
+        valid &= -scores <= kth
+    image_inds, box_inds = np.nonzero(valid)
+
+    groups = image_inds
+    if classes is not None:
+        classes = np.asarray(classes)
+        groups = image_inds * (classes.max() + 1) + \
+            classes[image_inds, box_inds]
+
+    keep = batched_nms(
+        boxes[image_inds, box_inds], scores[image_inds, box_inds],
+        groups, iou_threshold, offset=offset,
+    )
+
+    keeps = []
+    for i in range(n_images):
+        k = box_inds[keep[image_inds[keep] == i]]
+        if max_output > 0:
+            k = k[:max_output]
+        keeps.append(k)
+    return keeps
+
+
+def soft_nms(
+        boxes, scores, iou_threshold=0.3, sigma=0.5, score_threshold=0.001,
+        method='gaussian', top_k=-1, offset=0,
+):
+    """
+    Soft-NMS (Bodla et al., 2017): overlapping boxes are down-weighted
+    instead of removed.
+
+    Parameters
+    ----------
+    boxes: numpy array
+        Shape (N, 4), boxes as (x1, y1, x2, y2).
+    scores: numpy array
+        Shape (N,)
+    iou_threshold: float
+        Used by the 'linear' and 'hard' methods.
+    sigma: float
+        Used by the 'gaussian' method.
+    score_threshold: float
+        Boxes whose decayed score falls below this are removed.
+    method: string
+        'gaussian', 'linear' or 'hard'
+
+    Returns
+    -------
+    keep: numpy array
+        Indices of kept boxes, sorted by descending decayed score.
+    new_scores: numpy array
+        Decayed scores of the kept boxes.
+    """
+    if len(boxes) == 0:
+        return np.zeros((0,), dtype=np.int64), np.zeros((0,), np.float32)
+
+    order = _top_k_order(scores, top_k)
+    sorted_boxes = np.asarray(boxes, dtype=np.float32)[order]
+    decayed = np.asarray(scores, dtype=np.float32)[order].copy()
+
+    active = np.ones(len(order), dtype=bool)
+    keep = []
+    for _ in range(len(order)):
+        cand = np.nonzero(active)[0]
+        if len(cand) == 0:
+            break
+        i = cand[np.argmax(decayed[cand])]
+        if decayed[i] < score_threshold:
+            break
+        keep.append(i)
+        active[i] = False
+
+        ov = box_iou(sorted_boxes[i], sorted_boxes[active], offset=offset)[0]
+        if method == 'gaussian':
+            weight = np.exp(-(ov * ov) / sigma)
+        elif method == 'linear':
+            weight = np.where(ov > iou_threshold, 1 - ov, 1)
+        elif method == 'hard':
+            weight = np.where(ov > iou_threshold, 0, 1)
+        else:
+            raise ValueError(f'unknown method: {method}')
+        decayed[active] *= weight
+        active &= decayed >= score_threshold
+
+    keep = np.array(keep, dtype=np.int64)
+    return order[keep], decayed[keep]
+
+
+def weighted_nms(detections, iou_threshold=0.3, score_index=-1, top_k=-1):
+    """
+    Weighted NMS of the BlazeFace paper: overlapping detections are blended
+    into their confidence-weighted mean instead of being discarded.
+
+    The average score of the overlapping detections is assigned to the
+    blended detection.
+
+    Parameters
+    ----------
+    detections: numpy array
+        Shape (N, D). The first 4 columns are the box (any corner order),
+        column `score_index` is the score and all the other columns
+        (box, keypoints...) are averaged.
+    iou_threshold: float
+
+    Returns
+    -------
+    output: numpy array
+        Shape (M, D), sorted by descending score of the cluster head.
+    """
+    detections = np.asarray(detections)
+    if len(detections) == 0:
+        return np.zeros((0,) + detections.shape[1:], dtype=detections.dtype)
+
+    score_index = score_index % detections.shape[1]
+    coord_mask = np.arange(detections.shape[1]) != score_index
+
+    order = _top_k_order(detections[:, score_index], top_k)
+    dets = detections[order]
+    boxes = dets[:, :4]
+    # the box corner order does not matter for the IoU
+    boxes = np.concatenate([
+        np.minimum(boxes[:, :2], boxes[:, 2:]),
+        np.maximum(boxes[:, :2], boxes[:, 2:]),
+    ], axis=1)
+
+    # assign each detection to the first (highest scored) unassigned head
+    n = len(dets)
+    cluster = np.full(n, -1, dtype=np.int64)
+    for i in range(n):
+        if cluster[i] < 0:
+            overlap = box_iou(boxes[i], boxes)[0] > iou_threshold
+            cluster[(cluster < 0) & overlap] = i
+            cluster[i] = i
+
+    heads, inverse, counts = np.unique(
+        cluster, return_inverse=True, return_counts=True
+    )
+    scores = dets[:, score_index].astype(np.float64)
+    total = np.bincount(inverse, weights=scores)
+    weighted = np.zeros((len(heads), dets.shape[1]), dtype=np.float64)
+    np.add.at(weighted, inverse, dets * scores[:, None])
+
+    output = dets[heads].copy()
+    multi = counts > 1
+    output[np.ix_(multi, coord_mask)] = \
+        (weighted[multi] / total[multi, None])[:, coord_mask]
+    output[multi, score_index] = total[multi] / counts[multi]
+    return output
+
 def bb_intersection_over_union(boxA, boxB):
     # determine the (x, y)-coordinates of the intersection rectangle
     xA = max(boxA[0], boxB[0])
@@ -28,28 +459,34 @@ def nms_between_categories(detections,w,h,categories = None,iou_threshold = 0.25
     #https://github.com/opencv/opencv/issues/17111
 
     # remove overwrapped detection
-    det = []
-    keep = []
-    for idx in range(len(detections)):
-        obj = detections[idx]
-        is_keep=True
-        for idx2 in range(len(det)):
-            if not keep[idx2]:
-                continue
-            box_a = [w*det[idx2].x,h*det[idx2].y,w*(det[idx2].x+det[idx2].w),h*(det[idx2].y+det[idx2].h)]
-            box_b = [w*obj.x,h*obj.y,w*(obj.x+obj.w),h*(obj.y+obj.h)]
-            iou = bb_intersection_over_union(box_a,box_b)
-            if iou >= iou_threshold and (categories==None or ((det[idx2].category in categories) and (obj.category in categories))):
-                if det[idx2].prob<=obj.prob:
-                    keep[idx2]=False
-                else:
-                    is_keep=False
-        det.append(obj)
-        keep.append(is_keep)
-    
-    det = []
-    for idx in range(len(detections)):
-        if keep[idx]:
-            det.append(detections[idx])
-
-    return det
\ No newline at end of file
+    # (only the detections in `categories` suppress each other)
+    # The detections are visited in input order: a new detection removes
+    # the kept ones it overlaps with a lower or equal prob, and is itself
+    # removed when one of them has a higher prob.
+    if len(detections) == 0:
+        return []
+
+    boxes = np.array([
+        [w*obj.x,h*obj.y,w*(obj.x+obj.w),h*(obj.y+obj.h)] for obj in detections
+    ], dtype=np.float64)
+    probs = np.array([obj.prob for obj in detections])
+    if categories == None:
+        target = np.ones(len(detections), dtype=bool)
+    else:
+        target = np.array([obj.category in categories for obj in detections])
+    areas = (boxes[:, 2] - boxes[:, 0] + 1) * (boxes[:, 3] - boxes[:, 1] + 1)
+
+    keep = np.zeros(len(detections), dtype=bool)
+    for i in range(len(detections)):
+        lt = np.maximum(boxes[:i, :2], boxes[i, :2])
+        rb = np.minimum(boxes[:i, 2:], boxes[i, 2:])
+        wh = np.clip(rb - lt + 1, 0, None)
+        inter = wh[:, 0] * wh[:, 1]
+        iou = inter / (areas[:i] + areas[i] - inter)
+        hit = keep[:i] & (iou >= iou_threshold) & target[:i] & target[i]
+        weaker = hit & (probs[:i] <= probs[i])
+        keep[:i] &= ~weaker
+        keep[i] = not np.any(hit & ~weaker)
+
+    det = [detections[idx] for idx in range(len(detections)) if keep[idx]]
+    return det
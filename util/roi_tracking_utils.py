@@ -0,0 +1,212 @@
+import numpy as np
+
+
+# =============================================================================
+# ROI from landmarks
+# =============================================================================
+# A ROI is a rotated square (x center, y center, size, theta) in image
+# coordinates, as given to `extract_roi` of the MediaPipe utils.
+
+def rotated_bounding_roi(points, theta, scale=1.5, shift=(0., 0.)):
+    """
+    Square ROI around landmarks, in the orientation `theta`.
+
+    The landmarks are rotated to the ROI axes, and their bounding box is
+    shifted by `shift` (relative to its size) and made square with its
+    long side times `scale`.
+
+    Parameters
+    ----------
+    points: numpy array
+        (N, K, 2) landmarks in image coordinates
+    theta: numpy array
+        (N,) rotations
+    scale: float
+    shift: tuple of float
+
+    Returns
+    -------
+    numpy array
+        (N, 4) ROIs
+    """
+    c, s = np.cos(theta), np.sin(theta)
+    # rotation by -theta
+    x = points[:, :, 0] * c[:, None] + points[:, :, 1] * s[:, None]
+    y = -points[:, :, 0] * s[:, None] + points[:, :, 1] * c[:, None]
+
+    x_min, x_max = x.min(axis=1), x.max(axis=1)
+    y_min, y_max = y.min(axis=1), y.max(axis=1)
+    w, h = x_max - x_min, y_max - y_min
+    xr = (x_min + x_max) / 2 + w * shift[0]
+    yr = (y_min + y_max) / 2 + h * shift[1]
+
+    # back to the image axes
+    xc = xr * c - yr * s
+    yc = xr * s + yr * c
+    size = np.maximum(w, h) * scale
+    return np.stack([xc, yc, size, theta], axis=1)
+
+
+def alignment_roi(center, end, scale=1.5, theta0=np.pi / 2):
+    """
+    ROI of two alignment points: the center and a point on the circle
+    enclosing the subject (as `detection2roi` with the 'alignment' method).
+
+    Parameters
+    ----------
+    center: numpy array
+        (N, 2) center points
+    end: numpy array
+        (N, 2) points giving the size and rotation
+    scale: float
+    theta0: float
+        angle of the (center, end) vector of an upright subject
+
+    Returns
+    -------
+    numpy array
+        (N, 4) ROIs
+    """
+    d = center - end
+    size = np.sqrt((d ** 2).sum(axis=1)) * 2 * scale
+    theta = np.arctan2(d[:, 1], d[:, 0]) - theta0
+    return np.stack([center[:, 0], center[:, 1], size, theta], axis=1)
+
+
+def roi_corners(rois):
+    """
+    Corners of the ROIs, in the layout of the points of `extract_roi`.
+
+    Returns
+    -------
+    numpy array
+        (N, 2, 4) x and y of the corners
+    """
+    points = np.array([[-1, -1, 1, 1], [-1, 1, -1, 1]]).reshape(1, 2, 4)
+    points = points * rois[:, 2].reshape(-1, 1, 1) / 2
+    c = np.cos(rois[:, 3]).reshape(-1, 1)
+    s = np.sin(rois[:, 3]).reshape(-1, 1)
+    x = c * points[:, 0] - s * points[:, 1] + rois[:, 0:1]
+    y = s * points[:, 0] + c * points[:, 1] + rois[:, 1:2]
+    return np.stack([x, y], axis=1)
+
+
+# =============================================================================
+# Tracking
+# =============================================================================
+class RoiTracker:
+    """
+    Detect-once-then-track loop of the landmark models.
+
+    The detector is run on the first frame, then the ROI of each subject
+    in the next frame is derived from its landmarks, and the detector is
+    only run again when a tracked subject is lost or every
+    `detection_interval` frames (to find the subjects entering the
+    scene). The detections overlapping a tracked subject are dropped, so
+    the tracked ROIs are kept.
+
+    Parameters
+    ----------
+    detect: callable
+        detect(frame) -> (N, 4) ROIs of the detected subjects, best first
+    estimate: callable
+        estimate(frame, rois) -> (landmarks, scores, next_rois), with the
+        (N,) presence scores and the (N, 4) ROIs of the next frame
+    max_subjects: int
+    threshold: float
+        minimum presence score of a tracked subject
+    detection_interval: int
+        run the detector at least every `detection_interval` frames
+        (0: only when a subject is lost, 1: on every frame)
+    overlap: float
+        a detection whose center is within `overlap` * size of a tracked
+        ROI center is the same subject
+    """
+
+    def __init__(
+            self, detect, estimate, max_subjects=1, threshold=0.5,
+            detection_interval=30, overlap=0.5):
+        self.detect = detect
+        self.estimate = estimate
+        self.max_subjects = max_subjects
+        self.threshold = threshold
+        self.detection_interval = detection_interval
+        self.overlap = overlap
+        self.num_frames = 0
+        self.num_detections = 0
+        self.reset()
+
+    def reset(self):
+        self.rois = np.zeros((0, 4))
+        self.lost = True
+        self.since_detection = 0
+
+    @property
+    def detection_ratio(self):
+        """
+        Fraction of the frames on which the detector was run.
+        """
+        return self.num_detections / max(self.num_frames, 1)
+
+    def need_detection(self):
+        if self.lost or len(self.rois) == 0:
+            return True
+        return self.detection_interval > 0 and \
+            self.since_detection >= self.detection_interval
+
+    def merge(self, rois, detections):
+        """
+        Append the detections of new subjects to the tracked ROIs.
+        """
+        detections = np.asarray(detections, dtype=np.float64).reshape(-1, 4)
+        for roi in detections:
+            if len(rois) >= self.max_subjects:
+                break
+            if len(rois) > 0:
+                dist = np.linalg.norm(rois[:, :2] - roi[None, :2], axis=1)
+                if np.any(dist < self.overlap * rois[:, 2]):
+                    continue
+            rois = np.concatenate([rois, roi[None]])
+        return rois
+
+    def __call__(self, frame):
+        """
+        Track the subjects in the next frame.
+
+        Returns
+        -------
+        landmarks: list or numpy array
+            landmarks of the tracked subjects (as returned by `estimate`)
+        scores: numpy array
+            (N,) presence scores
+        rois: numpy array
+            (N, 4) ROIs used for the frame
+        """
+        self.num_frames += 1
+        self.since_detection += 1
+
+        rois = self.rois
+        num_tracked = len(rois)
+        if self.need_detection():
+            rois = self.merge(rois, self.detect(frame))
+            self.num_detections += 1
+            self.since_detection = 0
+
+        if len(rois) == 0:
+            self.rois = rois
+            self.lost = True
+            return [], np.zeros((0,)), rois
+
+        landmarks, scores, next_rois = self.estimate(frame, rois)
+        scores = np.asarray(scores).reshape(-1)
+        keep = scores >= self.threshold
+
+        # a lost tracked subject triggers the detection on the next frame
+        # (a detection rejected by the landmark model does not)
+        self.lost = not np.all(keep[:num_tracked])
+        # two ROIs which converged on the same subject are merged
+        next_rois = np.asarray(next_rois, dtype=np.float64).reshape(-1, 4)
+        self.rois = self.merge(np.zeros((0, 4)), next_rois[keep])
+
+        landmarks = [landmarks[i] for i in np.nonzero(keep)[0]]
+        return landmarks, scores[keep], rois[keep]
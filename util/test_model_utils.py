@@ -0,0 +1,61 @@
+import os
+import sys
+import threading
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from model_utils import SessionRegistry  # noqa: E402
+
+
+def test_session_registry_load_does_not_block_others():
+    registry = SessionRegistry()
+    registry.get('b', lambda: 'b')
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_factory():
+        started.set()
+        release.wait(5)
+        return 'a'
+
+    loader = threading.Thread(target=registry.get, args=('a', slow_factory))
+    loader.start()
+    results = []
+    try:
+        assert started.wait(5)
+        # a cached entry and a new one are available while 'a' is loading
+        lookup = threading.Thread(target=lambda: results.extend([
+            registry.get('b', lambda: 'other'),
+            registry.get('c', lambda: 'c'),
+        ]))
+        lookup.start()
+        lookup.join(1)
+        assert results == ['b', 'c']
+    finally:
+        release.set()
+        loader.join()
+    assert registry.get('a', lambda: 'other') == 'a'
+
+
+def test_session_registry_single_build():
+    registry = SessionRegistry()
+    calls = []
+    release = threading.Event()
+
+    def factory():
+        calls.append(1)
+        release.wait(5)
+        return object()
+
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(registry.get('a', factory)))
+        for _ in range(4)
+    ]
+    for t in threads:
+        t.start()
+    release.set()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1
+    assert all(r is results[0] for r in results)
@@ -0,0 +1,31 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from nms_utils import nms_between_categories  # noqa: E402
+
+
+class Detection:
+    def __init__(self, x, y, w, h, prob, category=0):
+        self.x, self.y, self.w, self.h = x, y, w, h
+        self.prob = prob
+        self.category = category
+
+
+def test_nms_between_categories_input_order():
+    # b overlaps a only, c overlaps a only: b is removed by a while a is
+    # kept, then a is removed by c
+    a = Detection(0.0, 0.0, 0.4, 0.4, 0.7)
+    b = Detection(0.0, 0.2, 0.4, 0.4, 0.5)
+    c = Detection(0.15, 0.0, 0.4, 0.4, 0.9)
+
+    assert nms_between_categories([a, b, c], 100, 100, iou_threshold=0.3) \
+        == [c]
+
+
+def test_nms_between_categories_other_categories_kept():
+    a = Detection(0.0, 0.0, 0.4, 0.4, 0.7, category=0)
+    b = Detection(0.0, 0.0, 0.4, 0.4, 0.9, category=1)
+
+    assert nms_between_categories(
+        [a, b], 100, 100, categories=[1], iou_threshold=0.3) == [a, b]
@@ -0,0 +1,343 @@
+import math
+
+import numpy as np
+import cv2
+
+
+# =============================================================================
+# Connected components
+# =============================================================================
+def component_max(values, labels, num_labels):
+    """
+    Maximum of `values` over each labelled component, in one pass.
+
+    Returns
+    -------
+    numpy array
+        (num_labels,) maxima (-inf for empty labels)
+    """
+    out = np.full(num_labels, -np.inf, dtype=np.float64)
+    np.maximum.at(out, labels.ravel(), values.ravel())
+    return out
+
+
+def component_boundaries(mask, labels, num_labels):
+    """
+    Boundary pixels of each labelled component.
+
+    Only the pixels with a background 8-neighbor are kept: they have the
+    same convex hull as the whole component, so `cv2.minAreaRect` of the
+    boundary equals that of the component, with much fewer points.
+
+    Parameters
+    ----------
+    mask: numpy array
+        (H, W) foreground mask
+    labels: numpy array
+        (H, W) labels of the foreground components
+    num_labels: int
+
+    Returns
+    -------
+    list of numpy array
+        (N_k, 2) int32 (x, y) points of each label (label 0 included)
+    """
+    mask = (mask > 0).astype(np.uint8)
+    inner = cv2.erode(
+        mask, np.ones((3, 3), np.uint8),
+        borderType=cv2.BORDER_CONSTANT, borderValue=0)
+    ys, xs = np.nonzero(mask & (1 - inner))
+    lab = labels[ys, xs]
+
+    order = np.argsort(lab, kind='stable')
+    points = np.stack([xs, ys], axis=1).astype(np.int32)[order]
+    counts = np.bincount(lab, minlength=num_labels)
+    return np.split(points, np.cumsum(counts)[:-1])
+
+
+def polygon_means(values, polygons):
+    """
+    Mean of `values` inside each polygon, with the pixels of
+    `cv2.fillPoly` (integer corners).
+
+    The polygons are drawn with their index into one label map and
+    averaged with one bincount. The few polygons overlapping the ones
+    already drawn are averaged one by one on their bounding box.
+
+    Parameters
+    ----------
+    values: numpy array
+        (H, W) map
+    polygons: numpy array
+        (N, K, 2) corners
+
+    Returns
+    -------
+    numpy array
+        (N,) means (0 for empty polygons)
+    """
+    height, width = values.shape
+    n = len(polygons)
+    pts = polygons.astype(np.int32)
+    x0 = np.clip(pts[:, :, 0].min(axis=1), 0, width - 1)
+    x1 = np.clip(pts[:, :, 0].max(axis=1), 0, width - 1)
+    y0 = np.clip(pts[:, :, 1].min(axis=1), 0, height - 1)
+    y1 = np.clip(pts[:, :, 1].max(axis=1), 0, height - 1)
+
+    index = np.zeros((height, width), dtype=np.int32)
+    overlapping = []
+    for i in range(n):
+        if index[y0[i]:y1[i] + 1, x0[i]:x1[i] + 1].any():
+            overlapping.append(i)
+            continue
+        cv2.fillPoly(index, pts[i:i + 1], i + 1)
+    sums = np.bincount(index.ravel(), weights=values.ravel(), minlength=n + 1)
+    counts = np.bincount(index.ravel(), minlength=n + 1)
+    means = sums[1:] / np.maximum(counts[1:], 1)
+
+    for i in overlapping:
+        mask = np.zeros((y1[i] - y0[i] + 1, x1[i] - x0[i] + 1), np.uint8)
+        cv2.fillPoly(mask, pts[i:i + 1] - [x0[i], y0[i]], 1)
+        means[i] = cv2.mean(
+            values[y0[i]:y1[i] + 1, x0[i]:x1[i] + 1], mask)[0]
+    return means
+
+
+# =============================================================================
+# Rotated rectangles
+# =============================================================================
+def min_area_rects(point_sets):
+    """
+    `cv2.minAreaRect` of each point set, as arrays.
+
+    Returns
+    -------
+    centers: numpy array
+        (N, 2) centers (x, y)
+    sizes: numpy array
+        (N, 2) (width, height)
+    angles: numpy array
+        (N,) angles in degrees
+    """
+    rects = [cv2.minAreaRect(points) for points in point_sets]
+    if len(rects) == 0:
+        return np.zeros((0, 2)), np.zeros((0, 2)), np.zeros((0,))
+    centers = np.array([r[0] for r in rects], dtype=np.float64)
+    sizes = np.array([r[1] for r in rects], dtype=np.float64)
+    angles = np.array([r[2] for r in rects], dtype=np.float64)
+    return centers, sizes, angles
+
+
+def rect_points(centers, sizes, angles):
+    """
+    Corners of rotated rectangles, in the order of `cv2.boxPoints`.
+
+    Returns
+    -------
+    numpy array
+        (N, 4, 2) float32 corners
+    """
+    theta = np.deg2rad(angles)
+    b = np.cos(theta) * 0.5
+    a = np.sin(theta) * 0.5
+    w, h = sizes[:, 0], sizes[:, 1]
+    cx, cy = centers[:, 0], centers[:, 1]
+
+    p0 = np.stack([cx - a * h - b * w, cy + b * h - a * w], axis=1)
+    p1 = np.stack([cx + a * h - b * w, cy - b * h - a * w], axis=1)
+    p2 = 2 * centers - p0
+    p3 = 2 * centers - p1
+    return np.stack([p0, p1, p2, p3], axis=1).astype(np.float32)
+
+
+def order_mini_boxes(points):
+    """
+    Order the corners as top-left, top-right, bottom-right, bottom-left:
+    the two left-most corners are the left side, and each side is
+    ordered by y.
+
+    Parameters
+    ----------
+    points: numpy array
+        (N, 4, 2) corners
+
+    Returns
+    -------
+    numpy array
+        (N, 4, 2) ordered corners
+    """
+    n = len(points)
+    order = np.argsort(points[:, :, 0], axis=1, kind='stable')
+    pts = np.take_along_axis(points, order[:, :, None], axis=1)
+
+    rows = np.arange(n)
+    left_down = pts[:, 1, 1] > pts[:, 0, 1]
+    right_down = pts[:, 3, 1] > pts[:, 2, 1]
+    tl = np.where(left_down, 0, 1)
+    bl = 1 - tl
+    tr = np.where(right_down, 2, 3)
+    br = 5 - tr
+    return np.stack([
+        pts[rows, tl], pts[rows, tr], pts[rows, br], pts[rows, bl]
+    ], axis=1)
+
+
+def unclip_sizes(sizes, unclip_ratio):
+    """
+    Size of the rectangles expanded by the DB unclip distance.
+
+    The polygon is offset by D = A * r / L (A area, L perimeter). For a
+    rectangle, the min-area rectangle of the offset polygon has the same
+    center and angle, and each side grows by 2 * D.
+    """
+    w, h = sizes[:, 0], sizes[:, 1]
+    distance = w * h * unclip_ratio / np.maximum(2 * (w + h), 1e-6)
+    return sizes + 2 * distance[:, None]
+
+
+# =============================================================================
+# DB (Differentiable Binarization) post process
+# =============================================================================
+def db_boxes_from_bitmap(
+        pred, bitmap, dest_width, dest_height,
+        box_thresh=0.7, max_candidates=1000, unclip_ratio=2.0, min_size=3):
+    """
+    Text boxes of a DB probability map.
+
+    Every step is done for all the text regions at once: the regions are
+    labelled with `cv2.connectedComponentsWithStats`, the rotated
+    rectangles are scored with one bincount per label map, and expanded,
+    ordered and rescaled as arrays.
+
+    Parameters
+    ----------
+    pred: numpy array
+        (H, W) probability map
+    bitmap: numpy array
+        (H, W) binarized map
+    dest_width, dest_height: int
+        size of the source image
+    box_thresh: float
+        minimum score of a box
+    max_candidates: int
+        maximum number of text regions
+    unclip_ratio: float
+    min_size: int
+        minimum short side of a box
+
+    Returns
+    -------
+    boxes: numpy array
+        (N, 4, 2) int16 boxes (top-left, top-right, bottom-right, bottom-left)
+    scores: numpy array
+        (N,) scores
+    """
+    height, width = bitmap.shape
+    mask = (np.asarray(bitmap) > 0).astype(np.uint8)
+    num_labels, labels, _, _ = cv2.connectedComponentsWithStats(
+        mask, connectivity=8)
+
+    ids = np.arange(1, min(num_labels, max_candidates + 1))
+    point_sets = component_boundaries(mask, labels, num_labels)
+    centers, sizes, angles = min_area_rects([point_sets[k] for k in ids])
+
+    keep = sizes.min(axis=1, initial=np.inf) >= min_size
+    centers, sizes, angles = centers[keep], sizes[keep], angles[keep]
+
+    # mean probability over the box
+    scores = polygon_means(pred, rect_points(centers, sizes, angles))
+    keep = scores >= box_thresh
+    centers, sizes, angles = centers[keep], sizes[keep], angles[keep]
+    scores = scores[keep]
+
+    sizes = unclip_sizes(sizes, unclip_ratio)
+    keep = sizes.min(axis=1, initial=np.inf) >= min_size + 2
+    centers, sizes, angles = centers[keep], sizes[keep], angles[keep]
+    scores = scores[keep]
+
+    boxes = order_mini_boxes(rect_points(centers, sizes, angles))
+    boxes[:, :, 0] = np.clip(
+        np.round(boxes[:, :, 0] / width * dest_width), 0, dest_width)
+    boxes[:, :, 1] = np.clip(
+        np.round(boxes[:, :, 1] / height * dest_height), 0, dest_height)
+    return boxes.astype(np.int16), scores
+
+
+# =============================================================================
+# CRAFT post process
+# =============================================================================
+def craft_boxes_from_maps(
+        textmap, linkmap, text_threshold, link_threshold, low_text):
+    """
+    Word boxes of the CRAFT region and affinity maps.
+
+    The components of the combined map are labelled once. Size and
+    score filtering use the component statistics, and the dilation and
+    `cv2.minAreaRect` of each word only touch its bounding box.
+
+    Returns
+    -------
+    boxes: list of numpy array
+        (4, 2) clockwise boxes starting from the top-left
+    labels: numpy array
+        (H, W) component labels
+    mapper: list of int
+        label of each box
+    """
+    img_h, img_w = textmap.shape
+
+    """ labeling method """
+    ret, text_score = cv2.threshold(textmap, low_text, 1, 0)
+    ret, link_score = cv2.threshold(linkmap, link_threshold, 1, 0)
+
+    text_score_comb = np.clip(text_score + link_score, 0, 1)
+    nLabels, labels, stats, centroids = cv2.connectedComponentsWithStats(
+        text_score_comb.astype(np.uint8), connectivity=4
+    )
+    link_only = np.logical_and(link_score == 1, text_score == 0)
+
+    text_max = component_max(textmap, labels, nLabels)
+    ids = np.nonzero(
+        (stats[:, cv2.CC_STAT_AREA] >= 10) & (text_max >= text_threshold))[0]
+    ids = ids[ids > 0]
+
+    point_sets = []
+    for k in ids:
+        size = stats[k, cv2.CC_STAT_AREA]
+        x, y = stats[k, cv2.CC_STAT_LEFT], stats[k, cv2.CC_STAT_TOP]
+        w, h = stats[k, cv2.CC_STAT_WIDTH], stats[k, cv2.CC_STAT_HEIGHT]
+        niter = int(math.sqrt(size * min(w, h) / (w * h)) * 2)
+        sx, ex = max(x - niter, 0), min(x + w + niter + 1, img_w)
+        sy, ey = max(y - niter, 0), min(y + h + niter + 1, img_h)
+
+        # segmentation map of the word without the link area
+        segmap = (labels[sy:ey, sx:ex] == k).astype(np.uint8) * 255
+        segmap[link_only[sy:ey, sx:ex]] = 0
+        kernel = cv2.getStructuringElement(
+            cv2.MORPH_RECT, (1 + niter, 1 + niter))
+        segmap = cv2.dilate(segmap, kernel)
+
+        ys, xs = np.nonzero(segmap)
+        point_sets.append(np.stack([xs + sx, ys + sy], axis=1))
+
+    if len(point_sets) == 0:
+        return [], labels, []
+    centers, sizes, angles = min_area_rects(point_sets)
+    boxes = rect_points(centers, sizes, angles)
+
+    # align diamond-shape
+    w = np.linalg.norm(boxes[:, 0] - boxes[:, 1], axis=1)
+    h = np.linalg.norm(boxes[:, 1] - boxes[:, 2], axis=1)
+    box_ratio = np.maximum(w, h) / (np.minimum(w, h) + 1e-5)
+    for i in np.nonzero(np.abs(1 - box_ratio) <= 0.1)[0]:
+        pts = point_sets[i]
+        l, t = pts.min(axis=0)
+        r, b = pts.max(axis=0)
+        boxes[i] = [[l, t], [r, t], [r, b], [l, b]]
+
+    # make clock-wise order
+    startidx = boxes.sum(axis=2).argmin(axis=1)
+    order = (np.arange(4)[None, :] + startidx[:, None]) % 4
+    boxes = np.take_along_axis(boxes, order[:, :, None], axis=1)
+
+    return list(boxes), labels, [int(k) for k in ids]
@@ -0,0 +1,145 @@
+import numpy as np
+
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+
+def tile_positions(size, tile, overlap):
+    """
+    Start positions of the tiles along one axis.
+
+    Neighboring tiles overlap by at least `overlap` pixels, and the last
+    tile ends at the border of the image.
+
+    Parameters
+    ----------
+    size: int
+        image size (must be >= tile)
+    tile: int
+        tile size
+    overlap: int
+
+    Returns
+    -------
+    list of int
+    """
+    if size <= tile:
+        return [0]
+    stride = max(tile - overlap, 1)
+    n = -(-(size - tile) // stride) + 1
+    # spread the tiles evenly so that all overlaps are about the same
+    return [int(round(i * (size - tile) / (n - 1))) for i in range(n)]
+
+
+def feather_weights(height, width, ramp):
+    """
+    Blending weights of a tile, rising linearly over `ramp` pixels
+    from each edge.
+
+    Returns
+    -------
+    numpy array
+        (height, width) float32 weights in (0, 1]
+    """
+    def ramp_1d(n):
+        r = min(ramp, n // 2)
+        w = np.ones(n, dtype=np.float32)
+        if r > 0:
+            edge = (np.arange(r, dtype=np.float32) + 0.5) / r
+            w[:r] = edge
+            w[n - r:] = edge[::-1]
+        return w
+
+    return np.outer(ramp_1d(height), ramp_1d(width))
+
+
+def tiled_predict(
+        net, img, tile_size, overlap=16, batch_size=1, scale=None,
+        pad_mode='edge'):
+    """
+    Run an image-to-image net tile by tile, and blend the tiles.
+
+    The image is split into `tile_size` tiles overlapping by `overlap`
+    pixels. The tiles are fed in batches of `batch_size`: the input
+    shape of the net is set once, and the last batch is padded, so the
+    net is never reshaped for a new image size. The overlapping outputs
+    are blended with feathered weights, which hides the seams.
+
+    Parameters
+    ----------
+    net: ailia.Net
+    img: numpy array
+        (C, H, W) or (1, C, H, W) preprocessed image
+    tile_size: int or tuple of int
+        (height, width) of the tiles. Images smaller than a tile are
+        padded to the tile size.
+    overlap: int
+        overlap of the tiles in input pixels
+    batch_size: int
+        number of tiles per inference
+    scale: int
+        ratio of the output size to the input size of the net
+        (obtained from the first output if None)
+    pad_mode: str
+        `numpy.pad` mode for images smaller than a tile
+
+    Returns
+    -------
+    numpy array
+        (1, C_out, H * scale, W * scale) float32 output
+    """
+    if np.ndim(tile_size) == 0:
+        tile_size = (tile_size, tile_size)
+    th, tw = tile_size
+
+    img = np.asarray(img, dtype=np.float32)
+    if img.ndim == 4:
+        img = img[0]
+    c, h, w = img.shape
+
+    # pad small images to the tile size
+    pad_h, pad_w = max(th - h, 0), max(tw - w, 0)
+    if pad_h or pad_w:
+        img = np.pad(img, ((0, 0), (0, pad_h), (0, pad_w)), mode=pad_mode)
+    ph, pw = img.shape[1:]
+
+    tiles = [
+        (y, x)
+        for y in tile_positions(ph, th, overlap)
+        for x in tile_positions(pw, tw, overlap)
+    ]
+    logger.debug(f'{len(tiles)} tiles of {th}x{tw} for {h}x{w} image')
+
+    shape = (batch_size, c, th, tw)
+    if tuple(net.get_input_shape()) != shape:
+        net.set_input_shape(shape)
+
+    batch = np.zeros(shape, dtype=np.float32)
+    output = weight_sum = weights = None
+    for start in range(0, len(tiles), batch_size):
+        group = tiles[start:start + batch_size]
+        for i, (y, x) in enumerate(group):
+            batch[i] = img[:, y:y + th, x:x + tw]
+        batch[len(group):] = 0
+
+        preds = net.predict(batch)
+        if isinstance(preds, (list, tuple)):
+            preds = preds[0]
+
+        if output is None:
+            if scale is None:
+                scale = preds.shape[2] // th
+            output = np.zeros(
+                (preds.shape[1], ph * scale, pw * scale), dtype=np.float32)
+            weight_sum = np.zeros(output.shape[1:], dtype=np.float32)
+            weights = feather_weights(th * scale, tw * scale, overlap * scale)
+
+        oh, ow = th * scale, tw * scale
+        for i, (y, x) in enumerate(group):
+            y, x = y * scale, x * scale
+            output[:, y:y + oh, x:x + ow] += preds[i] * weights
+            weight_sum[y:y + oh, x:x + ow] += weights
+
+    output /= weight_sum
+    return output[np.newaxis, :, :h * scale, :w * scale]
@@ -80,8 +80,9 @@ def get_base_parser(
     )
     parser.add_argument(
         '-b', '--benchmark', action='store_true',
-        help=('Running the inference on the same input 5 times to measure '
-              'execution performance. (Cannot be used in video mode)')
+        help=('Running the inference on the same input several times '
+              '(--benchmark_count) to measure execution performance. '
+              '(Cannot be used in video mode)')
     )
     parser.add_argument(
         '-e', '--env_id', type=int,
@@ -111,6 +112,16 @@ def get_base_parser(
         default=5, type=int,
         help='set iteration count of benchmark'
     )
+    parser.add_argument(
+        '--benchmark_warmup', metavar='BENCHMARK_WARMUP',
+        default=1, type=int,
+        help='number of benchmark iterations run before the measurement'
+    )
+    parser.add_argument(
+        '--benchmark_output', metavar='BENCHMARK_OUTPUT', default=None,
+        help=('save the benchmark results (per-stage timings) to this '
+              '.json or .csv file')
+    )
     return parser
 
 
@@ -166,7 +177,14 @@ def update_parser(parser, check_input_type=True, large_model=False):
         logger.info(f'{env.name}')
 
     # -------------------------------------------------------------------------
-    # 2. update input
+    # 2. benchmark mode: time the inference calls of the sessions
+    if getattr(args, 'benchmark', False):
+        from benchmark_utils import enable_benchmark
+        name = os.path.splitext(os.path.basename(sys.argv[0]))[0]
+        enable_benchmark(args, name=name)
+
+    # -------------------------------------------------------------------------
+    # 3. update input
     if args.video is not None:
         args.ftype = 'video'
         args.input = None # force video mode
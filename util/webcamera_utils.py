@@ -1,5 +1,7 @@
 import os
 import sys
+import threading
+from queue import Queue, Empty, Full
 
 import numpy as np
 import cv2
@@ -185,3 +187,210 @@ def get_capture(video):
             capture = cv2.VideoCapture(video)
 
     return capture
+
+
+# =============================================================================
+# Threaded video pipeline
+# =============================================================================
+BACKPRESSURE_BLOCK = 'block'
+BACKPRESSURE_DROP_OLDEST = 'drop_oldest'
+
+_END_OF_STREAM = object()
+
+
+def _put_drop_oldest(queue, item):
+    while True:
+        try:
+            queue.put_nowait(item)
+            return
+        except Full:
+            try:
+                queue.get_nowait()
+            except Empty:
+                pass
+
+
+class VideoPipeline:
+    """
+    Capture / inference / render pipeline joined by bounded queues.
+
+    The decoder thread reads frames from `capture`, the inference stage
+    runs `predict` in the calling thread, and the render thread runs
+    `render` and writes the rendered frames to `writer`.
+    Frames are handed to the writer in the order they were decoded.
+    `cv2.imshow` is called from the calling thread so that it also works
+    on platforms where GUI functions must run on the main thread.
+
+    Parameters
+    ----------
+    capture: cv2.VideoCapture
+    predict: callable
+        predict(frame) -> result. The result must not be modified
+        by the next call (ex. copy detector objects into a list).
+    render: callable
+        render(frame, result) -> image to display / write.
+        When None, `frame` is used as is.
+    writer: cv2.VideoWriter
+        None means no output video.
+    queue_size: int
+        Capacity of each queue between the stages.
+    backpressure: string
+        Behavior when the inference stage is slower than the decoder.
+        - 'block': the decoder waits, every frame is processed
+        - 'drop_oldest': the oldest waiting frame is discarded
+          (keeps the latency low for webcamera input)
+    show: bool
+        Show the rendered frames with `cv2.imshow`. Pressing 'q' stops.
+    window_name: string
+    """
+
+    def __init__(
+            self, capture, predict, render=None, writer=None,
+            queue_size=4, backpressure=BACKPRESSURE_BLOCK,
+            show=True, window_name='frame',
+    ):
+        if backpressure not in (BACKPRESSURE_BLOCK, BACKPRESSURE_DROP_OLDEST):
+            raise ValueError(f'unknown backpressure: {backpressure}')
+        self.capture = capture
+        self.predict = predict
+        self.render = render
+        self.writer = writer
+        self.backpressure = backpressure
+        self.show = show
+        self.window_name = window_name
+
+        self.frame_queue = Queue(maxsize=queue_size)
+        self.result_queue = Queue(maxsize=queue_size)
+        self.display_queue = Queue(maxsize=1)
+        self.stop_event = threading.Event()
+        self.frame_count = 0
+        self.dropped_count = 0
+        self.error = None
+
+    def _decode_loop(self):
+        try:
+            while not self.stop_event.is_set():
+                ret, frame = self.capture.read()
+                if not ret:
+                    break
+                if self.backpressure == BACKPRESSURE_DROP_OLDEST:
+                    if self.frame_queue.full():
+                        self.dropped_count += 1
+                    _put_drop_oldest(self.frame_queue, frame)
+                else:
+                    self._put_blocking(self.frame_queue, frame)
+        except Exception as e:
+            self.error = e
+        finally:
+            self._put_end(self.frame_queue)
+
+    def _render_loop(self):
+        try:
+            while True:
+                item = self.result_queue.get()
+                if item is _END_OF_STREAM:
+                    break
+                frame, result = item
+                if self.render is not None:
+                    frame = self.render(frame, result)
+                if self.writer is not None:
+                    self.writer.write(frame)
+                if self.show:
+                    _put_drop_oldest(self.display_queue, frame)
+        except Exception as e:
+            self.error = e
+            self.stop_event.set()
+
+    def _put_blocking(self, queue, item):
+        while not self.stop_event.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _put_end(self, queue):
+        if self.backpressure == BACKPRESSURE_BLOCK:
+            # wait for the inference stage, every frame is processed
+            # (once stopped, the inference stage does not read any more)
+            self._put_blocking(queue, _END_OF_STREAM)
+            return
+        # the end marker must not be dropped, an old frame is
+        while True:
+            try:
+                queue.put(_END_OF_STREAM, timeout=0.1)
+                return
+            except Full:
+                try:
+                    queue.get_nowait()
+                except Empty:
+                    pass
+
+    def _display(self):
+        try:
+            frame = self.display_queue.get_nowait()
+        except Empty:
+            frame = None
+        if frame is not None:
+            cv2.imshow(self.window_name, frame)
+        if cv2.waitKey(1) & 0xFF == ord('q'):
+            self.stop_event.set()
+
+    def run(self):
+        """
+        Process the whole stream.
+
+        Returns
+        -------
+        frame_count: int
+            Number of frames processed by the inference stage.
+        """
+        decoder = threading.Thread(target=self._decode_loop, daemon=True)
+        renderer = threading.Thread(target=self._render_loop, daemon=True)
+        decoder.start()
+        renderer.start()
+
+        try:
+            while not self.stop_event.is_set():
+                if self.show:
+                    self._display()
+                try:
+                    frame = self.frame_queue.get(timeout=0.01)
+                except Empty:
+                    continue
+                if frame is _END_OF_STREAM:
+                    break
+                result = self.predict(frame)
+                self.frame_count += 1
+                self._put_blocking(self.result_queue, (frame, result))
+        finally:
+            self.stop_event.set()
+            decoder.join()
+            # let the renderer finish the frames already predicted
+            while renderer.is_alive():
+                try:
+                    self.result_queue.put(_END_OF_STREAM, timeout=0.1)
+                    break
+                except Full:
+                    pass
+            renderer.join()
+            if self.show:
+                self._display()
+
+        if self.error is not None:
+            raise self.error
+        if self.dropped_count > 0:
+            logger.info(f'{self.dropped_count} frames dropped')
+        return self.frame_count
+
+
+def run_video_pipeline(capture, predict, render=None, writer=None, **kwargs):
+    """
+    Shortcut of `VideoPipeline(...).run()`.
+    See `VideoPipeline` for the parameters.
+    """
+    pipeline = VideoPipeline(
+        capture, predict, render=render, writer=writer, **kwargs
+    )
+    return pipeline.run()